@@ -5,10 +5,83 @@ PORT = os.environ.get('PORT') or 4000
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 DATABASE = os.environ.get('DATABASE') or 'sqlite:///' + os.path.join(basedir, 'database.sqlite')
+# Threads used to run database work off the event loop
+DB_WORKERS = int(os.environ.get('DB_WORKERS') or 1)
+# Changes are written in batches, at most every DB_FLUSH_INTERVAL seconds.
+# DB_DURABILITY says when a save counts as done: 'sync' (written straight
+# away), 'batch' (once its batch is written) or 'async' (immediately; a crash
+# can lose the last batch)
+DB_FLUSH_INTERVAL = float(os.environ.get('DB_FLUSH_INTERVAL') or 0.5)
+DB_DURABILITY = os.environ.get('DB_DURABILITY') or 'async'
+# Connections kept open for the db workers, and the SQLite settings used on
+# each of them (see app/db/engine.py); DB_CACHE_SIZE is in KiB
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 5)
+DB_JOURNAL_MODE = os.environ.get('DB_JOURNAL_MODE') or 'WAL'
+DB_SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS') or 'NORMAL'
+DB_CACHE_SIZE = -int(os.environ.get('DB_CACHE_SIZE') or 16000)
+
+# Password hashing work factor; existing hashes are upgraded when users log in
+PASSWORD_ROUNDS = int(os.environ.get('PASSWORD_ROUNDS') or 150000)
+# Processes used for password hashing, and how many hashes may run at once
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS') or 2)
+HASH_CONCURRENCY = int(os.environ.get('HASH_CONCURRENCY') or 4)
 
 LOBBY_ROOM_NAME = "Lobby"
 LOBBY_ROOM_DESC = "Welcome to MtGMUD!!\nYou are in the lobby area. Type 'help' to get started!"
 
 ADMIN = os.environ.get('ADMIN') or None
 
+# Longest line (in characters) a client may send before it is thrown away
+MAX_LINE_LENGTH = int(os.environ.get('MAX_LINE_LENGTH') or 1024)
+# Bytes the transport may buffer before we stop writing to a client, and how
+# much more we will queue for it after that before dropping the connection
+WRITE_BUFFER_HIGH = int(os.environ.get('WRITE_BUFFER_HIGH') or 65536)
+OUTPUT_BUFFER_LIMIT = int(os.environ.get('OUTPUT_BUFFER_LIMIT') or 1048576)
+
+# Seconds per tick of the timer wheel
+TIMER_RESOLUTION = float(os.environ.get('TIMER_RESOLUTION') or 1.0)
+
+# Card data is imported from CARD_DATA (plain or gzipped JSON), which is
+# downloaded from CARD_DATA_URL first if it doesn't exist yet
+CARD_DATA = os.environ.get('CARD_DATA') or os.path.join(basedir, 'AllCards.json')
+CARD_DATA_URL = os.environ.get('CARD_DATA_URL') or 'http://mtgjson.com/json/AllCards.json'
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE') or 1000)
+
+# Help files are loaded from HELP_DIR, and checked for changes every
+# HELP_RELOAD_INTERVAL seconds (0 to never check)
+HELP_DIR = os.environ.get('HELP_DIR') or os.path.join(os.path.dirname(basedir), 'help')
+HELP_RELOAD_INTERVAL = float(os.environ.get('HELP_RELOAD_INTERVAL') or 5)
+
+# Most cards shown for a single card search
+CARD_SEARCH_LIMIT = int(os.environ.get('CARD_SEARCH_LIMIT') or 10)
+# Cards listed on each page of a 'card' query
+CARD_PAGE_SIZE = int(os.environ.get('CARD_PAGE_SIZE') or 20)
+
+# Commands taking longer than SLOW_COMMAND_MS are logged with their arguments,
+# and event loop lag is sampled every LOOP_LAG_INTERVAL seconds
+SLOW_COMMAND_MS = float(os.environ.get('SLOW_COMMAND_MS') or 100)
+LOOP_LAG_INTERVAL = float(os.environ.get('LOOP_LAG_INTERVAL') or 0.5)
+# If METRICS_PORT is set, metrics are served there over HTTP in the
+# Prometheus text format
+METRICS_HOST = os.environ.get('METRICS_HOST') or '127.0.0.1'
+METRICS_PORT = int(os.environ.get('METRICS_PORT') or 0)
+
+# The admin 'profile' command writes to PROFILE_DIR, sampling the stack every
+# PROFILE_INTERVAL_MS of CPU time, for at most PROFILE_MAX_SECONDS
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(os.path.dirname(basedir), 'profiles')
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS') or 5)
+PROFILE_MAX_SECONDS = int(os.environ.get('PROFILE_MAX_SECONDS') or 600)
+
+# With SHARDS > 0 the server runs sharded: this process takes connections and
+# signs users in, and rooms are shared out between SHARDS worker processes
+# (see app/mud/cluster.py). They talk over a socket in SHARD_SOCKET_DIR.
+SHARDS = int(os.environ.get('SHARDS') or 0)
+SHARD_SOCKET_DIR = os.environ.get('SHARD_SOCKET_DIR') or None
+SHARD_START_TIMEOUT = float(os.environ.get('SHARD_START_TIMEOUT') or 300)
+
+# Separate servers can share chat through a message broker on a Unix socket
+# at BUS_SOCKET, which the server with BUS_BROKER set runs (see app/mud/bus.py)
+BUS_SOCKET = os.environ.get('BUS_SOCKET') or None
+BUS_BROKER = bool(int(os.environ.get('BUS_BROKER') or 0))
+
 BANNED_NAMES = ['admin', 'fuck', 'shit', 'asshole', 'ass', 'nigger']
\ No newline at end of file
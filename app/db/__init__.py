@@ -1,3 +1,3 @@
-from .models import Session
-
-session = Session()
\ No newline at end of file
+from .models import Session, session_scope
+from .executor import run, save, add, delete, shutdown, writer
+from . import passwords
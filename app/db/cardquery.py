@@ -0,0 +1,466 @@
+"""
+The search language used by the 'card' command, and the index it is run
+against. A query is a list of terms, all of which a card has to match:
+
+    t:creature c:green cmc<=3 o:"draw a card"
+
+Terms can be negated with '-', joined with 'or' and grouped with brackets.
+Bare words match card names. 'page:2' picks a page of the results.
+"""
+import asyncio
+import operator
+import re
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+from .catalog import normalize
+
+
+class QueryError(ValueError):
+    pass
+
+
+# Search key: the field it searches
+KEYS = {
+    'n': 'name', 'name': 'name',
+    't': 'type', 'type': 'type',
+    'c': 'color', 'color': 'color', 'colour': 'color',
+    'r': 'rarity', 'rarity': 'rarity',
+    'o': 'text', 'oracle': 'text', 'text': 'text',
+    'cmc': 'cmc', 'mv': 'cmc',
+    'pow': 'power', 'power': 'power',
+    'tou': 'toughness', 'toughness': 'toughness',
+    'loy': 'loyalty', 'loyalty': 'loyalty'
+}
+NUMERIC_FIELDS = ['cmc', 'power', 'toughness', 'loyalty']
+# Fields searched by word, through an inverted index
+WORD_FIELDS = ['name', 'text']
+
+COMPARISONS = {
+    ':': operator.eq,
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge
+}
+
+COLOURS = {'w': 'White', 'u': 'Blue', 'b': 'Black', 'r': 'Red', 'g': 'Green'}
+COLOURLESS = ('c', 'colorless', 'colourless')
+MULTICOLOUR = ('m', 'multicolor', 'multicolour', 'gold')
+
+TOKEN_PATTERN = re.compile(r"""
+    \s*(?:
+        (?P<open>\() | (?P<close>\)) |
+        (?P<negate>-)(?=[^\s)]) |
+        (?P<key>[a-z]+)(?P<op><=|>=|!=|<|>|=|:)(?P<value>"[^"]*"?|[^\s()"]+) |
+        (?P<word>"[^"]*"?|[^\s()]+)
+    )""", re.VERBOSE | re.IGNORECASE)
+
+# A parsed query: tree is made of ('and', [nodes]), ('or', [nodes]),
+# ('not', node) and ('term', field, op, value) nodes
+Query = namedtuple('Query', ['tree', 'page'])
+
+# One page of results
+Page = namedtuple('Page', ['cards', 'number', 'pages', 'total'])
+
+
+def unquote(value):
+    return value.strip('"')
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = TOKEN_PATTERN.match(text, pos)
+        pos = match.end()
+        if match.group('open'):
+            tokens.append(('(',))
+        elif match.group('close'):
+            tokens.append((')',))
+        elif match.group('negate'):
+            tokens.append(('-',))
+        elif match.group('key'):
+            tokens.append(('term', match.group('key').lower(), match.group('op'), unquote(match.group('value'))))
+        elif match.group('word').lower() == 'or':
+            tokens.append(('or',))
+        elif match.group('word').lower() != 'and' and normalize(match.group('word')):
+            tokens.append(('word', unquote(match.group('word'))))
+    return tokens
+
+
+def is_query(text):
+    """
+    Whether text uses any of the search language, rather than just being
+    (part of) a card name.
+    """
+    return any(token[0] != 'word' for token in tokenize(text))
+
+
+def term(key, op, value):
+    field = KEYS.get(key)
+    if field is None:
+        raise QueryError("Unknown search key '{}'.".format(key))
+    if field in NUMERIC_FIELDS:
+        try:
+            value = float(value)
+        except ValueError:
+            raise QueryError("'{}' needs a number.".format(key))
+    elif op not in (':', '='):
+        raise QueryError("'{}' can only be used with ':'.".format(key))
+    elif not normalize(value) and field != 'color':
+        raise QueryError("Search for what in '{}'?".format(key))
+    if field == 'color':
+        value = colours(value)
+    return ('term', field, op, value)
+
+
+def colours(value):
+    """
+    Reads a colour term: a colour name, letters such as 'gr' (green and
+    red), colourless or multicolour.
+    """
+    value = value.lower()
+    if value in COLOURLESS or value in MULTICOLOUR:
+        return value[0]
+    for colour in COLOURS.values():
+        if colour.lower() == value:
+            return (colour,)
+    if value and all(c in COLOURS for c in value):
+        return tuple(COLOURS[c] for c in value)
+    raise QueryError("Unknown colour '{}'.".format(value))
+
+
+def parse(text):
+    """
+    Parses a query, raising QueryError if it doesn't make sense.
+    """
+    page = 1
+    tokens = []
+    for token in tokenize(text):
+        if token[0] == 'term' and token[1] == 'page':
+            if not token[3].isdigit() or int(token[3]) < 1:
+                raise QueryError("Which page?")
+            page = int(token[3])
+        else:
+            tokens.append(token)
+    if not tokens:
+        raise QueryError("Search for what?")
+    tokens.reverse()
+
+    def parse_or():
+        nodes = [parse_and()]
+        while tokens and tokens[-1][0] == 'or':
+            tokens.pop()
+            nodes.append(parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and():
+        nodes = []
+        while tokens and tokens[-1][0] not in ('or', ')'):
+            nodes.append(parse_unary())
+        if not nodes:
+            if tokens and tokens[-1][0] == ')':
+                raise QueryError("Unexpected ')'.")
+            raise QueryError("'or' needs something on each side.")
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_unary():
+        token = tokens.pop()
+        if token[0] == '-':
+            if not tokens or tokens[-1][0] in ('or', ')'):
+                raise QueryError("'-' needs something after it.")
+            return ('not', parse_unary())
+        if token[0] == '(':
+            node = parse_or()
+            if not tokens or tokens.pop()[0] != ')':
+                raise QueryError("Missing ')'.")
+            return node
+        if token[0] == 'word':
+            return term('name', ':', token[1])
+        return term(*token[1:])
+
+    tree = parse_or()
+    if tokens:
+        raise QueryError("Unexpected ')'.")
+    return Query(tree, page)
+
+
+def is_phrase(node):
+    return node[0] == 'term' and node[1] in WORD_FIELDS and len(normalize(node[3]).split()) > 1
+
+
+def to_mask(rows, size):
+    bits = bytearray((size + 7) // 8)
+    for row in rows:
+        bits[row >> 3] |= 1 << (row & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def iter_bits(mask):
+    """
+    Yields the positions of the bits set in mask, lowest first.
+    """
+    data = mask.to_bytes((mask.bit_length() + 7) // 8, 'little')
+    for index, byte in enumerate(data):
+        while byte:
+            low = byte & -byte
+            yield index * 8 + low.bit_length() - 1
+            byte ^= low
+
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        # '*', '1+*' and the like can't be compared
+        return None
+
+
+class WordIndex(object):
+    """
+    An inverted index from words to the rows they appear in. Common words
+    are kept as bitsets; rare ones as arrays of rows, which take less room,
+    and are turned into bitsets when they are searched for.
+    """
+    def __init__(self, postings, size):
+        self.size = size
+        self.words = {}
+        for word, rows in postings.items():
+            # A bitset costs size bits; an array 32 bits a row
+            if len(rows) * 32 > size:
+                self.words[word] = to_mask(rows, size)
+            else:
+                self.words[word] = array('I', rows)
+        self.vocabulary = sorted(postings)
+
+    def mask(self, word):
+        rows = self.words.get(word, 0)
+        return rows if isinstance(rows, int) else to_mask(rows, self.size)
+
+    def prefix(self, prefix):
+        mask = 0
+        i = bisect_left(self.vocabulary, prefix)
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(prefix):
+            mask |= self.mask(self.vocabulary[i])
+            i += 1
+        return mask
+
+
+class CardIndex(object):
+    """
+    The catalog's cards held as columns, for searching. Each card is a bit,
+    in name order, and each column maps its values to a bitset (a Python
+    int) of the cards with that value, so a query is a handful of and/or/not
+    operations on whole columns whatever the number of cards. Once the
+    catalog changes, refresh() builds a new one off the event loop and swaps
+    it in.
+    """
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.version = None
+        # The refresh() under way, if any
+        self.building = None
+        # CardDefinition for each bit
+        self.rows = []
+        self.everything = 0
+        # Colour name: bitset, plus 'c' (colourless) and 'm' (multicoloured)
+        self.colours = {}
+        # Lower case type, supertype or subtype: bitset
+        self.types = {}
+        self.rarities = {}
+        # Numeric field: [(value, bitset), ...]
+        self.numbers = {}
+        self.names = None
+        self.texts = None
+        # Normalized name and rules text for each row, to check phrases against
+        self.name_keys = []
+        self.text_keys = []
+
+    def snapshot(self):
+        """
+        The catalog's version and cards as they are now, for build() to read
+        while the catalog goes on changing.
+        """
+        return self.catalog.version, list(self.catalog.by_id.values())
+
+    def build(self, snapshot=None):
+        version, cards = snapshot or self.snapshot()
+        rows = sorted(cards, key=lambda card: (card.name, card.id))
+        size = len(rows)
+        colours = {'c': [], 'm': []}
+        types = {}
+        rarities = {}
+        numbers = {field: {} for field in NUMERIC_FIELDS}
+        names = {}
+        texts = {}
+        name_keys = []
+        text_keys = []
+        for row, card in enumerate(rows):
+            for colour in card.colors or ():
+                colours.setdefault(colour, []).append(row)
+            if not card.colors:
+                colours['c'].append(row)
+            elif len(card.colors) > 1:
+                colours['m'].append(row)
+            for type_ in (card.supertypes or ()) + (card.types or ()) + (card.subtypes or ()):
+                types.setdefault(type_.lower(), []).append(row)
+            if card.rarity:
+                rarities.setdefault(card.rarity.lower(), []).append(row)
+            for field in NUMERIC_FIELDS:
+                value = number(getattr(card, field))
+                if value is not None:
+                    numbers[field].setdefault(value, []).append(row)
+            name_keys.append(normalize(card.name))
+            text_keys.append(normalize(card.text or ''))
+            for word in set(name_keys[-1].split()):
+                names.setdefault(word, []).append(row)
+            for word in set(text_keys[-1].split()):
+                texts.setdefault(word, []).append(row)
+        self.rows = rows
+        self.everything = (1 << size) - 1
+        self.colours = {colour: to_mask(bits, size) for colour, bits in colours.items()}
+        self.types = {type_: to_mask(bits, size) for type_, bits in types.items()}
+        self.rarities = {rarity: to_mask(bits, size) for rarity, bits in rarities.items()}
+        self.numbers = {field: sorted((value, to_mask(bits, size)) for value, bits in values.items())
+                        for field, values in numbers.items()}
+        self.names = WordIndex(names, size)
+        self.texts = WordIndex(texts, size)
+        self.name_keys = name_keys
+        self.text_keys = text_keys
+        self.version = version
+
+    async def refresh(self):
+        """
+        Brings the index up to date with the catalog. The new columns are
+        built on another thread from a snapshot of the cards, and searches
+        meanwhile see the old ones.
+        """
+        while self.version != self.catalog.version:
+            if self.building is None:
+                self.building = asyncio.ensure_future(self.rebuild())
+            # Shielded, so a caller going away doesn't stop the build
+            await asyncio.shield(self.building)
+
+    async def rebuild(self):
+        try:
+            index = CardIndex(self.catalog)
+            await asyncio.get_event_loop().run_in_executor(None, index.build, index.snapshot())
+            self.replace(index)
+        finally:
+            self.building = None
+
+    def replace(self, index):
+        """
+        Takes on the columns of index, one built off the event loop.
+        """
+        self.rows, self.everything = index.rows, index.everything
+        self.colours, self.types, self.rarities, self.numbers = index.colours, index.types, index.rarities, index.numbers
+        self.names, self.texts, self.name_keys, self.text_keys = index.names, index.texts, index.name_keys, index.text_keys
+        self.version = index.version
+
+    def __len__(self):
+        return len(self.rows)
+
+    def evaluate(self, node, scope):
+        """
+        Returns the bitset of cards matching a node of a parsed query. Only
+        the cards in scope need to be right; the caller ignores the rest.
+        """
+        kind = node[0]
+        if kind == 'and':
+            mask = scope
+            # Each term narrows the scope of the next; phrases, which have to
+            # be checked card by card, go last
+            for child in sorted(node[1], key=is_phrase):
+                mask &= self.evaluate(child, mask)
+                if not mask:
+                    break
+            return mask
+        if kind == 'or':
+            mask = 0
+            for child in node[1]:
+                mask |= self.evaluate(child, scope)
+            return mask
+        if kind == 'not':
+            return scope & ~self.evaluate(node[1], scope)
+        _, field, op, value = node
+        if field in NUMERIC_FIELDS:
+            return self.compare(field, op, value)
+        if field in WORD_FIELDS:
+            return self.match_words(field, value, scope)
+        return getattr(self, 'match_' + field)(value)
+
+    def compare(self, field, op, value):
+        compare = COMPARISONS[op]
+        mask = 0
+        for key, bits in self.numbers[field]:
+            if compare(key, value):
+                mask |= bits
+        return mask
+
+    def match_words(self, field, value, scope):
+        """
+        One word matches the start of any word; more than one (a quoted
+        phrase) must appear together, in order.
+        """
+        words, keys = (self.names, self.name_keys) if field == 'name' else (self.texts, self.text_keys)
+        value = normalize(value)
+        parts = value.split()
+        if len(parts) == 1:
+            return words.prefix(parts[0])
+        mask = scope
+        for part in parts:
+            mask &= words.mask(part)
+        # Every word is there; check they are together
+        return to_mask([row for row in iter_bits(mask) if value in keys[row]], len(self.rows))
+
+    def match_type(self, value):
+        mask = self.everything
+        for word in value.lower().split():
+            mask &= self.prefixed(self.types, word)
+        return mask
+
+    def match_rarity(self, value):
+        return self.prefixed(self.rarities, value.lower())
+
+    def match_color(self, value):
+        if isinstance(value, str):
+            return self.colours.get(value, 0)
+        mask = self.everything
+        for colour in value:
+            mask &= self.colours.get(colour, 0)
+        return mask
+
+    @staticmethod
+    def prefixed(column, prefix):
+        mask = 0
+        for key, bits in column.items():
+            if key.startswith(prefix):
+                mask |= bits
+        return mask
+
+    def search(self, query, page_size):
+        """
+        Runs a parsed query, returning the page of matching cards it asks
+        for (or the last page, if there aren't that many). It searches the
+        cards as of the last build; refresh() first to see the latest.
+        """
+        mask = self.evaluate(query.tree, self.everything)
+        total = bin(mask).count('1')
+        pages = max(1, -(-total // page_size))
+        page = min(query.page, pages)
+        skip = (page - 1) * page_size
+        cards = []
+        for row in iter_bits(mask):
+            if skip:
+                skip -= 1
+                continue
+            cards.append(self.rows[row])
+            if len(cards) == page_size:
+                break
+        return Page(cards, page, pages, total)
@@ -0,0 +1,236 @@
+import asyncio
+import re
+import unicodedata
+from bisect import bisect_left, insort
+from collections import namedtuple, Counter
+from difflib import SequenceMatcher
+
+from sqlalchemy import event, select
+
+from . import models
+from .events import after_commit
+
+FIELDS = ['id', 'name', 'names', 'manaCost', 'cmc', 'colors', 'type', 'supertypes',
+          'types', 'subtypes', 'rarity', 'text', 'power', 'toughness', 'loyalty']
+LIST_FIELDS = ['names', 'colors', 'supertypes', 'types', 'subtypes']
+# Fields kept in their own tables, rather than columns of the card table
+JOINED_FIELDS = ['colors', 'supertypes', 'types', 'subtypes']
+
+# An immutable copy of a row from the card table
+CardDefinition = namedtuple('CardDefinition', FIELDS)
+
+# Lowest similarity (0-1) a name needs to be offered as a typo correction
+FUZZY_CUTOFF = 0.6
+
+
+def normalize(name):
+    """
+    Folds a card name down to the key it is indexed under: lower case, no
+    accents or punctuation, single spaces.
+    """
+    name = unicodedata.normalize('NFKD', name.casefold().replace('æ', 'ae'))
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = re.sub(r"[^\w\s%]", lambda m: ' ' if m.group() == '-' else '', name)
+    return ' '.join(name.split())
+
+
+def trigrams(key):
+    return {key[i:i+3] for i in range(len(key) - 2)}
+
+
+def definition(row, lists=None):
+    """
+    Copies a card. row may be a Card, or a row from the card table with its
+    colours and types in lists ({field: [name, ...]}).
+    """
+    values = []
+    for field in FIELDS:
+        if lists is not None and field in JOINED_FIELDS:
+            value = lists.get(field)
+        else:
+            value = getattr(row, field)
+        if field in LIST_FIELDS:
+            value = tuple(value) if value else None
+        values.append(value)
+    return CardDefinition(*values)
+
+
+def read_lists(session):
+    """
+    Returns {card id: {field: [name, ...]}} with every card's colours and
+    types, the types in the order they are listed on the card.
+    """
+    lists = {}
+    colors = select([models.card_colors.c.card_id, models.Color.name]).select_from(
+        models.card_colors.join(models.Color.__table__)
+    ).order_by(models.card_colors.c.card_id, models.Color.id)
+    for card_id, name in session.execute(colors):
+        lists.setdefault(card_id, {}).setdefault('colors', []).append(name)
+    types = select([models.card_types.c.card_id, models.CardType.kind, models.CardType.name]).select_from(
+        models.card_types.join(models.CardType.__table__)
+    ).order_by(models.card_types.c.card_id, models.card_types.c.position)
+    for card_id, kind, name in session.execute(types):
+        lists.setdefault(card_id, {}).setdefault(models.TYPE_KINDS[kind], []).append(name)
+    return lists
+
+
+class CardCatalog(object):
+    """
+    The whole card table held in memory, indexed by id and by normalized name,
+    so card lookups never have to touch the database.
+    """
+    def __init__(self):
+        self.by_id = {}
+        # normalized name: [CardDefinition, ...]
+        self.by_key = {}
+        # Sorted normalized names, for prefix lookups
+        self.keys = []
+        # trigram: set(normalized names), for substring and fuzzy lookups
+        self.grams = {}
+        # Goes up whenever a card is added, changed or removed
+        self.version = 0
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def load(self, session=None):
+        """
+        (Re)builds the catalog from the card table.
+        """
+        if session is None:
+            with models.session_scope() as session:
+                return self.load(session)
+        self.version += 1
+        self.by_id.clear()
+        self.by_key.clear()
+        self.keys.clear()
+        self.grams.clear()
+        lists = read_lists(session)
+        for row in session.execute(models.Card.__table__.select()):
+            self.index(definition(row, lists.get(row.id, {})))
+        self.keys.sort()
+
+    def replace(self, catalog):
+        """
+        Takes on the cards of catalog, one loaded off the event loop, say.
+        """
+        self.by_id, self.by_key, self.keys, self.grams = catalog.by_id, catalog.by_key, catalog.keys, catalog.grams
+        self.version += 1
+
+    def listen(self, loop=None):
+        """
+        Keeps the catalog in step with cards added, changed or removed through
+        the ORM, once they are committed (on loop). The importer writes
+        without the ORM, so after an import the catalog needs loading again.
+        """
+        loop = loop or asyncio.get_event_loop()
+        changed = lambda mapper, conn, card: after_commit(card, loop, self.add, definition(card))
+        event.listen(models.Card, 'after_insert', changed)
+        event.listen(models.Card, 'after_update', changed)
+        event.listen(models.Card, 'after_delete', lambda mapper, conn, card: after_commit(card, loop, self.remove, card.id))
+
+    def index(self, card):
+        self.by_id[card.id] = card
+        key = normalize(card.name)
+        if key in self.by_key:
+            self.by_key[key].append(card)
+            return
+        self.by_key[key] = [card]
+        self.keys.append(key)
+        for gram in trigrams(key):
+            self.grams.setdefault(gram, set()).add(key)
+
+    def add(self, card):
+        self.remove(card.id)
+        self.version += 1
+        key = normalize(card.name)
+        new_key = key not in self.by_key
+        self.index(card)
+        if new_key:
+            # index() appended it; move it to its sorted place
+            self.keys.pop()
+            insort(self.keys, key)
+
+    def remove(self, card_id):
+        card = self.by_id.pop(card_id, None)
+        if card is None:
+            return
+        self.version += 1
+        key = normalize(card.name)
+        cards = [c for c in self.by_key[key] if c.id != card_id]
+        if cards:
+            self.by_key[key] = cards
+            return
+        del self.by_key[key]
+        self.keys.pop(bisect_left(self.keys, key))
+        for gram in trigrams(key):
+            self.grams[gram].discard(key)
+
+    def get(self, card_id):
+        return self.by_id.get(card_id)
+
+    def exact(self, name):
+        return list(self.by_key.get(normalize(name), []))
+
+    def prefix(self, name):
+        key = normalize(name)
+        keys = []
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i].startswith(key):
+            keys.append(self.keys[i])
+            i += 1
+        keys.sort(key=len)
+        return self.cards(keys)
+
+    def substring(self, name):
+        key = normalize(name)
+        if len(key) < 3:
+            candidates = self.keys
+        else:
+            postings = sorted((self.grams.get(gram, set()) for gram in trigrams(key)), key=len)
+            candidates = set.intersection(*postings)
+        keys = [k for k in candidates if key in k]
+        keys.sort(key=lambda k: (k.index(key), len(k)))
+        return self.cards(keys)
+
+    def fuzzy(self, name, limit=10):
+        """
+        Names that look like a typo of name, best match first.
+        """
+        key = normalize(name)
+        shared = Counter()
+        for gram in trigrams(key):
+            shared.update(self.grams.get(gram, ()))
+        # Only score the names sharing the most trigrams with the query
+        scored = []
+        for candidate, _ in shared.most_common(limit * 5):
+            score = SequenceMatcher(None, key, candidate).ratio()
+            if score >= FUZZY_CUTOFF:
+                scored.append((score, candidate))
+        scored.sort(key=lambda s: (-s[0], s[1]))
+        return self.cards([candidate for _, candidate in scored[:limit]])
+
+    def like(self, pattern):
+        """
+        Matches an SQL LIKE style pattern, where % and _ are wildcards.
+        """
+        wildcards = {'%': '.*', '_': '.'}
+        regex = re.compile(''.join(wildcards.get(c) or re.escape(c) for c in normalize(pattern)))
+        return self.cards([k for k in self.keys if regex.fullmatch(k)])
+
+    def search(self, name):
+        """
+        Returns the best matches for name: an exact match if there is one,
+        otherwise names starting with it, then names containing it, and
+        finally names that look like a typo of it.
+        """
+        if '%' in name or '_' in name:
+            return self.like(name)
+        for lookup in (self.exact, self.prefix, self.substring, self.fuzzy):
+            cards = lookup(name)
+            if cards:
+                return cards
+        return []
+
+    def cards(self, keys):
+        return [card for key in keys for card in self.by_key[key]]
@@ -0,0 +1,112 @@
+import asyncio
+from collections import namedtuple
+
+from sqlalchemy import event
+
+from . import models
+from .events import after_commit
+
+CHANNEL_FIELDS = ['key', 'name', 'colour_token', 'type', 'default']
+EMOTE_FIELDS = ['id', 'name', 'user_no_vict', 'others_no_vict', 'user_vict', 'others_vict',
+                'vict_vict', 'user_vict_self', 'others_vict_self']
+
+
+def compile_template(template, fields, **fixed):
+    """
+    Fills in the parts of template that are the same every time it is used,
+    and returns the format method for the rest (fields).
+    """
+    values = {name: str(value).replace('{', '{{').replace('}', '}}') for name, value in fixed.items()}
+    values.update({name: '{' + name + '}' for name in fields})
+    return template.format(**values).format
+
+
+# An immutable copy of a row from the channel table, with the lines sent on
+# it ready formatted apart from the user, target and message
+ChannelDefinition = namedtuple('ChannelDefinition', CHANNEL_FIELDS + ['emote_line', 'user_line', 'others_line'])
+
+
+def channel_definition(row):
+    fixed = {'colour': row.colour_token, 'channel': row.name}
+    return ChannelDefinition(
+        *[getattr(row, field) for field in CHANNEL_FIELDS],
+        emote_line=compile_template("&W[&x{colour}{channel}&x&W]&x {colour}{msg}&x", ['msg'], **fixed),
+        user_line=compile_template("&W[&x{colour}{channel}&x&W]&x You{to}: {colour}{msg}&x", ['to', 'msg'], **fixed),
+        others_line=compile_template("&W[&x{colour}{channel}&x&W]&x {user}: {colour}{msg}&x", ['user', 'msg'], **fixed)
+    )
+
+
+# An emote, with each of its templates (if it has one) stored as the bound
+# format method ready to be called with user= and vict=
+EmoteDefinition = namedtuple('EmoteDefinition', EMOTE_FIELDS)
+
+
+def emote_definition(row):
+    values = []
+    for field in EMOTE_FIELDS:
+        value = getattr(row, field)
+        if field not in ('id', 'name') and value is not None:
+            value = value.format
+        values.append(value)
+    return EmoteDefinition(*values)
+
+
+class ChatCache(object):
+    """
+    The channel and emote tables held in memory, so talking on a channel or
+    emoting never has to touch the database. Rows changed through the ORM
+    are picked up once they are committed; anything changed behind the
+    server's back needs reading again with read_channels() / read_emotes().
+    """
+    def __init__(self):
+        # channel key: ChannelDefinition
+        self.channels = {}
+        # emote name: EmoteDefinition
+        self.emotes = {}
+
+    @staticmethod
+    def read_channels():
+        with models.session_scope() as session:
+            return {row.key: channel_definition(row) for row in session.query(models.Channel).all()}
+
+    @staticmethod
+    def read_emotes():
+        with models.session_scope() as session:
+            return {row.name: emote_definition(row) for row in session.query(models.Emote).all()}
+
+    def set_channels(self, channels):
+        # Updated in place, as the server keeps a reference to the dict
+        self.channels.clear()
+        self.channels.update(channels)
+
+    def set_emotes(self, emotes):
+        self.emotes.clear()
+        self.emotes.update(emotes)
+
+    def listen(self, loop=None):
+        """
+        Keeps the cache in step with channels and emotes added, changed or
+        removed through the ORM, once they are committed (on loop).
+        """
+        loop = loop or asyncio.get_event_loop()
+        channel_changed = lambda mapper, conn, row: after_commit(row, loop, self.add_channel, channel_definition(row))
+        emote_changed = lambda mapper, conn, row: after_commit(row, loop, self.add_emote, emote_definition(row))
+        event.listen(models.Channel, 'after_insert', channel_changed)
+        event.listen(models.Channel, 'after_update', channel_changed)
+        event.listen(models.Channel, 'after_delete', lambda mapper, conn, row: after_commit(row, loop, self.channels.pop, row.key, None))
+        event.listen(models.Emote, 'after_insert', emote_changed)
+        event.listen(models.Emote, 'after_update', emote_changed)
+        event.listen(models.Emote, 'after_delete', lambda mapper, conn, row: after_commit(row, loop, self.remove_emote, row.id))
+
+    def add_channel(self, channel):
+        self.channels[channel.key] = channel
+
+    def add_emote(self, emote):
+        # It may have been renamed
+        self.remove_emote(emote.id)
+        self.emotes[emote.name] = emote
+
+    def remove_emote(self, emote_id):
+        for name, emote in list(self.emotes.items()):
+            if emote.id == emote_id:
+                del self.emotes[name]
@@ -0,0 +1,50 @@
+"""
+Engine set up for the game database. Nothing here imports the app package,
+so benchmarks can load this file on its own.
+"""
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool, StaticPool
+
+# Set on every new SQLite connection. WAL lets readers carry on while a batch
+# is written, and with synchronous=NORMAL a commit doesn't wait for an fsync
+# (the database can't be corrupted, though a power cut may lose the last few
+# commits). A negative cache_size is in KiB.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY'
+}
+
+
+def set_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute("PRAGMA {} = {}".format(name, value))
+    cursor.close()
+
+
+def make_engine(url, pool_size=5, pragmas=None, **kwargs):
+    """
+    Creates an engine for url. SQLite databases get pragmas (SQLITE_PRAGMAS
+    by default) set on each connection, and a pool of pool_size connections
+    that can be used from any thread.
+    """
+    if not url.startswith('sqlite'):
+        return create_engine(url, pool_size=pool_size, **kwargs)
+    pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+    in_memory = url in ('sqlite://', 'sqlite:///:memory:')
+    if in_memory:
+        # Every connection to :memory: is a new, empty database, so they all share one
+        kwargs.setdefault('poolclass', StaticPool)
+    else:
+        kwargs.setdefault('poolclass', QueuePool)
+        kwargs.setdefault('pool_size', pool_size)
+    engine = create_engine(url, connect_args={'check_same_thread': False}, **kwargs)
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        set_pragmas(dbapi_connection, pragmas)
+
+    return engine
@@ -0,0 +1,34 @@
+"""
+Hands changes seen by mapper events to the event loop once they are
+committed, for the in-memory copies of tables (the card catalog, the chat
+cache) to follow.
+
+Mapper events fire in the middle of a flush, on whichever thread is
+flushing, before the transaction has committed, and it may yet be rolled
+back. So what they see is only noted on the session, and applied on the
+event loop after the commit; a rollback throws it away.
+"""
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from . import models
+
+PENDING = 'after_commit'
+
+
+def after_commit(row, loop, func, *args):
+    """
+    Calls func(*args) on loop once the transaction changing row commits.
+    """
+    object_session(row).info.setdefault(PENDING, []).append((loop, func, args))
+
+
+@event.listens_for(models.Session, 'after_commit')
+def committed(session):
+    for loop, func, args in session.info.pop(PENDING, ()):
+        loop.call_soon_threadsafe(func, *args)
+
+
+@event.listens_for(models.Session, 'after_rollback')
+def rolled_back(session):
+    session.info.pop(PENDING, None)
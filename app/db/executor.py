@@ -0,0 +1,52 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from app import config, metrics
+from .writeback import WriteBehind
+
+# Database work is run on these threads, off the event loop. Each thread has
+# its own session and takes connections from the engine's pool.
+executor = ThreadPoolExecutor(max_workers=config.DB_WORKERS, thread_name_prefix='db')
+
+
+def run(func, *args, **kwargs):
+    """
+    Run blocking database work in the db thread pool and return an awaitable
+    for its result.
+    """
+    loop = asyncio.get_event_loop()
+    future = loop.run_in_executor(executor, partial(func, *args, **kwargs))
+    timing = metrics.current.get()
+    if timing is not None:
+        start = time.perf_counter()
+        future.add_done_callback(lambda f: timing.add_db(time.perf_counter() - start))
+    return future
+
+
+# Changes to rows are written behind, in batches; see WriteBehind
+writer = WriteBehind(run, interval=config.DB_FLUSH_INTERVAL, durability=config.DB_DURABILITY)
+
+
+def save(*instances, durable=False):
+    """
+    Queues changes to rows that have already been written once.
+    """
+    return writer.save(*instances, durable=durable)
+
+
+def add(*instances, durable=False):
+    return writer.add(*instances, durable=durable)
+
+
+def delete(instance, durable=False):
+    return writer.delete(instance, durable=durable)
+
+
+def shutdown():
+    """
+    Write anything still queued, then wait for any database work to finish.
+    """
+    writer.close(executor)
+    executor.shutdown(wait=True)
@@ -0,0 +1,185 @@
+import gzip
+import json
+import sys
+import time
+
+from sqlalchemy import bindparam, select
+
+from app import config
+from . import models
+
+CARD_FIELDS = ['name', 'names', 'manaCost', 'cmc', 'type', 'rarity', 'text', 'power', 'toughness', 'loyalty']
+# Lists of names stored in the colour and type tables rather than on the card
+LIST_FIELDS = ['colors', 'supertypes', 'types', 'subtypes']
+
+
+def open_card_data(path):
+    """
+    Opens a card JSON file as text, whether or not it has been gzipped.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def iter_object(f, chunk_size=65536):
+    """
+    Yields the (key, value) pairs of the top level JSON object in f, reading
+    it a chunk at a time so the whole document is never held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buff = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buff, pos, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+        buff = buff[pos:] + chunk
+        pos = 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buff) and buff[pos].isspace():
+                pos += 1
+            if pos < len(buff) or eof:
+                return
+            fill()
+
+    def expect(chars):
+        nonlocal pos
+        skip_whitespace()
+        if pos >= len(buff) or buff[pos] not in chars:
+            raise ValueError("Expected one of {!r} in card data".format(chars))
+        pos += 1
+        return buff[pos - 1]
+
+    def decode():
+        nonlocal pos
+        skip_whitespace()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buff, pos)
+                # A value running up to the end of the buffer (a number, say)
+                # might carry on in the next chunk.
+                if end < len(buff) or eof:
+                    pos = end
+                    return value
+            except ValueError:
+                if eof:
+                    raise
+            fill()
+
+    fill()
+    expect('{')
+    skip_whitespace()
+    if buff[pos:pos + 1] == '}':
+        return
+    while True:
+        key = decode()
+        expect(':')
+        value = decode()
+        yield key, value
+        if expect(',}') == '}':
+            return
+
+
+def card_row(card):
+    return {field: card.get(field) for field in CARD_FIELDS}
+
+
+def lookup_ids(conn, table, columns, keys):
+    """
+    Returns {key: id} for a lookup table such as colors, where each key is a
+    tuple of values for columns. Keys that aren't in the table yet are added.
+    """
+    select_ids = select([table.c[column] for column in columns] + [table.c.id])
+    ids = {tuple(row[:-1]): row[-1] for row in conn.execute(select_ids)}
+    missing = sorted(set(keys) - set(ids))
+    if missing:
+        conn.execute(table.insert(), [dict(zip(columns, key)) for key in missing])
+        ids = {tuple(row[:-1]): row[-1] for row in conn.execute(select_ids)}
+    return ids
+
+
+def save_card_lists(conn, cards):
+    """
+    Replaces the colours and types of cards, a dict of {card id: card data}.
+    """
+    card_ids = list(cards)
+    conn.execute(models.card_colors.delete().where(models.card_colors.c.card_id.in_(card_ids)))
+    conn.execute(models.card_types.delete().where(models.card_types.c.card_id.in_(card_ids)))
+    colors = {card_id: list(dict.fromkeys(card.get('colors') or ())) for card_id, card in cards.items()}
+    types = {card_id: [(kind, name) for kind, field in models.TYPE_KINDS.items()
+                       for name in dict.fromkeys(card.get(field) or ())]
+             for card_id, card in cards.items()}
+    color_ids = lookup_ids(conn, models.Color.__table__, ['name'],
+                           [(name,) for names in colors.values() for name in names])
+    type_ids = lookup_ids(conn, models.CardType.__table__, ['kind', 'name'],
+                          [key for keys in types.values() for key in keys])
+    color_rows = [{'card_id': card_id, 'color_id': color_ids[(name,)]}
+                  for card_id, names in colors.items() for name in names]
+    type_rows = [{'card_id': card_id, 'type_id': type_ids[key], 'position': position}
+                 for card_id, keys in types.items() for position, key in enumerate(keys)]
+    if color_rows:
+        conn.execute(models.card_colors.insert(), color_rows)
+    if type_rows:
+        conn.execute(models.card_types.insert(), type_rows)
+
+
+def save_batch(conn, cards):
+    """
+    Inserts new cards and updates existing ones, matched by name, along with
+    their colours and types.
+    """
+    table = models.Card.__table__
+    rows = {name: card_row(card) for name, card in cards.items()}
+    names = list(rows)
+    existing = dict(conn.execute(select([table.c.name, table.c.id]).where(table.c.name.in_(names))).fetchall())
+    inserts = [rows[name] for name in names if name not in existing]
+    updates = [dict(rows[name], b_id=existing[name]) for name in names if name in existing]
+    if inserts:
+        conn.execute(table.insert(), inserts)
+        existing = dict(conn.execute(select([table.c.name, table.c.id]).where(table.c.name.in_(names))).fetchall())
+    if updates:
+        conn.execute(table.update().where(table.c.id == bindparam('b_id')), updates)
+    save_card_lists(conn, {existing[name]: card for name, card in cards.items()})
+
+
+def import_cards(path, batch_size=None, engine=None):
+    """
+    Streams cards from an AllCards.json style file (optionally gzipped) into
+    the card table in batches. Cards already in the table are updated, so it
+    is safe to run again. Returns the number of cards read.
+    """
+    batch_size = batch_size or config.IMPORT_BATCH_SIZE
+    engine = engine or models.engine
+    start = time.time()
+    count = 0
+    batch = {}
+    with open_card_data(path) as f:
+        for key, card in iter_object(f):
+            batch[card['name']] = card
+            count += 1
+            if len(batch) >= batch_size:
+                with engine.begin() as conn:
+                    save_batch(conn, batch)
+                batch.clear()
+                elapsed = time.time() - start
+                print("Imported {} cards ({:.0f} rows/s)...".format(count, count / elapsed if elapsed else 0))
+        if batch:
+            with engine.begin() as conn:
+                save_batch(conn, batch)
+    elapsed = time.time() - start
+    print("Imported {} cards in {:.1f}s ({:.0f} rows/s).".format(count, elapsed, count / elapsed if elapsed else 0))
+    return count
+
+
+if __name__ == '__main__':
+    import_cards(sys.argv[1] if len(sys.argv) > 1 else config.CARD_DATA)
+    print("A running server picks the cards up with 'reload cards'.")
@@ -0,0 +1,145 @@
+"""
+Schema migrations. The schema version of an SQLite database is kept in its
+user_version pragma; a new database is created at SCHEMA_VERSION, and an
+older one has each migration after its version run on it in turn.
+"""
+import pickle
+
+from sqlalchemy import inspect, text
+
+
+def schema_version(conn):
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+
+def set_schema_version(conn, version):
+    conn.execute(text("PRAGMA user_version = {:d}".format(version)))
+
+
+def rename_tables(conn, names, suffix):
+    """
+    Moves tables out of the way so they can be created again with a new
+    schema, and drops their indexes, whose names the new tables will need.
+    """
+    # Stop SQLite pointing other tables' foreign keys at the renamed table
+    conn.execute(text("PRAGMA legacy_alter_table = ON"))
+    for name in names:
+        indexes = conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :name AND sql IS NOT NULL"
+        ), {'name': name}).fetchall()
+        for index, in indexes:
+            conn.execute(text('DROP INDEX "{}"'.format(index)))
+        conn.execute(text('ALTER TABLE "{0}" RENAME TO "{0}{1}"'.format(name, suffix)))
+    conn.execute(text("PRAGMA legacy_alter_table = OFF"))
+
+
+def unpickle(value, default=None):
+    return default if value is None else pickle.loads(value)
+
+
+def migrate_1(conn, metadata):
+    """
+    Replaces the pickled columns: user flags become a bitmask, aliases and
+    card names JSON, deck contents rows in deck_cards, and card colours and
+    types rows in lookup tables. Users get a deck_id for their active deck.
+    """
+    from . import importer, models
+
+    rename_tables(conn, ['users', 'decks', 'cards'], '_v0')
+    metadata.create_all(conn)
+    # Names may still clash in case; migrate_2 sorts that out and makes it again
+    conn.execute(text('DROP INDEX IF EXISTS "ix_users_name_lower"'))
+
+    users = conn.execute(text("SELECT id, name, aliases, flags, listening, _password FROM users_v0")).fetchall()
+    decks = conn.execute(text("SELECT id, name, user_id, cards FROM decks_v0 ORDER BY id")).fetchall()
+    # Until now the active deck wasn't stored, so start everyone on their first
+    first_decks = {}
+    for deck in decks:
+        first_decks.setdefault(deck.user_id, deck.id)
+    if users:
+        conn.execute(metadata.tables['users'].insert(), [{
+            'id': user.id,
+            'name': user.name,
+            'aliases': unpickle(user.aliases, {}),
+            'flags': models.encode_flags(unpickle(user.flags, {})),
+            'deck_id': first_decks.get(user.id),
+            'listening': user.listening,
+            '_password': user._password
+        } for user in users])
+    if decks:
+        conn.execute(metadata.tables['decks'].insert(), [
+            {'id': deck.id, 'name': deck.name, 'user_id': deck.user_id} for deck in decks
+        ])
+    deck_cards = [
+        {'deck_id': deck.id, 'card_id': card_id, 'count': count}
+        for deck in decks for card_id, count in unpickle(deck.cards, {}).items() if count > 0
+    ]
+    if deck_cards:
+        conn.execute(metadata.tables['deck_cards'].insert(), deck_cards)
+
+    columns = ['id', 'name', 'names', 'manaCost', 'cmc', 'type', 'rarity', 'text', 'power', 'toughness', 'loyalty']
+    cards = {}
+    rows = []
+    for card in conn.execute(text("SELECT * FROM cards_v0")).mappings():
+        card = dict(card)
+        for field in importer.LIST_FIELDS + ['names']:
+            card[field] = unpickle(card[field])
+        cards[card['id']] = card
+        rows.append({column: card[column] for column in columns})
+    if rows:
+        conn.execute(metadata.tables['cards'].insert(), rows)
+        importer.save_card_lists(conn, cards)
+
+    for name in ['users', 'decks', 'cards']:
+        conn.execute(text('DROP TABLE "{}_v0"'.format(name)))
+
+
+def migrate_2(conn, metadata):
+    """
+    Makes user names unique whatever their case. Where two users' names
+    differ only in case, the later one gets its id added to its name.
+    """
+    users = conn.execute(text("SELECT id, name FROM users ORDER BY id")).fetchall()
+    seen = set()
+    for user in users:
+        key = (user.name or '').lower()
+        if key in seen:
+            name = '{}_{}'.format(user.name, user.id)
+            print("Renaming user '{}' to '{}', as the name is already taken.".format(user.name, name))
+            conn.execute(text("UPDATE users SET name = :name WHERE id = :id"), {'name': name, 'id': user.id})
+            key = name.lower()
+        seen.add(key)
+    for index in metadata.tables['users'].indexes:
+        if index.name == 'ix_users_name_lower':
+            index.create(conn, checkfirst=True)
+
+
+# MIGRATIONS[n] takes a database from version n to n + 1
+MIGRATIONS = [migrate_1, migrate_2]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def upgrade(engine, metadata):
+    """
+    Creates any tables in metadata that are missing, first bringing an
+    existing SQLite database up to SCHEMA_VERSION.
+    """
+    if engine.dialect.name != 'sqlite':
+        metadata.create_all(engine)
+        return
+    with engine.begin() as conn:
+        # pysqlite only starts a transaction before a write, so without this
+        # the schema changes would each be committed as they ran. IMMEDIATE
+        # takes the write lock up front, so processes starting together (the
+        # shards) wait their turn rather than fail on upgrading a read lock.
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        version = schema_version(conn)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError("Database schema version {} is newer than this server's ({})".format(version, SCHEMA_VERSION))
+        if version == 0 and not inspect(conn).get_table_names():
+            version = SCHEMA_VERSION
+        for number in range(version, SCHEMA_VERSION):
+            print("Migrating database to schema version {}...".format(number + 1))
+            MIGRATIONS[number](conn, metadata)
+        metadata.create_all(conn)
+        set_schema_version(conn, SCHEMA_VERSION)
@@ -1,28 +1,81 @@
+from contextlib import contextmanager
+
 from passlib.hash import pbkdf2_sha256
-from sqlalchemy import Column, Integer, String, Boolean, PickleType, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, JSON, ForeignKey, Table, Index, UniqueConstraint, func, select
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import MutableDict
-from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import relationship, joinedload, selectinload
+from sqlalchemy.orm.collections import attribute_mapped_collection
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 from app import config
-
-engine = create_engine(config.DATABASE)
-Session = sessionmaker(bind=engine)
-session = Session()
+from .engine import SQLITE_PRAGMAS, make_engine
+from .migrations import upgrade
+
+engine = make_engine(config.DATABASE, pool_size=config.DB_POOL_SIZE, pragmas=dict(
+    SQLITE_PRAGMAS,
+    journal_mode=config.DB_JOURNAL_MODE,
+    synchronous=config.DB_SYNCHRONOUS,
+    cache_size=config.DB_CACHE_SIZE
+))
+# Each thread gets its own session. Objects stay loaded after a commit, so
+# the event loop can keep reading them once their session has gone.
+Session = scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
 Base = declarative_base()
 
+
+@contextmanager
+def session_scope():
+    """
+    A session for one unit of work: committed if the block finishes, rolled
+    back if it raises, and thrown away either way. Objects loaded in it are
+    left detached, but can still be read and can be saved again later.
+    """
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        Session.remove()
+
+
 USER_FLAGS = {
     'admin':False,
     'allow_spec': False,
     'banned': False,
     'muted': False,
-    'frozen': False
+    'frozen': False,
+    'colour': True,
+    'table_delta': False
 }
+# Bit of users.flags each flag is stored in; new flags only ever go on the end
+FLAG_BITS = ['admin', 'allow_spec', 'banned', 'muted', 'frozen', 'colour', 'table_delta']
+
+
+def flag_mask(name):
+    return 1 << FLAG_BITS.index(name)
+
+
+def encode_flags(flags):
+    bits = 0
+    for name in FLAG_BITS:
+        if flags.get(name, USER_FLAGS[name]):
+            bits |= flag_mask(name)
+    return bits
+
+
+def decode_flags(bits):
+    if bits is None:
+        return dict(USER_FLAGS)
+    return {name: bool(bits & flag_mask(name)) for name in FLAG_BITS}
+
 
 def generate_password_hash(password):
-    return pbkdf2_sha256.encrypt(password, rounds=150000, salt_size=15)
+    return pbkdf2_sha256.encrypt(password, rounds=config.PASSWORD_ROUNDS, salt_size=15)
 
 def check_password_hash(password, password_hash):
     return pbkdf2_sha256.verify(password, password_hash)
@@ -32,13 +85,35 @@ class User(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
-    aliases = Column(MutableDict.as_mutable(PickleType))
-    flags = Column(MutableDict.as_mutable(PickleType), default=USER_FLAGS)
-    decks = relationship('Deck')
-    deck = relationship('Deck', uselist=False, back_populates='user')
+    aliases = Column(MutableDict.as_mutable(JSON))
+    # The flags in USER_FLAGS, one bit each (see FLAG_BITS). Read and set
+    # them through flags; flag_bits is there for filtering in SQL.
+    flag_bits = Column('flags', Integer, nullable=False, default=encode_flags(USER_FLAGS))
+    decks = relationship('Deck', foreign_keys='Deck.user_id')
+    # The deck the user is playing with
+    deck_id = Column(Integer, ForeignKey('decks.id', use_alter=True, name='fk_users_deck_id'))
+    deck = relationship('Deck', foreign_keys=[deck_id], post_update=True)
     listening = Column(String)
     _password = Column(String)
 
+    # Names are unique whatever their case, as users are looked up by them
+    __table_args__ = (Index('ix_users_name_lower', func.lower(name), unique=True),)
+
+    @property
+    def flags(self):
+        return decode_flags(self.flag_bits)
+
+    @flags.setter
+    def flags(self, flags):
+        self.flag_bits = encode_flags(flags)
+
+    @staticmethod
+    def has_flag(name):
+        """
+        A filter for users with flag name set, e.g. User.has_flag('banned').
+        """
+        return User.flag_bits.op('&')(flag_mask(name)) != 0
+
     @property
     def password(self):
         raise AttributeError('password is not a readable attribute')
@@ -50,6 +125,15 @@ class User(Base):
     def verify_password(self, password):
         return check_password_hash(password, self._password)
 
+    @staticmethod
+    def by_name(user_name):
+        # Decks are loaded up front, as nothing can lazy-load once the session has gone
+        with session_scope() as session:
+            return session.query(User).options(
+                selectinload(User.decks).selectinload(Deck.entries),
+                joinedload(User.deck).selectinload(Deck.entries)
+            ).filter(func.lower(User.name) == user_name.lower()).first()
+
     def __repr__(self):
         return "<User(username='{}')>".format(self.username)
 
@@ -61,60 +145,157 @@ class Room(Base):
     name = Column(String)
     description = Column(String)
 
+    @staticmethod
+    def by_name(room_name):
+        with session_scope() as session:
+            return session.query(Room).filter_by(name=room_name).first()
+
     def __repr__(self):
         return "<Room(name='{}', description='{}')>".format(self.name, self.description)
 
 
+# Which colours and types each card has. The indexes on color_id and type_id
+# are what make "every Green Creature" a lookup rather than a scan.
+card_colors = Table(
+    'card_colors', Base.metadata,
+    Column('card_id', Integer, ForeignKey('cards.id'), primary_key=True),
+    Column('color_id', Integer, ForeignKey('colors.id'), primary_key=True),
+    Index('ix_card_colors_color_id', 'color_id', 'card_id')
+)
+
+card_types = Table(
+    'card_types', Base.metadata,
+    Column('card_id', Integer, ForeignKey('cards.id'), primary_key=True),
+    Column('type_id', Integer, ForeignKey('types.id'), primary_key=True),
+    # Where the type comes on the card's type line
+    Column('position', Integer, nullable=False, default=0),
+    Index('ix_card_types_type_id', 'type_id', 'card_id')
+)
+
+# CardType.kind: the Card attribute types of that kind are listed in
+TYPE_KINDS = {
+    'supertype': 'supertypes',
+    'type': 'types',
+    'subtype': 'subtypes'
+}
+
+
+class Color(Base):
+    __tablename__ = 'colors'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+
+    def __repr__(self):
+        return "<Color(name='{}')>".format(self.name)
+
+
+class CardType(Base):
+    __tablename__ = 'types'
+    __table_args__ = (UniqueConstraint('kind', 'name'),)
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    name = Column(String, nullable=False)
+
+    def __repr__(self):
+        return "<CardType(kind='{}', name='{}')>".format(self.kind, self.name)
+
+
 class Card(Base):
+    """
+    A card. Its colours and types live in their own tables, so they can be
+    filtered on in SQL; every Green Creature costing 3 or less is
+
+        session.query(Card).filter(Card.with_color('Green'), Card.with_type('Creature'), Card.cmc <= 3)
+
+    colors, supertypes, types and subtypes give them back as lists of names
+    (or None), as they appear in the card data.
+    """
     __tablename__ = 'cards'
 
     id = Column(Integer, primary_key=True)
 
     name = Column(String, index=True)
-    names = Column(PickleType)
+    names = Column(JSON)
     manaCost = Column(String)
-    cmc = Column(Integer)
-    colors = Column(PickleType)
+    cmc = Column(Integer, index=True)
     type = Column(String)
-    supertypes = Column(PickleType)
-    types = Column(PickleType)
-    subtypes = Column(PickleType)
     rarity = Column(String)
     text = Column(String)
     power = Column(String)
     toughness = Column(String)
     loyalty = Column(String)
+    color_rows = relationship('Color', secondary=card_colors, order_by='Color.id', lazy='selectin')
+    type_rows = relationship('CardType', secondary=card_types, order_by=card_types.c.position, lazy='selectin')
+
+    @property
+    def colors(self):
+        return [color.name for color in self.color_rows] or None
+
+    def types_of_kind(self, kind):
+        return [card_type.name for card_type in self.type_rows if card_type.kind == kind] or None
+
+    @property
+    def supertypes(self):
+        return self.types_of_kind('supertype')
+
+    @property
+    def types(self):
+        return self.types_of_kind('type')
+
+    @property
+    def subtypes(self):
+        return self.types_of_kind('subtype')
+
+    @staticmethod
+    def with_color(name):
+        """
+        A filter for cards that are (at least) colour name.
+        """
+        color_id = select([Color.id]).where(Color.name == name).scalar_subquery()
+        return Card.id.in_(select([card_colors.c.card_id]).where(card_colors.c.color_id == color_id))
+
+    @staticmethod
+    def with_type(name, kind='type'):
+        """
+        A filter for cards with the type (or supertype/subtype) name.
+        """
+        type_id = select([CardType.id]).where(CardType.kind == kind, CardType.name == name).scalar_subquery()
+        return Card.id.in_(select([card_types.c.card_id]).where(card_types.c.type_id == type_id))
 
     @staticmethod
     def search(card_name):
-        return session.query(Card).filter(Card.name.like(card_name)).all()
+        with session_scope() as session:
+            return session.query(Card).filter(Card.name.like(card_name)).all()
 
     def __repr__(self):
         return "<Card(name='{}')>".format(self.name)
 
 
+class DeckCard(Base):
+    __tablename__ = 'deck_cards'
+
+    deck_id = Column(Integer, ForeignKey('decks.id'), primary_key=True)
+    card_id = Column(Integer, ForeignKey('cards.id'), primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
 class Deck(Base):
     __tablename__ = 'decks'
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
     user_id = Column(Integer, ForeignKey('users.id'))
-    user = relationship('User', back_populates='deck')
-    # cards is a dict() of { card.id: no_of_cards }
-    cards = Column(MutableDict.as_mutable(PickleType))
+    entries = relationship('DeckCard', collection_class=attribute_mapped_collection('card_id'),
+                           cascade='all, delete-orphan')
+    # cards works like a dict() of { card.id: no_of_cards }, with a row in
+    # deck_cards for each card
+    cards = association_proxy('entries', 'count', creator=lambda card_id, count: DeckCard(card_id=card_id, count=count))
 
     @property
     def no_cards(self):
-        num = 0
-        for card in self.cards:
-            num += self.cards[card]
-        return num
-
-    def show(self):
-        buff = "\nDeck: {}".format(self.name)
-        for card in self.cards:
-            buff += "\n{} x {}".format(self.cards[card], session.query(Card).get(card).name)
-        return buff
+        return sum(self.cards.values())
 
     def __repr__(self):
         return "<Deck(name='{}')>".format(self.name)
@@ -147,4 +328,4 @@ class Emote(Base):
     user_vict_self = Column(String(128))
     others_vict_self = Column(String(128))
 
-Base.metadata.create_all(engine)
+upgrade(engine, Base.metadata)
@@ -0,0 +1,61 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from passlib.hash import pbkdf2_sha256
+
+from app import config
+
+# pbkdf2 is deliberately slow, so it runs in its own processes where it can't
+# hold up the event loop (or the GIL). The passlib functions are handed to the
+# pool directly so worker processes never have to import the app.
+executor = None
+# Caps how many hashes can be queued on the pool at once
+limiter = None
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=config.HASH_WORKERS)
+    return executor
+
+
+def get_limiter():
+    global limiter
+    if limiter is None:
+        limiter = asyncio.Semaphore(config.HASH_CONCURRENCY)
+    return limiter
+
+
+async def run(func):
+    async with get_limiter():
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(get_executor(), func)
+
+
+def hash_password(password):
+    """
+    Returns an awaitable for the hash of password, at the configured rounds.
+    """
+    return run(partial(pbkdf2_sha256.encrypt, password, rounds=config.PASSWORD_ROUNDS, salt_size=15))
+
+
+def verify_password(password, password_hash):
+    """
+    Returns an awaitable that resolves True if password matches password_hash.
+    """
+    return run(partial(pbkdf2_sha256.verify, password, password_hash))
+
+
+def needs_rehash(password_hash):
+    """
+    True if password_hash was made with a different number of rounds to the
+    ones currently configured.
+    """
+    return pbkdf2_sha256.from_string(password_hash).rounds != config.PASSWORD_ROUNDS
+
+
+def shutdown():
+    if executor is not None:
+        executor.shutdown(wait=True)
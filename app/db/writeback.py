@@ -0,0 +1,311 @@
+import asyncio
+import time
+import traceback
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .models import session_scope
+
+DURABILITY_MODES = ('sync', 'batch', 'async')
+# Flushes a row can fail in before it is given up on
+MAX_ATTEMPTS = 5
+# Longest wait before trying again after flushes have failed, in seconds
+MAX_BACKOFF = 30.0
+
+
+def _attach(session, instance, retrying=False):
+    """
+    Puts instance in session, returning the copy of it that is there.
+    """
+    if instance in session:
+        return instance
+    key = inspect(instance).key
+    if key is not None and (retrying or key in session.identity_map):
+        # Another copy of the same row (a user signed in twice, say) is
+        # already in this batch, or a failed flush lost track of what has
+        # changed, so the row is compared with the database's copy instead
+        return session.merge(instance)
+    session.add(instance)
+    return instance
+
+
+def _snapshot(instance):
+    state = inspect(instance)
+    return state.key, {key: value for key, value in state.dict.items() if key in state.mapper.attrs}
+
+
+def _restore(instance, key, values):
+    """
+    Puts back what _snapshot() saw. A failed flush rolls back, which
+    expires the rows in it and leaves new ones with ids they never got.
+    """
+    state = inspect(instance)
+    for attr in [attr for attr in state.dict if attr in state.mapper.attrs and attr not in values]:
+        del state.dict[attr]
+    for attr, value in values.items():
+        set_committed_value(instance, attr, value)
+    if key is None and state.key is not None:
+        make_transient(instance)
+
+
+def _flush(saved, deleted, retrying=frozenset()):
+    before = [(instance,) + _snapshot(instance) for instance in saved + deleted]
+    try:
+        with session_scope() as session:
+            for instance in saved:
+                _attach(session, instance, instance in retrying)
+            for instance in deleted:
+                session.delete(_attach(session, instance, instance in retrying))
+    except Exception:
+        # The rows are kept as they were, to be written again
+        for args in before:
+            _restore(*args)
+        raise
+
+
+class WriteBehind(object):
+    """
+    Collects changed, new and deleted rows and writes them all in one
+    transaction on the db executor, at most once every `interval` seconds.
+    Saving the same row again before it is written costs nothing.
+
+    save(), add() and delete() return a future; what it waits for depends on
+    durability:
+        sync  - the change is written straight away (together with anything
+                else saved in the same pass of the loop), and the future is
+                done once it has been committed
+        batch - the change is written with the next batch, and the future is
+                done once that has been committed
+        async - the change is written with the next batch, but the future is
+                done straight away; a crash can lose up to `interval` seconds
+                of changes
+
+    If a flush fails, its rows are queued again and tried with the next
+    batch, waiting longer after each failure, until they have failed
+    MAX_ATTEMPTS times.
+    """
+    def __init__(self, run, interval=0.5, durability='async'):
+        if durability not in DURABILITY_MODES:
+            raise ValueError("DB_DURABILITY must be one of {}".format(', '.join(DURABILITY_MODES)))
+        # run(func, *args) runs func on the db executor and returns a future
+        self.run = run
+        self.interval = interval
+        self.durability = durability
+        # Dicts rather than sets, so rows are written in the order they were saved
+        self.dirty = {}
+        self.added = {}
+        self.deleted = {}
+        # Futures waiting on the next flush
+        self.waiters = []
+        self.handle = None
+        self.flushing = None
+        # Whether the next flush should happen straight away
+        self.urgent = False
+        # Rows from failed flushes: {row: flushes failed in}
+        self.attempts = {}
+        # Flushes failed in a row, for backing off
+        self.failing = 0
+        # Metrics
+        self.flushes = 0
+        self.failures = 0
+        self.rows_dropped = 0
+        self.rows_written = 0
+        self.last_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.total_flush_time = 0.0
+
+    def __len__(self):
+        return len(self.dirty) + len(self.added) + len(self.deleted)
+
+    def save(self, *instances, durable=False):
+        """
+        Marks rows that are already in the database as changed. durable=True
+        waits for the commit, and writes straight away whatever the
+        durability mode.
+        """
+        for instance in instances:
+            self.dirty[instance] = None
+        return self.queued(durable)
+
+    def add(self, *instances, durable=False):
+        for instance in instances:
+            self.added[instance] = None
+        return self.queued(durable)
+
+    def delete(self, instance, durable=False):
+        if instance in self.added:
+            # Never written, so there is nothing to delete
+            del self.added[instance]
+            return self.queued(durable)
+        self.dirty.pop(instance, None)
+        self.deleted[instance] = None
+        return self.queued(durable)
+
+    def queued(self, durable):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if self.durability == 'async' and not durable:
+            future.set_result(None)
+        else:
+            self.waiters.append(future)
+        if self.durability == 'sync' or durable:
+            self.urgent = True
+            self.schedule(loop, 0)
+        else:
+            self.schedule(loop, self.interval)
+        return future
+
+    def schedule(self, loop, delay):
+        if self.handle is not None:
+            if delay > 0 or self.handle.when() <= loop.time():
+                return
+            # Bring a batch that is waiting forward
+            self.handle.cancel()
+        self.handle = loop.call_later(delay, self.flush)
+
+    async def settled(self):
+        """
+        Waits until no flush is in progress. The flush runs on another thread
+        and reads the same rows the event loop changes, so anything about to
+        change rows should wait on this first.
+        """
+        while self.flushing is not None:
+            await asyncio.wait([self.flushing])
+
+    def take(self):
+        dirty, added, deleted = list(self.dirty), list(self.added), list(self.deleted)
+        waiters = self.waiters
+        self.dirty, self.added, self.deleted, self.waiters = {}, {}, {}, []
+        self.urgent = False
+        return dirty, added, deleted, waiters
+
+    def retry(self, instance):
+        """
+        Counts a failed flush against instance; False if it has now failed
+        too often to try again.
+        """
+        attempts = self.attempts.pop(instance, 0) + 1
+        if attempts >= MAX_ATTEMPTS:
+            self.rows_dropped += 1
+            print("Giving up writing {!r} after {} tries.".format(instance, attempts))
+            return False
+        self.attempts[instance] = attempts
+        return True
+
+    def retrying(self, dirty, deleted):
+        if not self.attempts:
+            return frozenset()
+        return frozenset(instance for instance in dirty + deleted if instance in self.attempts)
+
+    def requeue(self, dirty, added, deleted):
+        """
+        Puts the rows of a failed flush back, ahead of anything queued since.
+        Rows saved or deleted again since are left where they now are, but
+        still count the failure, so that they are merged when next written.
+        """
+        queued = (self.dirty, self.added, self.deleted)
+
+        def retried(rows):
+            return {instance: None for instance in rows
+                    if self.retry(instance) and not any(instance in queue for queue in queued)}
+        dirty, added, deleted = retried(dirty), retried(added), retried(deleted)
+        dirty.update(self.dirty)
+        added.update(self.added)
+        deleted.update(self.deleted)
+        self.dirty, self.added, self.deleted = dirty, added, deleted
+
+    def flush(self):
+        self.handle = None
+        if self.flushing is not None:
+            # Only one flush at a time; go again once this one is done
+            return
+        if not len(self) and not self.waiters:
+            return
+        dirty, added, deleted, waiters = self.take()
+        start = time.perf_counter()
+        self.flushing = self.run(_flush, dirty + added, deleted, self.retrying(dirty, deleted))
+        self.flushing.add_done_callback(lambda f: self.flushed(f, start, dirty, added, deleted, waiters))
+
+    def flushed(self, future, start, dirty, added, deleted, waiters):
+        self.flushing = None
+        elapsed = time.perf_counter() - start
+        self.flushes += 1
+        self.last_flush_time = elapsed
+        self.max_flush_time = max(self.max_flush_time, elapsed)
+        self.total_flush_time += elapsed
+        error = future.exception()
+        if error is not None:
+            self.failures += 1
+            self.failing += 1
+            traceback.print_exception(type(error), error, error.__traceback__)
+            # Nobody may be waiting on these (async durability), so they
+            # mustn't just be dropped
+            self.requeue(dirty, added, deleted)
+        else:
+            self.failing = 0
+            self.rows_written += len(dirty) + len(added) + len(deleted)
+            if self.attempts:
+                for instance in dirty + added + deleted:
+                    self.attempts.pop(instance, None)
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if error is not None:
+                waiter.set_exception(error)
+            else:
+                waiter.set_result(None)
+        if len(self) or self.waiters:
+            loop = asyncio.get_event_loop()
+            if self.urgent:
+                delay = 0
+            elif self.failing:
+                delay = min(self.interval * 2 ** self.failing, MAX_BACKOFF)
+                if self.handle is not None:
+                    # A batch scheduled meanwhile waits for the back-off too
+                    self.handle.cancel()
+                    self.handle = None
+            else:
+                delay = self.interval
+            self.schedule(loop, delay)
+
+    async def drain(self):
+        """
+        Writes everything queued and waits until it is done, so that no
+        flush is left to report back once the event loop has closed. Used at
+        shutdown, while the loop still runs.
+        """
+        while self.flushing is not None or len(self) or self.waiters:
+            if self.flushing is None:
+                if self.handle is not None:
+                    self.handle.cancel()
+                    self.handle = None
+                self.flush()
+            await asyncio.wait([self.flushing])
+
+    def close(self, executor):
+        """
+        Writes anything still waiting, blocking until it is done. Used at
+        shutdown, when the event loop may already have stopped.
+        """
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if len(self):
+            dirty, added, deleted, waiters = self.take()
+            executor.submit(_flush, dirty + added, deleted, self.retrying(dirty, deleted)).result()
+            self.rows_written += len(dirty) + len(added) + len(deleted)
+
+    def metrics(self):
+        return {
+            'queue_depth': len(self),
+            'waiters': len(self.waiters),
+            'flushes': self.flushes,
+            'failures': self.failures,
+            'rows_dropped': self.rows_dropped,
+            'rows_written': self.rows_written,
+            'last_flush_ms': self.last_flush_time * 1000,
+            'max_flush_ms': self.max_flush_time * 1000,
+            'mean_flush_ms': self.total_flush_time / self.flushes * 1000 if self.flushes else 0.0
+        }
@@ -0,0 +1,273 @@
+"""
+Counts and latency histograms for commands, the database time they wait on,
+and how late the event loop runs callbacks. Shown by the admin 'stats'
+command, and served in the Prometheus text format if METRICS_PORT is set.
+"""
+import asyncio
+import bisect
+import contextvars
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# The command being run by the current task, so that database work can be
+# charged to it
+current = contextvars.ContextVar('command', default=None)
+
+SlowCommand = namedtuple('SlowCommand', 'time user command args seconds db_seconds')
+
+
+class Histogram(object):
+    """
+    Counts of observations falling in each bucket, as Prometheus keeps them.
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # The last count is for anything over the largest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """
+        Estimates the q quantile, assuming observations are spread evenly
+        through their bucket.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.bounds, self.counts):
+            if count and seen + count >= rank:
+                return min(self.max, lower + (bound - lower) * (rank - seen) / count)
+            seen += count
+            lower = bound
+        return self.max
+
+    def cumulative(self):
+        """
+        Yields (upper bound, observations at or under it) for each bucket,
+        ending with float('inf').
+        """
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class CommandStats(object):
+    __slots__ = ('count', 'errors', 'latency', 'db_seconds', 'db_calls')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.latency = Histogram()
+        self.db_seconds = 0.0
+        self.db_calls = 0
+
+
+class Timing(object):
+    """
+    One run of a command. Database work it starts adds to db_seconds until
+    the command is done.
+    """
+    __slots__ = ('name', 'db_seconds', 'db_calls', 'open')
+
+    def __init__(self, name):
+        self.name = name
+        self.db_seconds = 0.0
+        self.db_calls = 0
+        self.open = True
+
+    def add_db(self, seconds):
+        # Work scheduled by a command but finished after it (a write-behind
+        # flush, say) isn't charged to it
+        if self.open:
+            self.db_seconds += seconds
+            self.db_calls += 1
+
+
+class Gauge(object):
+    __slots__ = ('name', 'help', 'read', 'kind')
+
+    def __init__(self, name, help, read, kind):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.kind = kind
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    def __init__(self, slow_seconds=0.1, slow_log_size=50, lag_interval=0.5):
+        self.slow_seconds = slow_seconds
+        self.lag_interval = lag_interval
+        self.commands = {}
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.slow = deque(maxlen=slow_log_size)
+        self.gauges = []
+        self.started = time.time()
+        self.loop = None
+        self.handle = None
+        self.expected = None
+
+    def reset(self):
+        self.commands = {}
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.slow.clear()
+        self.started = time.time()
+
+    def gauge(self, name, help, read, kind='gauge'):
+        """
+        Adds a value read when metrics are shown, such as the number of users
+        online. kind is 'gauge', or 'counter' for values that only go up.
+        """
+        self.gauges.append(Gauge(name, help, read, kind))
+
+    @contextmanager
+    def timed(self, name, user=None, args=None):
+        """
+        Times the command run inside the block, and logs it if it is slow.
+        args are only kept for the slow command log.
+        """
+        timing = Timing(name)
+        token = current.set(timing)
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield timing
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            timing.open = False
+            current.reset(token)
+            self.record(name, elapsed, timing, failed, user, args)
+
+    def record(self, name, elapsed, timing, failed, user=None, args=None):
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = CommandStats()
+        stats.count += 1
+        stats.errors += failed
+        stats.latency.observe(elapsed)
+        stats.db_seconds += timing.db_seconds
+        stats.db_calls += timing.db_calls
+        if elapsed >= self.slow_seconds:
+            entry = SlowCommand(time.time(), getattr(user, 'name', None), name,
+                                ' '.join(args) if args else '', elapsed, timing.db_seconds)
+            self.slow.append(entry)
+            print("Slow command: '{}' by {} took {:.1f} ms ({:.1f} ms in the database)".format(
+                ' '.join([name] + list(args or ())), entry.user, elapsed * 1000, timing.db_seconds * 1000))
+
+    def start(self, loop=None):
+        """
+        Starts sampling event loop lag: how much later than asked for a
+        callback every lag_interval seconds gets run.
+        """
+        self.loop = loop or asyncio.get_event_loop()
+        self.expected = self.loop.time() + self.lag_interval
+        self.handle = self.loop.call_at(self.expected, self.probe)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def probe(self):
+        now = self.loop.time()
+        self.loop_lag.observe(max(0.0, now - self.expected))
+        self.expected = now + self.lag_interval
+        self.handle = self.loop.call_at(self.expected, self.probe)
+
+    def exposition(self):
+        """
+        Everything, in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def header(name, help, kind):
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+        def histogram(name, values, labels=''):
+            for bound, total in values.cumulative():
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, number(bound), total))
+            labels = '{{{}}}'.format(labels.rstrip(',')) if labels else ''
+            lines.append('{}_sum{} {}'.format(name, labels, number(values.sum)))
+            lines.append('{}_count{} {}'.format(name, labels, values.count))
+
+        commands = sorted(self.commands.items())
+        header('mud_command_seconds', "Time taken to run each command.", 'histogram')
+        for name, stats in commands:
+            histogram('mud_command_seconds', stats.latency, 'command="{}",'.format(label(name)))
+        header('mud_command_errors_total', "Commands that raised an exception.", 'counter')
+        for name, stats in commands:
+            lines.append('mud_command_errors_total{{command="{}"}} {}'.format(label(name), stats.errors))
+        header('mud_command_db_seconds_total', "Time commands spent waiting on the database.", 'counter')
+        for name, stats in commands:
+            lines.append('mud_command_db_seconds_total{{command="{}"}} {}'.format(label(name), number(stats.db_seconds)))
+        header('mud_event_loop_lag_seconds', "How late the event loop ran a periodic callback.", 'histogram')
+        histogram('mud_event_loop_lag_seconds', self.loop_lag)
+        for gauge in self.gauges:
+            header(gauge.name, gauge.help, gauge.kind)
+            lines.append('{} {}'.format(gauge.name, number(gauge.read())))
+        return '\n'.join(lines) + '\n'
+
+    async def handle_request(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            # Headers aren't needed, but are read so the client sees a clean close
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+        except (asyncio.TimeoutError, ConnectionError, asyncio.LimitOverrunError, ValueError):
+            writer.close()
+            return
+        parts = request.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/', '/metrics'):
+            status, body = '200 OK', self.exposition()
+        else:
+            status, body = '404 Not Found', 'Not found\n'
+        body = body.encode()
+        writer.write("HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     "Content-Length: {}\r\nConnection: close\r\n\r\n".format(status, len(body)).encode() + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    def serve(self, host, port):
+        """
+        Returns a coroutine that starts serving exposition() over HTTP.
+        """
+        return asyncio.start_server(self.handle_request, host=host, port=port)
@@ -0,0 +1,235 @@
+"""
+Publish/subscribe for everything sent to more than one user. Users are
+subscribed to topics (the server, their room, their table and themselves)
+as they sign in, move and sit down, and a message published to a topic goes
+to its subscribers only, so sending costs as much as the audience is big.
+
+A Bus on its own delivers within this process. Buses in several processes
+share topics through a broker: each bus has at most one upstream (the bus
+it shares through) and any number of peers (buses sharing through it), and
+passes on subscriptions and messages to them. In sharded mode the front
+door's bus is the broker for the shards'. Separate servers can share one
+over a local socket: one of them serves it (BUS_BROKER) and the rest
+connect to it (BUS_SOCKET).
+
+Server, room and table topics are global: a room or table name means the
+same place to every bus sharing through a broker, so rooms of the same name
+on linked servers share what is said in them. User ids only mean something
+within one database, so user topics, and the users a message is kept from,
+are qualified by the bus's namespace (see namespace()).
+
+Between processes a bus sends ('subscribe', topic), ('unsubscribe', topic)
+and ('publish', topic, msg, channel, exclude) to peer.send(*message), with
+exclude a list of [namespace, user id] pairs.
+"""
+import asyncio
+import json
+import os
+import traceback
+import zlib
+
+from .telnet import Payload
+
+SERVER = 'server'
+
+
+def room_topic(room):
+    return 'room:' + room.name.lower()
+
+
+def table_topic(table):
+    return 'table:{}/{}'.format(table.room.name.lower(), table.name.lower())
+
+
+def namespace(url):
+    """
+    Names the database at the SQLAlchemy url the same way in every process
+    using it, and differently from any other database.
+    """
+    database = url.database or ''
+    if url.get_backend_name() == 'sqlite' and database and database != ':memory:':
+        database = os.path.abspath(database)
+    where = '{}://{}:{}/{}'.format(url.get_backend_name(), url.host or '', url.port or '', database)
+    return '{:08x}'.format(zlib.crc32(where.encode()))
+
+
+class Bus(object):
+    def __init__(self, namespace=''):
+        # Which database the user ids of this bus's users are from
+        self.namespace = namespace
+        # topic: {user: None}, users subscribed here
+        self.topics = {}
+        # user: {topic, ...}, so a user can be dropped from everything at once
+        self.subscriptions = {}
+        # topic: {peer, ...}, buses that share the topic through this one
+        self.peers = {}
+        self.upstream = None
+
+    def __len__(self):
+        return len(self.topics)
+
+    def user_topic(self, user_id):
+        return 'user:{}/{}'.format(self.namespace, user_id)
+
+    def subscribe(self, topic, user):
+        subscribers = self.topics.get(topic)
+        if subscribers is None:
+            subscribers = self.topics[topic] = {}
+            if topic not in self.peers:
+                self.share(topic)
+        subscribers[user] = None
+        self.subscriptions.setdefault(user, set()).add(topic)
+
+    def unsubscribe(self, topic, user):
+        subscribers = self.topics.get(topic)
+        if subscribers is None or user not in subscribers:
+            return
+        del subscribers[user]
+        topics = self.subscriptions[user]
+        topics.discard(topic)
+        if not topics:
+            del self.subscriptions[user]
+        if not subscribers:
+            del self.topics[topic]
+            if topic not in self.peers:
+                self.unshare(topic)
+
+    def drop(self, user):
+        """
+        Unsubscribes user from every topic.
+        """
+        for topic in list(self.subscriptions.get(user, ())):
+            self.unsubscribe(topic, user)
+
+    def share(self, topic):
+        # Someone here is interested now, so the broker has to send it on
+        if self.upstream is not None:
+            self.upstream.send('subscribe', topic)
+
+    def unshare(self, topic):
+        if self.upstream is not None:
+            self.upstream.send('unsubscribe', topic)
+
+    def publish(self, topic, msg, channel=None, exclude=()):
+        """
+        Sends msg to topic's subscribers, here and in other processes. With
+        channel, only to those listening to that channel key; never to the
+        users whose ids are in exclude.
+        """
+        self.route(topic, msg, channel, [[self.namespace, user_id] for user_id in exclude])
+
+    def route(self, topic, msg, channel, exclude, source=None):
+        # Delivers here, and passes on to every bus but the one it came from
+        self.deliver(topic, msg, channel, exclude)
+        for peer in self.peers.get(topic, ()):
+            if peer is not source:
+                peer.send('publish', topic, msg, channel, exclude)
+        if self.upstream is not None and self.upstream is not source:
+            self.upstream.send('publish', topic, msg, channel, exclude)
+
+    def deliver(self, topic, msg, channel, exclude):
+        subscribers = self.topics.get(topic)
+        if not subscribers:
+            return
+        payload = Payload(msg)
+        exclude = {user_id for namespace, user_id in exclude if namespace == self.namespace}
+        for user in subscribers:
+            if user.db.id in exclude or (channel is not None and channel not in user.db.listening):
+                continue
+            user.send(payload)
+
+    def receive(self, peer, kind, *args):
+        """
+        Handles a message from a peer or the upstream bus.
+        """
+        if kind == 'publish':
+            self.route(*args, source=peer)
+        elif kind == 'subscribe':
+            topic, = args
+            peers = self.peers.setdefault(topic, set())
+            if not peers and topic not in self.topics:
+                self.share(topic)
+            peers.add(peer)
+        elif kind == 'unsubscribe':
+            topic, = args
+            peers = self.peers.get(topic)
+            if peers is None:
+                return
+            peers.discard(peer)
+            if not peers:
+                del self.peers[topic]
+                if topic not in self.topics:
+                    self.unshare(topic)
+
+    def lost(self, peer):
+        """
+        Forgets a peer, or the upstream bus, that has gone.
+        """
+        if peer is self.upstream:
+            print("Lost the message broker; messages now stay in this process.")
+            self.upstream = None
+            return
+        for topic in [topic for topic, peers in self.peers.items() if peer in peers]:
+            self.receive(peer, 'unsubscribe', topic)
+
+    def link(self, upstream):
+        """
+        Starts sharing topics through upstream.
+        """
+        self.upstream = upstream
+        for topic in set(self.topics) | set(self.peers):
+            self.share(topic)
+
+
+class StreamPeer(object):
+    """
+    A bus at the other end of a broker socket, in JSON lines.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, *message):
+        if not self.writer.is_closing():
+            self.writer.write(json.dumps(message).encode() + b'\n')
+
+    async def serve(self, bus):
+        """
+        Passes what comes in to bus until the other end goes.
+        """
+        while True:
+            try:
+                line = await self.reader.readline()
+            except (ConnectionError, ValueError):
+                break
+            if not line:
+                break
+            try:
+                bus.receive(self, *json.loads(line))
+            except Exception:
+                traceback.print_exc()
+        bus.lost(self)
+        self.writer.close()
+
+
+async def serve(bus, path):
+    """
+    Serves bus as the broker on a Unix socket at path.
+    """
+    if os.path.exists(path):
+        # Left over from a broker that is no longer running
+        os.unlink(path)
+
+    async def accept(reader, writer):
+        await StreamPeer(reader, writer).serve(bus)
+    return await asyncio.start_unix_server(accept, path=path, limit=1048576)
+
+
+async def connect(bus, path):
+    """
+    Shares bus's topics through the broker at path.
+    """
+    reader, writer = await asyncio.open_unix_connection(path, limit=1048576)
+    peer = StreamPeer(reader, writer)
+    bus.link(peer)
+    return asyncio.ensure_future(peer.serve(bus))
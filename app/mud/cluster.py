@@ -0,0 +1,701 @@
+"""
+Sharded mode, so the server can use more than one core: a front door
+process and SHARDS worker processes (shards).
+
+The front door takes every client connection, signs users in, and keeps
+the directory of who is online and where. Rooms, and the tables in them,
+are shared out between the shards by name (see owner()). A signed in
+user's lines are forwarded to the shard that owns their room, which runs
+their commands just as a single server would and sends the output back.
+Going to a room on another shard hands the session over to that shard,
+which reads the user back from the database.
+
+Shards know about users on other shards through RemoteUser stand-ins, kept
+up to date by the front door, for 'who', whispers and the like. Messages
+travel on the bus (see app.mud.bus), for which the front door is the
+broker: a chat line goes once to each shard with someone listening, and
+each shard sends it on to its own users.
+
+Processes talk over a Unix socket in a private directory (or a local TCP
+port where there are no Unix sockets), in length-prefixed pickled tuples,
+('kind', *args), handled by the receiving end's on_kind(*args).
+"""
+import asyncio
+import hmac
+import itertools
+import multiprocessing
+import os
+import pickle
+import secrets
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import traceback
+import zlib
+from types import SimpleNamespace
+
+from app import config, db, server
+from .telnet import Payload
+from .user import User
+
+HEADER = struct.Struct('!I')
+TOKEN_BYTES = 16
+
+
+def owner(room_name, count):
+    """
+    The index of the shard that runs the room called room_name.
+    """
+    return zlib.crc32(room_name.lower().encode()) % count
+
+
+def done():
+    future = asyncio.get_event_loop().create_future()
+    future.set_result(None)
+    return future
+
+
+def spawn(coroutine):
+    """
+    Runs a message handler that has to wait, logging what it raises.
+    """
+    async def run():
+        try:
+            await coroutine
+        except Exception:
+            traceback.print_exc()
+    return asyncio.ensure_future(run())
+
+
+class Link(object):
+    """
+    One end of the connection between the front door and a shard.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.index = None
+
+    def send(self, *message):
+        if self.writer.is_closing():
+            return
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        self.writer.write(HEADER.pack(len(data)) + data)
+
+    async def receive(self):
+        """
+        The next message, or None once the other end has gone.
+        """
+        try:
+            size, = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+            return pickle.loads(await self.reader.readexactly(size))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    async def serve(self, handle):
+        """
+        Passes each message to handle until the other end goes.
+        """
+        while True:
+            message = await self.receive()
+            if message is None:
+                return
+            try:
+                handle(message)
+            except Exception:
+                traceback.print_exc()
+
+    def close(self):
+        if not self.writer.is_closing() and self.writer.can_write_eof():
+            # Processes forked from this one (the password hashing pool) have
+            # copies of the socket, so it takes a shutdown for the other end
+            # to see it closed
+            self.writer.write_eof()
+        self.writer.close()
+
+
+def dispatch(handler, message, *args):
+    getattr(handler, 'on_' + message[0])(*args, *message[1:])
+
+
+class FrontDoor(object):
+    """
+    The front door's part: it holds the client connections and runs the
+    'login' command, and forwards everything else to the shards.
+    """
+    def __init__(self, count):
+        self.count = count
+        self.links = [None] * count
+        self.processes = []
+        # Client sessions on the shards, by the id they are known by there
+        self.sessions = {}
+        self.ids = itertools.count(1)
+        # Lines for sessions on their way to a shard: session id: [line, ...]
+        self.attaching = {}
+        self.listener = None
+        self.directory = None
+        self.stopping = False
+        self.token = secrets.token_hex(TOKEN_BYTES)
+        self.ready = asyncio.get_event_loop().create_future()
+
+    async def listen(self):
+        if hasattr(socket, 'AF_UNIX'):
+            # Only this user can get at a socket in a directory from mkdtemp
+            self.directory = tempfile.mkdtemp(prefix='mud-', dir=config.SHARD_SOCKET_DIR)
+            address = os.path.join(self.directory, 'shards.sock')
+            self.listener = await asyncio.start_unix_server(self.accept, path=address)
+        else:
+            self.listener = await asyncio.start_server(self.accept, host='127.0.0.1', port=0)
+            address = self.listener.sockets[0].getsockname()[:2]
+        return address
+
+    def spawn_shards(self, address):
+        # Shards start from a clean interpreter, whatever the platform
+        context = multiprocessing.get_context('spawn')
+        for index in range(self.count):
+            process = context.Process(target=run_shard, args=(index, self.count, address, self.token),
+                                      name='shard-{}'.format(index), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    async def accept(self, reader, writer):
+        try:
+            # Nothing is unpickled before the shard has shown it was started by us
+            token = await asyncio.wait_for(reader.readexactly(len(self.token)), 10)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        if not hmac.compare_digest(token, self.token.encode()):
+            print("Refused a shard connection with the wrong token.")
+            writer.close()
+            return
+        link = Link(reader, writer)
+        message = await link.receive()
+        if message is None or message[0] != 'hello' or self.links[message[1]] is not None:
+            link.close()
+            return
+        link.index = message[1]
+        self.links[link.index] = link
+        print("Shard {} is up.".format(link.index))
+        if all(self.links) and not self.ready.done():
+            self.ready.set_result(None)
+        await link.serve(lambda message: dispatch(self, message, link))
+        self.lost(link)
+
+    def lost(self, link):
+        if self.links[link.index] is link:
+            self.links[link.index] = None
+        if self.stopping:
+            return
+        print("Lost shard {}!".format(link.index))
+        server.bus.lost(link)
+        for user in list(self.sessions.values()):
+            if user.shard == link.index:
+                user.shard = None
+                user.send_to_self("&RThe part of the realm you were in has gone away. Please sign in again.&x")
+                user.close()
+
+    async def stop(self):
+        self.stopping = True
+        if self.listener is not None:
+            self.listener.close()
+        for link in self.links:
+            if link is not None:
+                link.close()
+        # Shards exit once their link is closed
+        for process in self.processes:
+            await asyncio.get_event_loop().run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.terminate()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def send(self, index, *message):
+        link = self.links[index]
+        if link is not None:
+            link.send(*message)
+
+    def broadcast(self, *message):
+        for link in self.links:
+            if link is not None:
+                link.send(*message)
+
+    def present(self, user):
+        """
+        Tells the shards where user is, and who runs them.
+        """
+        self.broadcast('presence', user.db.id, user.session, user.name, user.room.name, user.shard,
+                       dict(user.flags), user.db.listening)
+
+    def place(self, user, room):
+        # Keeps the directory's rooms up to date, without moving anyone
+        if user.room is not None:
+            user.room.leave(user)
+        user.room = room
+        if room is not None:
+            room.enter(user)
+
+    # Called by Mud and User
+
+    def admits(self, user, room):
+        return True
+
+    def moved(self, user, room):
+        """
+        Sends user to the shard that runs room.
+        """
+        if user.shard is not None:
+            if user.session in self.attaching:
+                del self.attaching[user.session]
+            else:
+                self.send(user.shard, 'detach', user.session)
+            user.shard = None
+        if room is None:
+            self.sessions.pop(user.session, None)
+            self.broadcast('absent', user.db.id, user.session)
+            return
+        if user.session is None:
+            user.session = next(self.ids)
+            self.sessions[user.session] = user
+        user.shard = owner(room.name, self.count)
+        spawn(self.attach(user, room, self.attaching.setdefault(user.session, [])))
+        self.present(user)
+
+    async def attach(self, user, room, lines):
+        # Anything saved here (a new password hash, the ADMIN flag) has to be
+        # written before the shard reads the user back
+        await db.save(durable=True)
+        if self.attaching.get(user.session) is not lines:
+            # Gone, or sent somewhere else, in the meantime
+            return
+        del self.attaching[user.session]
+        self.send(user.shard, 'attach', user.session, user.db.id, user.name, room.name,
+                  dict(user.flags), user.addr, lines)
+
+    def forward(self, user, line):
+        lines = self.attaching.get(user.session)
+        if lines is not None:
+            lines.append(line)
+        else:
+            self.send(user.shard, 'line', user.session, line)
+
+    def saving(self, user):
+        # Once a user is on a shard, the shard has their up to date state
+        return user.shard is None
+
+    def runs(self, user):
+        return user.shard is None
+
+    # Messages from the shards
+
+    def on_output(self, link, session, data):
+        user = self.sessions.get(session)
+        if user is not None:
+            user.output.write(data)
+
+    def on_close(self, link, session):
+        user = self.sessions.get(session)
+        if user is not None:
+            user.close()
+
+    def on_moved(self, link, session, room_name):
+        user = self.sessions.get(session)
+        if user is None:
+            return
+        # The shard has subscribed them, so their messages come from there now
+        server.bus.drop(user)
+        room = server.get_room(room_name)
+        if room is None or user.room is room:
+            return
+        self.place(user, room)
+        self.present(user)
+
+    def on_migrate(self, link, session, room_name, lines):
+        user = self.sessions.get(session)
+        if user is None or user.transport.is_closing():
+            return
+        # The shard has let the session go
+        user.shard = None
+        # The blank line has the next shard show the user where they are
+        self.attaching[session] = [''] + lines
+        server.move(user, server.get_room(room_name) or server.get_room(config.LOBBY_ROOM_NAME))
+
+    def on_bounce(self, link, session, line):
+        # A line that reached a shard after the session had left it
+        user = self.sessions.get(session)
+        if user is not None and user.shard is not None:
+            self.forward(user, line)
+
+    def on_kick(self, link, user_id):
+        user = server.users.get_by_id(user_id)
+        if user is not None:
+            user.close()
+
+    def on_flags(self, link, user_id, flags):
+        # Set by an admin on another shard
+        user = server.users.get_by_id(user_id)
+        if user is None:
+            return
+        user.flags.update(flags)
+        if user.shard is None:
+            user.save()
+        elif user.session not in self.attaching:
+            self.send(user.shard, 'flags', user.session, flags)
+        self.present(user)
+
+    def on_state(self, link, session, flags, listening):
+        user = self.sessions.get(session)
+        if user is None or (user.flags == flags and user.db.listening == listening):
+            return
+        spawn(self.update_state(user, flags, listening))
+
+    async def update_state(self, user, flags, listening):
+        # user.db is a row, which mustn't change mid-flush
+        await db.writer.settled()
+        user.flags = flags
+        user.colour = flags.get('colour', True)
+        user.db.listening = listening
+        self.present(user)
+
+    def on_subscribe(self, link, topic):
+        server.bus.receive(link, 'subscribe', topic)
+
+    def on_unsubscribe(self, link, topic):
+        server.bus.receive(link, 'unsubscribe', topic)
+
+    def on_publish(self, link, *args):
+        server.bus.receive(link, 'publish', *args)
+
+    def on_room(self, link, room_name):
+        async def add():
+            await server.add_room(room_name)
+            for other in self.links:
+                if other is not None and other is not link:
+                    other.send('room', room_name)
+        spawn(add())
+
+    def on_unroom(self, link, room_name):
+        room = server.get_room(room_name)
+        if room is not None:
+            server.remove_room(room)
+        for other in self.links:
+            if other is not None and other is not link:
+                other.send('unroom', room_name)
+
+
+class ProxyTransport(object):
+    """
+    A client's connection as a shard sees it: what is written goes to the
+    front door, which writes it to the client.
+    """
+    def __init__(self, link, session, peer):
+        self.link = link
+        self.session = session
+        self.peer = peer
+        self.closing = False
+
+    def write(self, data):
+        if not self.closing:
+            self.link.send('output', self.session, bytes(data))
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self.link.send('close', self.session)
+
+    abort = close
+
+    def detach(self):
+        """
+        Stops sending anything, leaving the connection open.
+        """
+        self.closing = True
+
+    def is_closing(self):
+        return self.closing
+
+    def get_extra_info(self, name, default=None):
+        return self.peer if name == 'peername' else default
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        # The front door holds back output for clients that aren't reading
+        pass
+
+
+class RemoteUser(object):
+    """
+    A user on another shard, as far as this shard needs to know them.
+    """
+    def __init__(self, link, user_id, session):
+        self.link = link
+        self.session = session
+        self.name = None
+        self.db = SimpleNamespace(id=user_id, listening='')
+        self.flags = {}
+        self.authd = True
+        self.room = None
+        self.table = None
+
+    def send(self, payload):
+        server.bus.publish(server.bus.user_topic(self.db.id), payload.msg)
+
+    def send_to_self(self, msg):
+        self.send(Payload(msg))
+
+    def save(self, durable=False):
+        # Their shard writes them; it is sent the flags, which are all a
+        # command can change on another user
+        self.link.send('flags', self.db.id, dict(self.flags))
+        return done()
+
+    def close(self):
+        self.link.send('kick', self.db.id)
+
+    def is_admin(self):
+        return self.flags['admin']
+
+    def is_muted(self):
+        return self.flags['muted']
+
+    def is_frozen(self):
+        return self.flags['frozen']
+
+    def is_banned(self):
+        return self.flags['banned']
+
+    def can_spectate(self):
+        return self.flags['allow_spec']
+
+
+class Shard(object):
+    """
+    A shard's part: it runs the users in the rooms it owns, and keeps
+    RemoteUsers for everyone else.
+    """
+    def __init__(self, link, index, count):
+        self.link = link
+        self.index = index
+        self.count = count
+        # Sessions being run here, by id
+        self.sessions = {}
+        # Lines for sessions still being loaded: session id: [line, ...]
+        self.starting = {}
+        # user id: RemoteUser
+        self.remote = {}
+
+    def owns(self, room):
+        return owner(room.name, self.count) == self.index
+
+    def handle(self, message):
+        dispatch(self, message)
+
+    def forget(self, user_id, session=None):
+        remote = self.remote.get(user_id)
+        if remote is None or (session is not None and remote.session != session):
+            return
+        del self.remote[user_id]
+        if remote.room is not None:
+            remote.room.leave(remote)
+        server.users.remove(remote)
+
+    def hand_over(self, user, room):
+        """
+        Lets the session go to the shard that owns room.
+        """
+        del self.sessions[user.session]
+        # Anything more is for the next shard to say
+        user.output.flush()
+        user.transport.detach()
+        lines = []
+        while not user.commands.empty():
+            lines.append(user.commands.get_nowait())
+            user.commands.task_done()
+        spawn(self.migrate(user, room.name, lines))
+
+    async def migrate(self, user, room_name, lines):
+        # Let the line being handled (the 'goto', say) finish
+        await user.commands.join()
+        user.connection_lost(None)
+        # Still online as far as this shard's concerned, until the front door says where
+        self.on_presence(user.db.id, user.session, user.name, room_name, owner(room_name, self.count),
+                         user.flags, user.db.listening)
+        # The next shard reads the user back from the database
+        await db.save(durable=True)
+        self.link.send('migrate', user.session, room_name, lines)
+
+    async def stop(self):
+        """
+        Lets go of the sessions run here once the front door has gone, as if
+        it had detached each of them, and waits for their command workers.
+        """
+        workers = []
+        for session, user in list(self.sessions.items()):
+            workers.append(user.worker)
+            self.on_detach(session)
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    # Called by Mud and User
+
+    def admits(self, user, room):
+        if room is None or self.owns(room) or user.session not in self.sessions:
+            return True
+        self.hand_over(user, room)
+        return False
+
+    def moved(self, user, room):
+        if room is not None and user.session in self.sessions:
+            self.link.send('moved', user.session, room.name)
+
+    def saving(self, user):
+        # Keeps the front door's copy, which it tells other shards about, current
+        if user.session is not None:
+            self.link.send('state', user.session, dict(user.flags), user.db.listening)
+        return True
+
+    def runs(self, user):
+        return not isinstance(user, RemoteUser)
+
+    def room_added(self, room):
+        self.link.send('room', room.name)
+
+    def room_removed(self, room):
+        self.link.send('unroom', room.name)
+
+    # Messages from the front door
+
+    def on_attach(self, session, user_id, name, room_name, flags, peer, lines):
+        self.starting[session] = list(lines)
+        spawn(self.attach(session, user_id, name, room_name, flags, peer))
+
+    async def attach(self, session, user_id, name, room_name, flags, peer):
+        dbUser = await db.run(db.models.User.by_name, name)
+        lines = self.starting.pop(session, None)
+        if lines is None:
+            # Signed off while being loaded
+            return
+        transport = ProxyTransport(self.link, session, peer)
+        if dbUser is None:
+            transport.close()
+            return
+        self.forget(user_id)
+        user = User()
+        user.open(transport)
+        user.session = session
+        user.attach(dbUser)
+        # The front door's flags are the latest, whatever has been written
+        user.flags = flags
+        user.colour = flags.get('colour', True)
+        self.sessions[session] = user
+        server.move(user, server.get_room(room_name) or server.get_room(config.LOBBY_ROOM_NAME))
+        for line in lines:
+            user.commands.put_nowait(line)
+
+    def on_line(self, session, line):
+        user = self.sessions.get(session)
+        if user is not None:
+            user.commands.put_nowait(line)
+        elif session in self.starting:
+            self.starting[session].append(line)
+        else:
+            self.link.send('bounce', session, line)
+
+    def on_detach(self, session):
+        if self.starting.pop(session, None) is not None:
+            return
+        user = self.sessions.pop(session, None)
+        if user is not None:
+            user.transport.detach()
+            user.connection_lost(None)
+
+    def on_flags(self, session, flags):
+        user = self.sessions.get(session)
+        if user is not None:
+            user.flags.update(flags)
+            user.save()
+
+    def on_presence(self, user_id, session, name, room_name, index, flags, listening):
+        if index == self.index:
+            # Run here
+            self.forget(user_id)
+            return
+        remote = self.remote.get(user_id)
+        if remote is None or remote.session != session:
+            self.forget(user_id)
+            remote = self.remote[user_id] = RemoteUser(self.link, user_id, session)
+        remote.name = name
+        remote.flags = flags
+        remote.db.listening = listening
+        room = server.get_room(room_name)
+        if remote.room is not room:
+            if remote.room is not None:
+                remote.room.leave(remote)
+            remote.room = room
+            if room is not None:
+                room.enter(remote)
+        server.users.add(remote)
+
+    def on_absent(self, user_id, session):
+        self.forget(user_id, session)
+
+    def on_publish(self, *args):
+        server.bus.receive(self.link, 'publish', *args)
+
+    def on_room(self, room_name):
+        spawn(server.add_room(room_name))
+
+    def on_unroom(self, room_name):
+        room = server.get_room(room_name)
+        if room is not None:
+            server.remove_room(room)
+
+
+async def start(count):
+    """
+    Starts count shards and waits for them to be ready, making this process
+    the front door.
+    """
+    front = FrontDoor(count)
+    address = await front.listen()
+    print("Starting {} shards...".format(count))
+    front.spawn_shards(address)
+    try:
+        await asyncio.wait_for(asyncio.shield(front.ready), config.SHARD_START_TIMEOUT)
+    except asyncio.TimeoutError:
+        await front.stop()
+        raise RuntimeError("Shards didn't start within {} seconds".format(config.SHARD_START_TIMEOUT))
+    server.cluster = front
+    return front
+
+
+async def connect(address, token):
+    if isinstance(address, str):
+        reader, writer = await asyncio.open_unix_connection(address)
+    else:
+        reader, writer = await asyncio.open_connection(*address)
+    writer.write(token.encode())
+    return Link(reader, writer)
+
+
+def run_shard(index, count, address, token):
+    """
+    A shard process. By the time this runs, importing app has loaded the
+    rooms, cards and everything else.
+    """
+    # The front door decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.get_event_loop()
+    link = loop.run_until_complete(connect(address, token))
+    server.cluster = Shard(link, index, count)
+    # Whatever BUS_SOCKET says, shards share the bus through the front door
+    server.bus.link(link)
+    server.metrics.start(loop)
+    link.send('hello', index)
+    loop.run_until_complete(link.serve(server.cluster.handle))
+    loop.run_until_complete(server.cluster.stop())
+    loop.run_until_complete(server.shutdown())
+    server.metrics.stop()
+    loop.close()
+    db.shutdown()
+    db.passwords.shutdown()
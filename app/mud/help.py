@@ -0,0 +1,109 @@
+import os
+import re
+
+from app.style import strip_colours
+from .telnet import Payload
+
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+class HelpTopic(object):
+    __slots__ = ('name', 'mtime', 'payload', 'words')
+
+    def __init__(self, name, mtime, text):
+        self.name = name
+        self.mtime = mtime
+        self.payload = Payload(text)
+        # Render and encode both versions now, rather than on first use
+        self.payload.encoded(True)
+        self.payload.encoded(False)
+        self.words = set(WORD_PATTERN.findall(strip_colours(text).lower()))
+
+
+class HelpIndex(object):
+    """
+    Every help file held in memory, ready encoded, with an index of the words
+    in them for 'help search'. refresh() picks up files that have been added,
+    changed or removed since they were loaded.
+    """
+    def __init__(self, path, default='help'):
+        self.path = path
+        self.default = default
+        # topic name: HelpTopic
+        self.topics = {}
+        # word: set(topic names)
+        self.words = {}
+
+    def __len__(self):
+        return len(self.topics)
+
+    def __contains__(self, name):
+        return name in self.topics
+
+    def refresh(self):
+        """
+        Loads any help file that is new or has changed on disk, and forgets
+        any that have gone. Returns the number of topics (re)loaded.
+        """
+        seen = set()
+        loaded = 0
+        for entry in os.scandir(self.path):
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            name = entry.name.lower()
+            seen.add(name)
+            mtime = entry.stat().st_mtime
+            topic = self.topics.get(name)
+            if topic is not None and topic.mtime == mtime:
+                continue
+            with open(entry.path, 'r', encoding='utf-8') as f:
+                self.add(HelpTopic(name, mtime, f.read()))
+            loaded += 1
+        for name in set(self.topics) - seen:
+            self.remove(name)
+        return loaded
+
+    def add(self, topic):
+        self.remove(topic.name)
+        self.topics[topic.name] = topic
+        for word in topic.words:
+            self.words.setdefault(word, set()).add(topic.name)
+
+    def remove(self, name):
+        topic = self.topics.pop(name, None)
+        if topic is None:
+            return
+        for word in topic.words:
+            names = self.words[word]
+            names.discard(name)
+            if not names:
+                del self.words[word]
+
+    def get(self, name):
+        return self.topics.get(name)
+
+    def find(self, words):
+        """
+        Returns the topics words could mean. Each word may be cut short, so
+        'tab dr' finds 'table draw'; an exact name always wins.
+        """
+        words = [word.lower() for word in words]
+        topic = self.topics.get(' '.join(words))
+        if topic is not None:
+            return [topic]
+        found = []
+        for name, topic in sorted(self.topics.items()):
+            parts = name.split()
+            if len(parts) == len(words) and all(part.startswith(word) for part, word in zip(parts, words)):
+                found.append(topic)
+        return found
+
+    def search(self, words):
+        """
+        Returns the names of the topics containing every one of words.
+        """
+        names = None
+        for word in words:
+            matches = self.words.get(word.lower(), set())
+            names = matches if names is None else names & matches
+        return sorted(names or ())
@@ -1,4 +1,5 @@
-from itertools import zip_longest
+from collections import deque
+from itertools import count, zip_longest
 from random import shuffle
 
 from app import db, style
@@ -10,8 +11,8 @@ class Room(object):
         self.description = None
         self.db = None
 
-        self.occupants = []
-        self.tables = []
+        # Used as an ordered set of users
+        self.occupants = {}
 
     @staticmethod
     def load(db_room):
@@ -21,15 +22,22 @@ class Room(object):
         room.db = db_room
         return room
 
+    def enter(self, user):
+        self.occupants[user] = None
+
+    def leave(self, user):
+        self.occupants.pop(user, None)
+
     def save(self):
-        self.db.room.name = self.name
+        self.db.name = self.name
         self.db.description = self.description
-        db.session.commit()
+        return db.save(self.db)
 
 
 class Table(object):
     def __init__(self, user, name):
         self.owner = user
+        self.room = user.room
         self.name = name
         self.start_time = 0
         self.battlefields = {}
@@ -40,18 +48,43 @@ class Table(object):
         self.life_totals = {}
         self.poison_counters = {}
         self.users = []
+        # Timer handles, cancelled when the table closes
+        self.timers = []
+        # Each player's rendered lines, dropped by changed() when something
+        # they show is altered; show() only re-renders what has been dropped
+        self.stats_lines = {}
+        self.card_lines = {}
+        self.rows = None
+        # The rows each delta mode viewer was last sent
+        self.frames = {}
+
+    def close(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers.clear()
 
     def round_timer(self):
         for user in self.users:
             user.send_to_self("&W[&x&gtable&x&W]&x &g50 minutes has elapsed.&w\r\n")
 
+    def changed(self, user, cards=False):
+        """
+        Marks user's part of the table as needing to be rendered again:
+        their stats line, and their cards as well if cards is True.
+        """
+        self.stats_lines.pop(user, None)
+        if cards:
+            self.card_lines.pop(user, None)
+        self.rows = None
+
     def join(self, user):
+        self.changed(user, cards=True)
         self.users.append(user)
-        self.battlefields[user] = []
-        self.graveyards[user] = []
-        self.exiles[user] = []
-        self.libraries[user] = []
-        self.hands[user] = []
+        self.battlefields[user] = Zone()
+        self.graveyards[user] = Zone()
+        self.exiles[user] = Zone()
+        self.libraries[user] = deque()
+        self.hands[user] = Zone()
         self.life_totals[user] = 20
         self.poison_counters[user] = 0
 
@@ -64,156 +97,280 @@ class Table(object):
         self.life_totals.pop(user)
         self.poison_counters.pop(user)
         self.users.remove(user)
-
-    def stack(self, user):
-        user.table.libraries[user].clear()
-        for card in user.deck.cards:
-            dbCard = db.session.query(db.models.Card).get(card)
-            for i in range(user.deck.cards[card]):
-                self.libraries[user].append(Card.load(dbCard))
+        self.changed(user, cards=True)
+        self.frames.pop(user, None)
+
+    def stack(self, user, catalog):
+        library = self.libraries[user]
+        library.clear()
+        handles = self.free_handles()
+        for card_id, copies in user.deck.cards.items():
+            # Every copy shares the one definition the catalog holds for the card
+            definition = catalog.get(card_id)
+            if definition is None:
+                continue
+            library.extend(Card(definition, user, next(handles)) for i in range(copies))
         self.life_totals[user] = 20
         self.poison_counters[user] = 0
+        self.changed(user)
+
+    def free_handles(self):
+        """
+        Yields the handles no card at the table has, lowest first. Stacking
+        again leaves cards on the battlefield and elsewhere, so handles can't
+        simply start from 0, but those of cards that have gone are reused,
+        keeping them short however long the game.
+        """
+        used = set()
+        for zones in (self.libraries, self.hands, self.battlefields, self.graveyards, self.exiles):
+            for zone in zones.values():
+                used.update(card.handle for card in zone)
+        return (handle for handle in count() if handle not in used)
 
     def shuffle(self, user):
-        shuffle(self.libraries[user])
+        # Shuffling a deque in place indexes into the middle of it, which is slow
+        cards = list(self.libraries[user])
+        shuffle(cards)
+        self.libraries[user] = deque(cards)
+
+    def take(self, user, num):
+        """
+        Removes and returns up to num cards from the top of the user's library.
+        """
+        library = self.libraries[user]
+        self.changed(user)
+        return [library.popleft() for i in range(min(int(num), len(library)))]
 
     def draw(self, user, num=1):
-        for i in range(int(num)):
-            self.hands[user].append(self.libraries[user][0])
-            self.libraries[user].pop(0)
+        cards = self.take(user, num)
+        self.hands[user].extend(cards)
+        return len(cards)
+
+    def mill(self, user, num=1):
+        cards = self.take(user, num)
+        self.graveyards[user].extend(cards)
+        return len(cards)
+
+    def render_stats(self, user):
+        poison = self.poison_counters[user]
+        return [style.table_user(user.name),
+                style.table_user_stats(self.life_totals[user], len(self.hands[user]),
+                                       len(self.libraries[user]), len(self.graveyards[user]),
+                                       poison if poison > 0 else None)]
+
+    def render_cards(self, user):
+        cards = sorted(self.battlefields[user], key=card_order)
+        width = handle_width(cards)
+        return [style.table_card(card.handle, card, width) for card in cards]
+
+    def render(self):
+        """
+        Returns the table as a list of rows, one line from each player's
+        section side by side, rendering only the sections that have changed.
+        """
+        if self.rows is not None:
+            return self.rows
+        sections = []
+        for user in self.battlefields:
+            stats = self.stats_lines.get(user)
+            if stats is None:
+                stats = self.stats_lines[user] = self.render_stats(user)
+            cards = self.card_lines.get(user)
+            if cards is None:
+                cards = self.card_lines[user] = self.render_cards(user)
+            sections.append(stats + cards)
+        self.rows = [''.join(line) for line in zip_longest(*sections, fillvalue=style.table_card_blank())]
+        return self.rows
 
     def show(self):
-        buff = style.table_header(self.name)
-        user_list = []
-        for user in self.battlefields:
-            card_list = [style.table_user(user.name),
-                         style.table_user_stats(self.life_totals[user], len(self.hands[user]),
-                                                len(self.libraries[user]), len(self.graveyards[user]),
-                                                self.poison_counters[user] if self.poison_counters[user] > 0 else None)]
-            lands_list = []
-            artifacts_list = []
-            enchantments_list = []
-            creatures_list = []
-            others_list = []
-            for card in self.battlefields[user]:
-                if 'Land' in card.types:
-                    lands_list.append(style.table_card(self.battlefields[user].index(card), card))
-                elif 'Artifact' in card.types:
-                    artifacts_list.append(style.table_card(self.battlefields[user].index(card), card))
-                elif 'Enchantment' in card.types:
-                    enchantments_list.append(style.table_card(self.battlefields[user].index(card), card))
-                elif 'Creature' in card.types:
-                    creatures_list.append(style.table_card(self.battlefields[user].index(card), card))
-                else:
-                    others_list.append(style.table_card(self.battlefields[user].index(card), card))
-            card_list += lands_list+artifacts_list+enchantments_list+creatures_list+others_list
-            user_list.append(card_list[:])
-        battlefield_list = list(zip_longest(*user_list))
-        for lines in battlefield_list:
-            for card in lines:
-                buff += "{}{}".format("\r\n" if card is lines[0] else "", style.table_card_blank() if card is None else card)
-        return buff
+        return style.table_header(self.name) + '\r\n'.join(self.render())
+
+    def show_delta(self, viewer):
+        """
+        Returns what viewer needs sent to bring the table on their screen up
+        to date: the rows that have changed since they last saw it, or the
+        whole table drawn from the top of a cleared screen, and pinned there,
+        if they haven't seen it yet or it has grown or shrunk.
+        """
+        rows = self.render()
+        frame = self.frames.get(viewer)
+        self.frames[viewer] = rows
+        if frame is None or len(frame) != len(rows):
+            return style.UNPIN + style.CLEAR_SCREEN + self.show() + style.table_pin(len(rows))
+        changes = [(i, row) for i, (old, row) in enumerate(zip(frame, rows)) if old != row]
+        return style.table_delta(changes) if changes else ""
+
+    def redraw(self, viewer):
+        self.frames.pop(viewer, None)
+        return self.show_delta(viewer)
 
     def hand(self, user):
         buff = style.header_40("Hand")
+        width = handle_width(self.hands[user])
         for card in self.hands[user]:
-            buff += style.body_40("({:2}) {:<25}".format(self.hands[user].index(card), card.name))
+            buff += style.body_40("({:{}}) {:<{}}".format(card.handle, width, card.name, 27 - width))
         buff += style.FOOTER_40
         return buff
 
     def play(self, user, card):
-        self.battlefields[user].append(card)
+        self.changed(user, cards=True)
+        self.battlefields[user].add(card)
         self.hands[user].remove(card)
 
     def discard(self, user, card):
+        self.changed(user)
         self.hands[user].remove(card)
-        self.graveyards[user].append(card)
+        self.graveyards[user].add(card)
 
     def tutor(self, user, card_name):
         for card in self.libraries[user]:
             if card.name.lower() == card_name.lower():
-                self.hands[user].append(card)
+                self.changed(user)
+                self.hands[user].add(card)
                 self.libraries[user].remove(card)
                 return True
         return False
 
     def destroy(self, user, card):
+        self.changed(user, cards=True)
         self.battlefields[user].remove(card)
-        self.graveyards[user].append(card)
+        self.graveyards[user].add(card)
 
     def return_(self, user, card):
+        self.changed(user, cards=True)
         self.battlefields[user].remove(card)
-        self.hands[user].append(card)
+        self.hands[user].add(card)
 
     def greturn(self, user, card):
+        self.changed(user)
         self.graveyards[user].remove(card)
-        self.hands[user].append(card)
+        self.hands[user].add(card)
 
     def unearth(self, user, card):
+        self.changed(user, cards=True)
         self.graveyards[user].remove(card)
-        self.battlefields[user].append(card)
+        self.battlefields[user].add(card)
 
     def exile(self, user, card):
+        self.changed(user, cards=True)
         self.battlefields[user].remove(card)
-        self.exiles[user].append(card)
+        self.exiles[user].add(card)
 
     def grexile(self, user, card):
+        self.changed(user)
         self.graveyards[user].remove(card)
-        self.exiles[user].append(card)
+        self.exiles[user].add(card)
 
     def hexile(self, user, card):
+        self.changed(user)
         self.hands[user].remove(card)
-        self.exiles[user].append(card)
+        self.exiles[user].add(card)
+
+    def tap(self, user, card):
+        card.tap()
+        self.changed(user, cards=True)
+
+    def untap(self, user, card):
+        card.untap()
+        self.changed(user, cards=True)
+
+    def tap_all(self, user, tapped=True):
+        for card in self.battlefields[user]:
+            card.tapped = tapped
+        self.changed(user, cards=True)
+
+    def adjust_life(self, user, amount):
+        self.life_totals[user] += amount
+        self.changed(user)
+        return self.life_totals[user]
 
     def scoop(self, user):
+        self.changed(user)
         self.hands[user].clear()
         self.graveyards[user].clear()
         self.exiles[user].clear()
         self.libraries[user].clear()
 
 
-class Card(object):
+# Battlefield cards are shown grouped in this order, with everything else last
+CARD_ORDER = ['Land', 'Artifact', 'Enchantment', 'Creature']
+
+
+def handle_width(cards):
+    """
+    How wide a column the cards' handles need: 3, unless one is longer.
+    """
+    return max([3] + [len(str(card.handle)) for card in cards])
+
+
+def card_order(card):
+    for i, type_ in enumerate(CARD_ORDER):
+        if type_ in (card.types or ()):
+            return i
+    return len(CARD_ORDER)
+
+
+class Zone(object):
+    """
+    An unordered pile of cards (a hand, battlefield, graveyard or exile),
+    keyed by each card's handle. Adding, removing and finding a card are all
+    O(1), and cards come back out in the order they were added.
+    """
     def __init__(self):
-        self.name = None
-        self.names = None
-        self.manaCost = None
-        self.cmc = None
-        self.colors = None
-        self.type = None
-        self.supertypes = None
-        self.types = None
-        self.subtypes = None
-        self.rarity = None
-        self.text = None
-        self.power = None
-        self.toughness = None
-        self.loyalty = None
+        self.cards = {}
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __iter__(self):
+        return iter(self.cards.values())
+
+    def __contains__(self, card):
+        return self.cards.get(card.handle) is card
+
+    def get(self, handle):
+        return self.cards.get(handle)
+
+    def add(self, card):
+        assert card.handle not in self.cards, "card handle {} is already in use".format(card.handle)
+        self.cards[card.handle] = card
+
+    def extend(self, cards):
+        for card in cards:
+            self.add(card)
 
+    def remove(self, card):
+        del self.cards[card.handle]
+
+    def clear(self):
+        self.cards.clear()
+
+
+class Card(object):
+    """
+    One copy of a card on a table. The card's details (name, types, text...)
+    are read from a CardDefinition shared by every copy of that card; only
+    the state of this copy is kept here. The handle is the number players
+    use for the card, and it keeps it wherever it moves on the table.
+    """
+    __slots__ = ('definition', 'owner', 'handle', 'tapped', 'counters')
+
+    # definition can be any object with the card attributes, so cards could be
+    # created on the fly one day... (tokens?)
+    def __init__(self, definition, owner=None, handle=None):
+        self.definition = definition
+        self.owner = owner
+        self.handle = handle
         self.tapped = False
         self.counters = 0
 
+    def __getattr__(self, attr):
+        if attr == 'definition':
+            raise AttributeError(attr)
+        return getattr(self.definition, attr)
+
     def tap(self):
         self.tapped = True
 
     def untap(self):
-        self.tapped = False
-
-    # Not done in __init__ incase we want to create cards on the fly one day... (tokens?)
-    @staticmethod
-    def load(db_card):
-        card = Card()
-        card.name = db_card.name
-        card.names = db_card.names
-        card.manaCost = db_card.manaCost
-        card.cmc = db_card.cmc
-        card.colors = db_card.colors
-        card.type = db_card.type
-        card.supertypes = db_card.supertypes
-        card.types = db_card.types
-        card.subtypes = db_card.subtypes
-        card.rarity = db_card.rarity
-        card.text = db_card.text
-        card.power = db_card.power
-        card.toughness = db_card.toughness
-        card.loyalty = db_card.loyalty
-        return card
\ No newline at end of file
+        self.tapped = False
\ No newline at end of file
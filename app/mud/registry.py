@@ -0,0 +1,99 @@
+class UserRegistry(object):
+    """
+    Logged in users, by db id and by name (case-insensitive).
+    """
+    def __init__(self):
+        self.by_id = {}
+        self.by_name = {}
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __contains__(self, user):
+        return self.by_id.get(user.db.id) is user
+
+    def add(self, user):
+        self.by_id[user.db.id] = user
+        self.by_name[user.name.lower()] = user
+
+    def remove(self, user):
+        # A user who signs in again replaces their old session before the old
+        # connection has gone, so only remove the entries that are still ours.
+        if self.by_id.get(user.db.id) is user:
+            del self.by_id[user.db.id]
+        if self.by_name.get(user.name.lower()) is user:
+            del self.by_name[user.name.lower()]
+
+    def get(self, name):
+        return self.by_name.get(name.lower())
+
+    def get_by_id(self, user_id):
+        return self.by_id.get(user_id)
+
+
+class RoomRegistry(object):
+    """
+    Loaded rooms, by name (case-insensitive), in the order they were added.
+    """
+    def __init__(self):
+        self.by_name = {}
+
+    def __iter__(self):
+        return iter(self.by_name.values())
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def add(self, room):
+        self.by_name[room.name.lower()] = room
+
+    def remove(self, room):
+        self.by_name.pop(room.name.lower(), None)
+
+    def get(self, name):
+        return self.by_name.get(name.lower())
+
+    def clear(self):
+        self.by_name.clear()
+
+
+class TableRegistry(object):
+    """
+    Open tables, by room and by table name (case-insensitive).
+    """
+    def __init__(self):
+        # room: { table name: table }
+        self.by_room = {}
+        self.count = 0
+
+    def __iter__(self):
+        for tables in self.by_room.values():
+            yield from tables.values()
+
+    def __len__(self):
+        return self.count
+
+    def add(self, room, table):
+        tables = self.by_room.setdefault(room, {})
+        if table.name.lower() in tables:
+            raise ValueError("There is already a table called '{}' in {}".format(table.name, room.name))
+        tables[table.name.lower()] = table
+        self.count += 1
+
+    def remove(self, room, table):
+        tables = self.by_room.get(room)
+        if tables is None or tables.get(table.name.lower()) is not table:
+            return
+        del tables[table.name.lower()]
+        self.count -= 1
+        if not tables:
+            del self.by_room[room]
+
+    def get(self, room, name):
+        return self.by_room.get(room, {}).get(name.lower())
+
+    def in_room(self, room):
+        return list(self.by_room.get(room, {}).values())
@@ -1,51 +1,61 @@
-import requests, threading, time, json, os
+import asyncio, requests, json, os
 
-from app import db, config
+from app import db, config, metrics, style
+from app.profiler import Profiler
 from app.db import models as db_models
+from app.db.catalog import CardCatalog
+from app.db.cardquery import CardIndex
+from app.db.chat import ChatCache
+from app.db.importer import import_cards
 from . import models as v_models
-
-# specify a function to be executed with specified params every n seconds.
-class Ticker(threading.Thread):
-    def __init__(self, sleep, func):
-        """ execute func() every 'sleep' seconds """
-        self.func = func
-        self.sleep = sleep
-        threading.Thread.__init__(self, name = "Ticker")
-        self.setDaemon(True)
-    def run(self):
-        while 1:
-            time.sleep(self.sleep)
-            self.func()
+from .bus import Bus, namespace, room_topic, table_topic
+from .help import HelpIndex
+from .registry import UserRegistry, RoomRegistry, TableRegistry
+from .timers import TimerWheel
 
 
 class Mud(object):
     def __init__(self):
-        self.connected = []
-        self.users = []
-        self.rooms = []
-        self.tables = []
-        self.channels = {}
-        # A tick is a list of (function, interval, repeat?)
-        self.ticks = []
-        self.tick_count = 0
-        self.ticker = Ticker(1, self.do_tick)
-        self.ticker.start()
+        self.connected = set()
+        self.users = UserRegistry()
+        self.rooms = RoomRegistry()
+        self.tables = TableRegistry()
+        self.chat = ChatCache()
+        # channel key: ChannelDefinition, and emote name: EmoteDefinition
+        self.channels = self.chat.channels
+        self.emotes = self.chat.emotes
+        self.catalog = CardCatalog()
+        # Columns of the catalog for 'card' queries
+        self.card_index = CardIndex(self.catalog)
+        self.help = HelpIndex(config.HELP_DIR)
+        # Everything that needs to happen later (table timers...) is scheduled here
+        self.timers = TimerWheel(resolution=config.TIMER_RESOLUTION)
+        self.metrics = metrics.Metrics(slow_seconds=config.SLOW_COMMAND_MS / 1000,
+                                       lag_interval=config.LOOP_LAG_INTERVAL)
+        self.add_gauges()
+        self.profiler = Profiler(config.PROFILE_DIR, interval=config.PROFILE_INTERVAL_MS / 1000)
+        self.profile_timer = None
+        # In sharded mode, this process's part in it (see app.mud.cluster)
+        self.cluster = None
+        # Who hears what is sent to the server, each room, table and user
+        self.bus = Bus(namespace(db_models.engine.url))
 
         print("Checking Room database...")
-        if db.session.query(db_models.Room).filter_by(name=config.LOBBY_ROOM_NAME).first() is None:
+        if db_models.Room.by_name(config.LOBBY_ROOM_NAME) is None:
             print("No lobby found....")
             self.create_lobby()
         self.load_rooms()
 
         print("Checking Card database...")
-        if db.session.query(db_models.Card).count() < 1:
+        if self.count(db_models.Card) < 1:
             print("Card database is empty. \r\nNow populating...")
             self.create_cards()
         else:
             print("Cards exist.")
+        self.load_catalog()
 
         print("Checking for channels...")
-        if db.session.query(db_models.Channel).count() < 1:
+        if self.count(db_models.Channel) < 1:
             print("No channels found...")
             self.create_default_channels()
         else:
@@ -53,11 +63,33 @@ class Mud(object):
         self.load_channels()
 
         print("Checking for emotes...")
-        if db.session.query(db_models.Emote).count() < 1:
+        if self.count(db_models.Emote) < 1:
             print("No emotes found...")
             self.create_default_emotes()
         else:
             print("Emotes exist.")
+        self.load_emotes()
+        self.chat.listen()
+
+        self.load_help()
+
+    def add_gauges(self):
+        gauge = self.metrics.gauge
+        gauge('mud_connections', "Open client connections.", lambda: len(self.connected))
+        gauge('mud_users', "Users signed in.", lambda: len(self.users))
+        gauge('mud_tables', "Open tables.", lambda: len(self.tables))
+        gauge('mud_timers', "Timers waiting to run.", lambda: len(self.timers))
+        gauge('mud_bus_topics', "Topics with subscribers in this process.", lambda: len(self.bus))
+        gauge('mud_db_queue_depth', "Rows waiting to be written.", lambda: len(db.writer))
+        gauge('mud_db_flushes_total', "Batches of rows written.", lambda: db.writer.flushes, 'counter')
+        gauge('mud_db_flush_failures_total', "Batches that failed to write.", lambda: db.writer.failures, 'counter')
+        gauge('mud_db_rows_written_total', "Rows written.", lambda: db.writer.rows_written, 'counter')
+        gauge('mud_db_flush_seconds_total', "Time spent writing batches.", lambda: db.writer.total_flush_time, 'counter')
+
+    @staticmethod
+    def count(model):
+        with db.session_scope() as session:
+            return session.query(model).count()
 
     @staticmethod
     def create_lobby():
@@ -66,8 +98,8 @@ class Mud(object):
             name=config.LOBBY_ROOM_NAME,
             description=config.LOBBY_ROOM_DESC
         )
-        db.session.add(lobby)
-        db.session.commit()
+        with db.session_scope() as session:
+            session.add(lobby)
         print("{} created.".format(lobby.name))
 
     def load_rooms(self):
@@ -77,123 +109,255 @@ class Mud(object):
             for user in self.users:
                 user.room = None
             self.rooms.clear()
-        for i in db.session.query(db_models.Room).all():
+        with db.session_scope() as session:
+            db_rooms = session.query(db_models.Room).all()
+        for i in db_rooms:
             print("Loading room: {}".format(i.name))
             room = v_models.Room.load(i)
-            self.rooms.append(room)
+            self.rooms.add(room)
         print("Rooms loaded.")
 
+    def load_catalog(self):
+        print("Loading card catalog...")
+        self.catalog.load()
+        self.catalog.listen()
+        self.card_index.build()
+        print("{} cards loaded.".format(len(self.catalog)))
+
+    def load_help(self):
+        print("Loading help files...")
+        self.help.refresh()
+        print("{} help topics loaded.".format(len(self.help)))
+        if config.HELP_RELOAD_INTERVAL > 0:
+            self.timers.call_every(config.HELP_RELOAD_INTERVAL, self.reload_help)
+
+    def reload_help(self):
+        loaded = self.help.refresh()
+        if loaded:
+            print("Reloaded {} help topics.".format(loaded))
+
     def load_channels(self):
         print("Loading channels...")
-        if self.channels is not None:
+        if self.channels:
             print("Clearing out existing channels...")
-            self.channels.clear()
-        for channel in db.session.query(db_models.Channel).all():
+        self.chat.set_channels(self.chat.read_channels())
+        for channel in self.channels.values():
             print("Loading channel: {}".format(channel.name))
-            self.channels[channel.key] = channel
         print("Channels loaded.")
 
-    def add_tick(self, func, interval, repeat=True):
-        self.ticks.append((func, interval, repeat))
+    def load_emotes(self):
+        print("Loading emotes...")
+        self.chat.set_emotes(self.chat.read_emotes())
+        print("{} emotes loaded.".format(len(self.emotes)))
 
-    def do_tick(self):
-        for tick in self.ticks:
-            func, interval, repeat = tick
-            if self.tick_count % interval is 0:
-                func()
-                if not repeat:
-                    self.ticks.remove(tick)
-        self.tick_count += 1
+    async def reload_catalog(self):
+        catalog = CardCatalog()
+        await db.run(catalog.load)
+        self.catalog.replace(catalog)
+
+    async def reload_channels(self):
+        self.chat.set_channels(await db.run(self.chat.read_channels))
+
+    async def reload_emotes(self):
+        self.chat.set_emotes(await db.run(self.chat.read_emotes))
+
+    def start_profile(self, seconds, mode, done=None):
+        """
+        Profiles the server for seconds, then writes the profile out and
+        calls done(path, result) (see finish_profile).
+        """
+        self.profiler.start(mode)
+        self.profile_timer = self.timers.call_later(seconds, self.finish_profile, done)
+
+    async def finish_profile(self, done=None):
+        """
+        Stops the running profile and writes it to a file, off the event loop.
+        """
+        if self.profile_timer is not None:
+            self.profile_timer.cancel()
+            self.profile_timer = None
+        path = self.profiler.path(self.profiler.mode)
+        result = self.profiler.stop()
+        await asyncio.get_event_loop().run_in_executor(None, self.profiler.write, result, path)
+        print("Profile written to {}".format(path))
+        if done is not None:
+            done(path, result)
+
+    async def shutdown(self):
+        """
+        Signs everyone off before the event loop is closed: closes their
+        connections, waits for their command workers to stop, and writes
+        whatever that queued.
+        """
+        users = list(self.connected)
+        for user in users:
+            user.close()
+        # Closed connections call connection_lost on the next pass of the loop,
+        # except those still sending to a client that isn't reading
+        await asyncio.sleep(0)
+        for user in users:
+            if user in self.connected:
+                user.transport.abort()
+        await asyncio.sleep(0)
+        workers = [user.worker for user in users]
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await db.writer.drain()
 
     def get_room(self, room_name):
-        for room in self.rooms:
-            if room.name == room_name:
-                return room
-        return None
+        return self.rooms.get(room_name)
 
     def get_user(self, user_name):
-        for user in self.users:
-            if user.name == user_name:
-                return user
-        return None
+        return self.users.get(user_name)
+
+    def move(self, user, room):
+        """
+        Takes user out of the room they are in (if any) and puts them in room.
+        """
+        if self.cluster is not None and not self.cluster.admits(user, room):
+            # The room is on another shard, which the user is handed over to
+            return
+        if user.room is not None:
+            user.room.leave(user)
+            self.bus.unsubscribe(room_topic(user.room), user)
+        user.room = room
+        if room is not None:
+            room.enter(user)
+            if self.runs(user):
+                self.bus.subscribe(room_topic(room), user)
+        if self.cluster is not None:
+            self.cluster.moved(user, room)
+
+    def runs(self, user):
+        """
+        Whether user's commands are run by this process (always, unless sharded).
+        """
+        return self.cluster is None or self.cluster.runs(user)
+
+    async def add_room(self, name):
+        """
+        Loads a room that has been created since the rooms were loaded.
+        """
+        db_room = await db.run(db_models.Room.by_name, name)
+        if db_room is not None and self.get_room(name) is None:
+            self.rooms.add(v_models.Room.load(db_room))
+
+    def remove_room(self, room):
+        """
+        Sends everyone in room to the lobby, closing their tables, and
+        forgets the room.
+        """
+        lobby = self.get_room(config.LOBBY_ROOM_NAME)
+        for occupant in list(room.occupants):
+            if not self.runs(occupant):
+                # Moved by the process that runs them
+                continue
+            # Tables go with the room
+            if occupant.table is not None:
+                self.leave_table(occupant)
+            # Before the move, which may hand them over to another shard
+            occupant.send_to_self("The lights flicker and you are suddenly in {}. Weird...".format(config.LOBBY_ROOM_NAME))
+            self.move(occupant, lobby)
+        self.rooms.remove(room)
+
+    def open_table(self, table):
+        self.tables.add(table.room, table)
+
+    def join_table(self, user, table):
+        table.join(user)
+        user.table = table
+        self.bus.subscribe(table_topic(table), user)
+
+    def leave_table(self, user):
+        """
+        Takes user away from their table, closing it if they were the last one there.
+        """
+        table = user.table
+        if user in table.frames:
+            # Their table was pinned at the top of the screen
+            user.send_to_self(style.UNPIN)
+        table.leave(user)
+        user.table = None
+        self.bus.unsubscribe(table_topic(table), user)
+        if len(table.users) < 1:
+            table.close()
+            self.tables.remove(table.room, table)
+        return table
 
     @staticmethod
     def create_default_channels():
         print("Creating default channels...")
-        chat = db_models.Channel(
-            key = ".",
-            name = "chat",
-            colour_token = "&G",
-            type = 0,
-            default = True
-        )
-        db.session.add(chat)
-        say = db_models.Channel(
-            key = "\'",
-            name = "say",
-            colour_token = "&C",
-            type = 1,
-            default = True
-        )
-        db.session.add(say)
-        tchat = db_models.Channel(
-            key = ";",
-            name = "tchat",
-            colour_token = "$y",
-            type = 2,
-            default = True
-        )
-        db.session.add(tchat)
-        whisper = db_models.Channel(
-            key = ">",
-            name = "whisper",
-            colour_token = "&M",
-            type = 3,
-            default = True
-        )
-        db.session.add(whisper)
-        db.session.commit()
-        print("Created default channels: {}".format(', '.join([channel.name for channel in db.session.query(db_models.Channel).filter_by(default=True).all()])))
+        with db.session_scope() as session:
+            chat = db_models.Channel(
+                key = ".",
+                name = "chat",
+                colour_token = "&G",
+                type = 0,
+                default = True
+            )
+            session.add(chat)
+            say = db_models.Channel(
+                key = "\'",
+                name = "say",
+                colour_token = "&C",
+                type = 1,
+                default = True
+            )
+            session.add(say)
+            tchat = db_models.Channel(
+                key = ";",
+                name = "tchat",
+                colour_token = "$y",
+                type = 2,
+                default = True
+            )
+            session.add(tchat)
+            whisper = db_models.Channel(
+                key = ">",
+                name = "whisper",
+                colour_token = "&M",
+                type = 3,
+                default = True
+            )
+            session.add(whisper)
+            print("Created default channels: {}".format(', '.join([channel.name for channel in session.query(db_models.Channel).filter_by(default=True).all()])))
 
     @staticmethod
     def create_default_emotes():
         print("Creating default emotes...")
         with open('app/player/emotes.json') as emotes_json:
             emotes = json.load(emotes_json)
-        for e in emotes:
-            print("Adding emote: {}".format(e))
-            emote = db_models.Emote(
-                name = emotes[e]['name'],
-                user_no_vict = emotes[e]['user_no_vict'],
-                others_no_vict = emotes[e]['others_no_vict'] if 'others_no_vict' in emotes[e] else None,
-                user_vict = emotes[e]['user_vict'] if 'user_vict' in emotes[e] else None,
-                others_vict = emotes[e]['others_vict'] if 'others_vict' in emotes[e] else None,
-                vict_vict = emotes[e]['vict_vict'] if 'vict_vict' in emotes[e] else None,
-                user_vict_self = emotes[e]['user_vict_self'] if 'user_vict_self' in emotes[e] else None,
-                others_vict_self = emotes[e]['others_vict_self'] if 'others_vict_self' in emotes[e] else None
-            )
-            db.session.add(emote)
-        db.session.commit()
+        with db.session_scope() as session:
+            for e in emotes:
+                print("Adding emote: {}".format(e))
+                emote = db_models.Emote(
+                    name = emotes[e]['name'],
+                    user_no_vict = emotes[e]['user_no_vict'],
+                    others_no_vict = emotes[e]['others_no_vict'] if 'others_no_vict' in emotes[e] else None,
+                    user_vict = emotes[e]['user_vict'] if 'user_vict' in emotes[e] else None,
+                    others_vict = emotes[e]['others_vict'] if 'others_vict' in emotes[e] else None,
+                    vict_vict = emotes[e]['vict_vict'] if 'vict_vict' in emotes[e] else None,
+                    user_vict_self = emotes[e]['user_vict_self'] if 'user_vict_self' in emotes[e] else None,
+                    others_vict_self = emotes[e]['others_vict_self'] if 'others_vict_self' in emotes[e] else None
+                )
+                session.add(emote)
 
     @staticmethod
     def create_cards():
-        cards = requests.get('http://mtgjson.com/json/AllCards.json').json()
-        for c in cards:
-            card = db_models.Card(
-                name = cards[c]['name'],
-                names = cards[c]['names'] if 'names' in cards[c] else None,
-                manaCost = cards[c]['manaCost'] if 'manaCost' in cards[c] else None,
-                cmc = cards[c]['cmc'] if 'cmc' in cards[c] else None,
-                colors = cards[c]['colors'] if 'colors' in cards[c] else None,
-                type = cards[c]['type'],
-                supertypes = cards[c]['supertypes'] if 'supertypes' in cards[c] else None,
-                types = cards[c]['types'] if 'types' in cards[c] else None,
-                subtypes = cards[c]['subtypes'] if 'subtypes' in cards[c] else None,
-                rarity = cards[c]['rarity'] if 'rarity' in cards[c] else None,
-                text = cards[c]['text'] if 'text' in cards[c] else None,
-                power = cards[c]['power'] if 'power' in cards[c] else None,
-                toughness = cards[c]['toughness'] if 'toughness' in cards[c] else None,
-                loyalty = cards[c]['loyalty'] if 'loyalty' in cards[c] else None
-            )
-            db.session.add(card)
-        db.session.commit()
\ No newline at end of file
+        if not os.path.exists(config.CARD_DATA):
+            print("Downloading {}...".format(config.CARD_DATA_URL))
+            # Downloaded beside it and moved into place once complete, so an
+            # interrupted download isn't taken for the card data next time
+            partial = config.CARD_DATA + '.part'
+            try:
+                with requests.get(config.CARD_DATA_URL, stream=True) as response:
+                    response.raise_for_status()
+                    with open(partial, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=65536):
+                            f.write(chunk)
+                os.replace(partial, config.CARD_DATA)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+        import_cards(config.CARD_DATA)
\ No newline at end of file
@@ -0,0 +1,148 @@
+import asyncio
+import codecs
+
+from app.style import colourify, strip_colours
+
+
+class LineBuffer(object):
+    """
+    Per-connection input buffer. Bytes are fed in as they arrive off the socket
+    and complete lines come back out, however the stream was chunked.
+    """
+    def __init__(self, max_length=1024, encoding='utf-8'):
+        self.max_length = max_length
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self.buffer = ""
+        # True while we are throwing away the rest of an over-long line
+        self.discarding = False
+        # True if the last chunk ended on a CR, so a leading LF belongs to it
+        self.after_cr = False
+
+    def feed(self, data):
+        """
+        Add received bytes to the buffer and return every line that has been
+        terminated by CR, LF or CRLF. Lines over max_length come back as None.
+        """
+        text = self.decoder.decode(data)
+        if not text:
+            return []
+        if self.after_cr and text.startswith('\n'):
+            text = text[1:]
+        self.after_cr = text.endswith('\r')
+
+        lines = []
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+        *complete, rest = text.split('\n')
+        for part in complete:
+            line = self.buffer + part
+            self.buffer = ""
+            if self.discarding:
+                self.discarding = False
+                continue
+            if len(line) > self.max_length:
+                lines.append(None)
+                continue
+            lines.append(line)
+
+        if self.discarding:
+            return lines
+        self.buffer += rest
+        if len(self.buffer) > self.max_length:
+            # Never let a client grow the buffer without bound; drop everything
+            # up to the next line terminator and tell the caller once.
+            self.buffer = ""
+            self.discarding = True
+            lines.append(None)
+        return lines
+
+
+class OutputBuffer(object):
+    """
+    Per-connection output queue. Everything written while handling an event is
+    collected and sent to the transport as one write on the next pass of the
+    event loop, instead of one write per message.
+    """
+    def __init__(self, transport, limit=1048576):
+        self.transport = transport
+        # Most bytes we will hold for a client that has stopped reading
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+        self.paused = False
+        self.scheduled = False
+
+    def write(self, data):
+        if self.transport.is_closing():
+            return
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.paused:
+            if self.size > self.limit:
+                print("Dropping slow client: {}".format(self.transport.get_extra_info('peername')))
+                self.chunks.clear()
+                self.size = 0
+                self.transport.abort()
+            return
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        if self.paused or not self.chunks or self.transport.is_closing():
+            return
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        self.transport.write(data)
+
+    def pause(self):
+        """
+        Called when the transport's write buffer is full; hold output until resume().
+        """
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self.flush()
+
+    def close(self):
+        """
+        Sends whatever is waiting, then closes the connection.
+        """
+        self.paused = False
+        self.flush()
+        self.transport.close()
+
+
+class Payload(object):
+    """
+    A message ready to send. It is rendered and encoded at most once for
+    colour clients and once for no-colour clients, and the same bytes are
+    handed to every recipient.
+    """
+    __slots__ = ('msg', 'text', 'colour', 'plain')
+
+    def __init__(self, msg):
+        self.msg = msg
+        self.text = "\r\n" + msg
+        self.colour = None
+        self.plain = None
+
+    def encoded(self, colour=True):
+        if colour:
+            if self.colour is None:
+                self.colour = memoryview(colourify(self.text).encode())
+            return self.colour
+        if self.plain is None:
+            self.plain = memoryview(strip_colours(self.text).encode())
+        return self.plain
+
+
+def broadcast(users, msg):
+    """
+    Sends msg to every user in users, encoding it only once.
+    """
+    payload = Payload(msg)
+    for user in users:
+        user.send(payload)
@@ -0,0 +1,156 @@
+import asyncio
+import math
+import traceback
+
+
+class Timer(object):
+    """
+    Handle for a scheduled callback; cancel() stops it from running.
+    """
+    __slots__ = ('wheel', 'deadline', 'callback', 'args', 'interval', 'slot')
+
+    def __init__(self, wheel, deadline, callback, args, interval=None):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        # The wheel slot (a set) this timer is waiting in, if any
+        self.slot = None
+
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+        self.interval = None
+
+    @property
+    def cancelled(self):
+        return self.slot is None
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timing wheel run off the event loop's clock.
+
+    Time is cut into ticks of `resolution` seconds. Level 0 has a slot for
+    each of the next `slots` ticks, level 1 a slot for each of the next
+    `slots` blocks of `slots` ticks, and so on. Adding or cancelling a timer
+    just puts it in or takes it out of a slot's set; when a higher level slot
+    comes round its timers are moved down to the level below. Only one
+    loop.call_at is ever pending, however many timers there are, and none
+    while the wheel is empty.
+    """
+    def __init__(self, resolution=1.0, slots=64, levels=4):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[set() for i in range(slots)] for level in range(levels)]
+        self.count = 0
+        self.loop = None
+        # Loop time at tick 0, and the last tick that has been run
+        self.start = None
+        self.tick = 0
+        self.handle = None
+
+    def __len__(self):
+        return self.count
+
+    def time(self):
+        return self.get_loop().time()
+
+    def get_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+            self.start = self.loop.time()
+        return self.loop
+
+    def call_at(self, when, callback, *args):
+        """
+        Runs callback(*args) at loop time `when`. callback may be a coroutine
+        function, in which case the coroutine is scheduled as a task.
+        """
+        return self.add(Timer(self, when, callback, args))
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_every(self, interval, callback, *args):
+        """
+        Runs callback(*args) every `interval` seconds until cancelled.
+        """
+        return self.add(Timer(self, self.time() + interval, callback, args, interval))
+
+    def add(self, timer):
+        loop = self.get_loop()
+        if self.count == 0:
+            # Nothing is waiting, so the wheel can jump straight to now
+            self.tick = int((loop.time() - self.start) / self.resolution)
+        self.count += 1
+        # Timers are never due on a tick that has already run
+        self.place(timer, max(self.tick_for(timer.deadline), self.tick + 1))
+        if self.handle is None:
+            self.schedule()
+        return timer
+
+    def tick_for(self, when):
+        return math.ceil((when - self.start) / self.resolution)
+
+    def place(self, timer, target):
+        delta = target - self.tick
+        level = 0
+        span = 1
+        while level < self.levels - 1 and delta >= span * self.slots:
+            level += 1
+            span *= self.slots
+        timer.slot = self.wheels[level][(target // span) % self.slots]
+        timer.slot.add(timer)
+
+    def schedule(self):
+        when = self.start + (self.tick + 1) * self.resolution
+        self.handle = self.loop.call_at(when, self.advance)
+
+    def advance(self):
+        self.handle = None
+        now = int((self.loop.time() - self.start) / self.resolution)
+        while self.tick < now and self.count:
+            self.tick += 1
+            self.cascade()
+            self.expire(self.wheels[0][self.tick % self.slots])
+        if self.count:
+            self.tick = max(self.tick, now)
+            self.schedule()
+
+    def cascade(self):
+        # Move timers down from every higher level whose slot starts on this tick
+        span = self.slots ** (self.levels - 1)
+        for level in range(self.levels - 1, 0, -1):
+            if self.tick % span == 0:
+                index = (self.tick // span) % self.slots
+                timers = self.wheels[level][index]
+                self.wheels[level][index] = set()
+                for timer in timers:
+                    self.place(timer, max(self.tick_for(timer.deadline), self.tick))
+            span //= self.slots
+
+    def expire(self, slot):
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            timer.slot = None
+            self.count -= 1
+            self.run(timer)
+            if timer.interval is not None:
+                timer.deadline += timer.interval
+                self.count += 1
+                self.place(timer, max(self.tick_for(timer.deadline), self.tick + 1))
+
+    @staticmethod
+    def run(timer):
+        try:
+            result = timer.callback(*timer.args)
+            if asyncio.iscoroutine(result):
+                asyncio.ensure_future(result)
+        except Exception:
+            traceback.print_exc()
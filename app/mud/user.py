@@ -1,13 +1,30 @@
+import asyncio
+import traceback
 from asyncio import Protocol
 
 from app import db, server, config
-from app.player import actions, channels
-from app.style import colourify
+from app.player import commands, channels
+from .bus import SERVER
+from .telnet import LineBuffer, OutputBuffer, Payload, broadcast
 
 class User(Protocol):
 
     def connection_made(self, transport):
+        self.open(transport)
+        print("Connected: {}".format(self.addr))
+        server.connected.add(self)
+
+        commands['help'](self, ['welcome'])
+        self.get_prompt()
+
+    def open(self, transport):
+        """
+        Sets up a session on transport, which is a client's connection or,
+        on a shard, one proxied from the front door (see app.mud.cluster).
+        """
         self.transport = transport
+        self.transport.set_write_buffer_limits(high=config.WRITE_BUFFER_HIGH)
+        self.output = OutputBuffer(transport, limit=config.OUTPUT_BUFFER_LIMIT)
         self.addr = transport.get_extra_info('peername')
         self.authd = False
         self.name = None
@@ -15,21 +32,66 @@ class User(Protocol):
         self.room = None
         self.table = None
         self.db = None
+        # In sharded mode: the id the front door and shards know the session
+        # by and, on the front door, the index of the shard running it
+        self.shard = None
+        self.session = None
 
         self.flags = []
-
-        print("Connected: {}".format(self.addr))
-        server.connected.append(self)
-
-        actions['help'](self, ['welcome'])
-        self.get_prompt()
+        self.colour = True
+        self.input = LineBuffer(max_length=config.MAX_LINE_LENGTH)
+        # Lines are handled one at a time, in order, even when a command has to
+        # wait on the database.
+        self.commands = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self.process_commands())
 
     def data_received(self, data):
-        msg = data.decode().strip()
+        for line in self.input.feed(data):
+            self.commands.put_nowait(line)
+
+    async def process_commands(self):
+        while True:
+            line = await self.commands.get()
+            try:
+                if self.transport.is_closing():
+                    continue
+                if line is None:
+                    self.send_to_self("Line too long, ignored.")
+                    self.get_prompt()
+                    continue
+                try:
+                    # Commands change rows, which mustn't happen mid-flush
+                    await db.writer.settled()
+                    await self.handle_line(line)
+                except Exception:
+                    traceback.print_exc()
+                    self.send_to_self("Huh?")
+                    self.get_prompt()
+            finally:
+                # Lets a shard handing the session on wait for the line in hand
+                self.commands.task_done()
+
+    async def do_action(self, command, args):
+        """
+        Runs a command; coroutine commands are awaited before the next line is handled.
+        """
+        name = command.full_name(args, self)
+        # A verb is already part of the name
+        logged = args[name.count(' '):] if args and not command.sensitive else None
+        with server.metrics.timed(name, self, logged):
+            result = command(self, args)
+            if asyncio.iscoroutine(result):
+                await result
+
+    async def handle_line(self, line):
+        if self.shard is not None:
+            server.cluster.forward(self, line)
+            return
+        msg = line.strip()
         args = msg.split()
 
         if self.authd is False:
-            actions['login'](self, args)
+            await self.do_action(commands['login'], args)
             return
 
         if msg:
@@ -40,27 +102,34 @@ class User(Protocol):
                 args = msg.split()
 
             if msg[0] in server.channels:
-                ch = db.session.query(db.models.Channel).get(msg[0])
-                if msg[1] =='@':
-                    channels.send_to_channel(self, ch, msg[2:], do_emote=True)
-                else:
-                    channels.send_to_channel(self, ch, msg[1:])
+                ch = server.channels[msg[0]]
+                # What is said isn't logged, even when it is slow
+                with server.metrics.timed(ch.name, self):
+                    if msg[1] =='@':
+                        channels.send_to_channel(self, ch, msg[2:], do_emote=True)
+                    else:
+                        channels.send_to_channel(self, ch, msg[1:])
                 self.get_prompt()
                 return
 
-            if args[0] in actions:
+            command = commands.find(args[0], self)
+            if command is not None:
                 if self.is_frozen():
                     self.send_to_self("You're frozen solid!")
                 else:
-                    actions[args[0]](self, args[1:] if len(args) > 1 else None)
+                    await self.do_action(command, args[1:] if len(args) > 1 else None)
                 self.get_prompt()
                 return
-            self.send_to_self("Huh?")
+            matches = commands.matches(args[0], self)
+            if matches:
+                self.send_to_self("Did you mean: {}?".format(', '.join(matches)))
+            else:
+                self.send_to_self("Huh?")
         else:
             if self.table is not None:
-                actions['table'](self, None)
+                await self.do_action(commands['table'], None)
             elif self.room is not None:
-                actions['look'](self, None)
+                await self.do_action(commands['look'], None)
 
         self.get_prompt()
 
@@ -75,23 +144,28 @@ class User(Protocol):
         buff += "&B>&x&w>> &x"
         self.send_to_self(buff)
 
+    def send(self, payload):
+        self.output.write(payload.encoded(self.colour))
+
     def send_to_self(self, msg):
-        msg = "\r\n" + msg
-        msg = colourify(msg)
-        self.transport.write(msg.encode())
+        self.send(Payload(msg))
 
     @staticmethod
     def send_to_user(user, msg):
-        msg = "\r\n"+msg
-        msg = colourify(msg)
-        user.transport.write(msg.encode())
+        user.send(Payload(msg))
 
     @staticmethod
     def send_to_users(users, msg):
-        msg = "\r\n"+msg
-        msg = colourify(msg)
-        for user in users:
-            user.transport.write(msg.encode())
+        broadcast(users, msg)
+
+    def pause_writing(self):
+        self.output.pause()
+
+    def resume_writing(self):
+        self.output.resume()
+
+    def close(self):
+        self.output.close()
 
     def is_admin(self):
         return self.flags['admin']
@@ -109,36 +183,64 @@ class User(Protocol):
         return self.flags['allow_spec']
 
     def load(self, dbUser):
-        for user in server.users:
-            if user.db.id is dbUser.id:
-                self.send_to_user(user, "You have signed in from another location!")
-                actions['quit'](user, None)
+        user = server.users.get_by_id(dbUser.id)
+        if user is not None:
+            self.send_to_user(user, "You have signed in from another location!")
+            commands['quit'](user, None)
+        self.attach(dbUser)
+        if self.name == config.ADMIN and not self.is_admin():
+            self.flags['admin'] = True
+            self.save()
+        server.move(self, server.get_room(config.LOBBY_ROOM_NAME))
+
+    def attach(self, dbUser):
+        """
+        Signs the session in as dbUser, without putting them anywhere.
+        """
         self.authd = True
         self.name = str(dbUser.name)
         self.flags = dict(dbUser.flags)
+        self.colour = self.flags.get('colour', True)
         self.deck = dbUser.deck
         self.decks = dbUser.decks
         self.db = dbUser
-        server.users.append(self)
-        lobby = server.get_room(config.LOBBY_ROOM_NAME)
-        self.room = lobby
-        lobby.occupants.append(self)
-
-        if self.name == config.ADMIN and not self.is_admin():
-            self.flags['admin'] = True
-            self.save()
-
-    def save(self):
+        server.users.add(self)
+        server.bus.subscribe(SERVER, self)
+        server.bus.subscribe(server.bus.user_topic(dbUser.id), self)
+
+    def save(self, durable=False):
+        """
+        Copies state back onto the db user and queues it to be written.
+        Returns an awaitable for callers that need to wait on the write.
+        """
+        if server.cluster is not None and not server.cluster.saving(self):
+            # Another process has the up to date copy of this user, and writes it
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(None)
+            return future
+        if db.writer.flushing is not None:
+            # The flush is reading the row on the db thread, so it can only
+            # be changed once that is done (commands wait the same way)
+            return asyncio.ensure_future(self.save_settled(durable))
         self.db.name = self.name
         self.db.flags = self.flags
-        db.session.commit()
+        self.db.deck = self.deck
+        return db.save(self.db, durable=durable)
+
+    async def save_settled(self, durable):
+        await db.writer.settled()
+        await self.save(durable)
 
     def connection_lost(self, ex):
         print("Disconnected: {}".format(self.addr))
-        server.connected.remove(self)
-        
+        self.worker.cancel()
+        server.connected.discard(self)
+
         if self.authd:
             self.save()
+            if self.table is not None:
+                server.leave_table(self)
             server.users.remove(self)
-            self.room.occupants.remove(self)
+            server.move(self, None)
+            server.bus.drop(self)
 
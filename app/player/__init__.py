@@ -1 +1 @@
-from .actions import actions
\ No newline at end of file
+from .actions import commands
@@ -1,36 +1,17 @@
-import os
 import re
+import time
 from random import randint
 
+from sqlalchemy.exc import IntegrityError
+
 from app import config, db, mud, server, style
+from app.db import cardquery
 from . import channels
-
-def is_int(s):
-    try:
-        int(s)
-        return True
-    except ValueError:
-        return False
-
-#Trying out this decorator malarky... still not convinced, but lets give it a bash; might at least be useful to have later
-class d_user_has(object):
-    def __init__(self, user, attrib, error_msg='Huh?'):
-        self.user = user
-        self.attrib = attrib
-        self.error_msg = error_msg
-
-    def __call__(self, func):
-        def wrapper(*args):
-            if hasattr(self.user, self.attrib) and getattr(self.user, self.attrib) is not None:
-                func(*args)
-            else:
-                self.user.send_to_self(self.error_msg)
-        return wrapper
-
+from .commands import CommandTable
 
 #TODO: Tidy up the logic of these functions to be more consistent
 
-def do_login(user, args):
+async def do_login(user, args):
     """
     Function to register or login an existing user.
     """
@@ -57,31 +38,43 @@ def do_login(user, args):
                 user.send_to_self("That name is banned, sorry!")
                 user.get_prompt()
                 return
-            if db.session.query(db.models.User).filter_by(name=args[1]).first() is not None:
+            if await db.run(db.models.User.by_name, args[1]) is not None:
                 user.send_to_self("Username '{}' is already taken, sorry.".format(args[1]))
                 user.get_prompt()
                 return
             dbUser = db.models.User(
                 name = args[1],
-                password = args[2],
+                _password = await db.passwords.hash_password(args[2]),
                 aliases = {},
-                listening = ''.join([channel.key for channel in db.session.query(db.models.Channel).filter_by(default=True).all()])
+                decks = [],
+                deck = None,
+                listening = ''.join([channel.key for channel in server.channels.values() if channel.default])
             )
-            db.session.add(dbUser)
-            db.session.commit()
+            # The new user's id is needed straight away, so this can't wait for a batch
+            try:
+                await db.add(dbUser, durable=True)
+            except IntegrityError:
+                # Someone registered the name since it was checked; don't try again
+                db.delete(dbUser)
+                user.send_to_self("Username '{}' is already taken, sorry.".format(args[1]))
+                user.get_prompt()
+                return
             user.load(dbUser)
             channels.do_info("{} has entered the realm.".format(user.name))
             do_look(user, None)
             user.get_prompt()
             return
     if len(args) == 2:
-        dbUser = db.session.query(db.models.User).filter_by(name=args[0]).first()
+        dbUser = await db.run(db.models.User.by_name, args[0])
         if dbUser is not None:
-            if dbUser.verify_password(args[1]):
+            if await db.passwords.verify_password(args[1], dbUser._password):
+                if db.passwords.needs_rehash(dbUser._password):
+                    dbUser._password = await db.passwords.hash_password(args[1])
+                    await db.save(dbUser)
                 user.load(dbUser)
                 if user.is_banned():
                     user.send_to_self("Eeek, it looks like you're banned buddy! Bye!")
-                    actions['quit'](user, None)
+                    do_quit(user, None)
                     return
                 channels.do_info("{} has entered the realm.".format(user.name))
                 do_look(user, None)
@@ -98,7 +91,7 @@ def do_quit(user, args):
     """
     user.send_to_self("&gYou are wracked with uncontrollable pain as you are extracted from the Matrix.&x")
     channels.do_info("{} has left the realm.".format(user.name))
-    user.transport.close()
+    user.close()
 
 
 def do_look(user, args):
@@ -135,22 +128,29 @@ def do_who(user, args):
 
 def do_help(user, args):
     """
-    Reads a help file and sends the contents to the user.
+    Sends a help topic to the user, or the topics matching 'help search <words>'.
     """
-    if args is None:
-        file = open('help/help', 'r')
-    else:
-        filename = os.path.join('help/',' '.join(args))
-        if os.path.isfile(filename):
-            file = open(filename, 'r')
-        else:
-            file = open('help/help', 'r')
-    help_ = file.read()
-    file.close()
-    user.send_to_self(help_)
+    if args is not None and args[0] == 'search' and len(args) > 1:
+        names = server.help.search(args[1:])
+        if not names:
+            user.send_to_self("No help topics mention '{}'.".format(' '.join(args[1:])))
+            return
+        buff = style.header_40('Help Search')
+        for name in names:
+            buff += style.body_40(name, align='left')
+        buff += style.BLANK_40
+        buff += style.FOOTER_40
+        user.send_to_self(buff)
+        return
+    topics = server.help.find(args) if args is not None else []
+    if len(topics) > 1:
+        user.send_to_self("Did you mean: {}?".format(', '.join(topic.name for topic in topics)))
+        return
+    topic = topics[0] if topics else server.help.get(server.help.default)
+    user.send(topic.payload)
 
 
-def do_alias(user, args):
+async def do_alias(user, args):
     """
     Create or delete aliases for the user.
     """
@@ -165,6 +165,7 @@ def do_alias(user, args):
     if args[0] == 'delete' and len(args) > 1:
         if args[1] in user.db.aliases:
             user.db.aliases.pop(args[1])
+            await db.save(user.db)
             user.send_to_self("Alias '{}' has been deleted.".format(args[1]))
             return
         user.send_to_self("You have no '{}' alias.".format(args[1]))
@@ -173,17 +174,27 @@ def do_alias(user, args):
         user.send_to_self("That's not a good idea...")
         return
     user.db.aliases[args[0]] = ' '.join(args[1:])
-    db.session.commit()
+    await db.save(user.db)
     user.send_to_self("Alias '{}' for '{}' created.".format(args[0], ' '.join(args[1:])))
 
 
-def do_make_admin(user, args):
+async def do_colour(user, args):
     """
-    Set the admin flag for a user.
+    Turns colour on or off for the user.
     """
-    if user.name != config.ADMIN:
-        user.send_to_self("Huh?")
+    if args is None or args[0] not in ('on', 'off'):
+        do_help(user, ['colour'])
         return
+    user.colour = args[0] == 'on'
+    user.flags['colour'] = user.colour
+    await user.save()
+    user.send_to_self("&GColour&x is now &Y{}&x.".format(args[0]))
+
+
+async def do_make_admin(user, args):
+    """
+    Set the admin flag for a user.
+    """
     if args is None:
         user.send_to_self("Make who an Admin?")
         return
@@ -196,87 +207,236 @@ def do_make_admin(user, args):
         user.send_to_self("They are already an Admin!")
         return
     u.flags['admin'] = True
-    u.save()
-    user.msg_client(u, "&RYou have been made an Admin!&x")
-    user.send_to_self("&CYou have admin'd {}.&x")
+    await u.save()
+    user.send_to_user(u, "&RYou have been made an Admin!&x")
+    user.send_to_self("&CYou have admin'd {}.&x".format(u.name))
 
-def do_mute(user, args):
+async def do_mute(user, args):
     """
     Set mute flag for a user.
     """
-    if not user.is_admin():
-        user.send_to_self("Huh?")
-        return
     if args is None:
         user.send_to_self("Mute who?")
         return
     user_name = args[0]
     u = server.get_user(user_name)
-    if user is None:
+    if u is None:
         user.send_to_self("Could not find user '{}'.".format(user_name))
         return
     u.flags['muted'] = True
-    u.save()
-    user.msg_client(u, "&RYou have been muted!&x")
+    await u.save()
+    user.send_to_user(u, "&RYou have been muted!&x")
     user.send_to_self("&CYou have muted {}.&x".format(u.name))
     return
 
 
-def do_freeze(user, args):
+async def do_freeze(user, args):
     """
     Set frozen flag for a user
     """
-    if not user.is_admin():
-        user.send_to_self("Huh?")
-        return
     if args is None:
         user.send_to_self("Freeze who?")
         return
     username = args[0]
-    for u in server.users:
-        if u.name == username:
-            u.flags['frozen'] = True
-            u.save()
-            user.msg_client(u, "&RYou have been frozen solid!&x")
-            user.send_to_self("&CYou have frozen {}.&x".format(u.name))
-
-            return
-    user.send_to_self("Could not find user '{}'.".format(username))
+    u = server.get_user(username)
+    if u is None:
+        user.send_to_self("Could not find user '{}'.".format(username))
+        return
+    u.flags['frozen'] = True
+    await u.save()
+    user.send_to_user(u, "&RYou have been frozen solid!&x")
+    user.send_to_self("&CYou have frozen {}.&x".format(u.name))
 
 
-def do_ban(user, args):
+async def do_ban(user, args):
     """
     Set banned flag for a user
     """
-    if not user.is_admin():
-        user.send_to_self("Huh?")
-        return
     if args is None:
         user.send_to_self("Ban who?")
         return
     username = args[0]
-    for u in server.users:
-        if u.name == username:
-            u.flags['banned'] = True
-            u.save()
-            user.msg_client(u, "&RYou have been banned!&x")
-            user.send_to_self("&CYou have banned {}.&x".format(u.name))
-            actions['quit'](u, None)
+    u = server.get_user(username)
+    if u is None:
+        user.send_to_self("Could not find user '{}'.".format(username))
+        return
+    u.flags['banned'] = True
+    await u.save()
+    user.send_to_user(u, "&RYou have been banned!&x")
+    user.send_to_self("&CYou have banned {}.&x".format(u.name))
+    do_quit(u, None)
+
+async def do_reload(user, what):
+    """
+    Reads channels, emotes or cards back from the database, after they have
+    been edited (or imported) outside the server.
+    """
+    if what == 'cards':
+        await server.reload_catalog()
+    elif what == 'channels':
+        await server.reload_channels()
+    elif what == 'emotes':
+        await server.reload_emotes()
+    else:
+        user.send_to_self("Reload what? (cards, channels, emotes)")
+        return
+    user.send_to_self("&CReloaded {}.&x".format(what))
+
+# Commands listed by 'stats', busiest first
+STATS_TOP = 20
+
+
+def do_stats(user, what):
+    """
+    Shows how long commands are taking, how far behind the event loop is
+    running and how the database writes are keeping up.
+    """
+    metrics = server.metrics
+    if what == 'reset':
+        metrics.reset()
+        user.send_to_self("&CStats reset.&x")
+        return
+    if what == 'slow':
+        buff = style.header_80('SLOW COMMANDS')
+        buff += style.body_80("{:<8} {:<12} {:>8} {:>8}  {}".format('TIME', 'USER', 'MS', 'DB MS', 'COMMAND'), align='left')
+        buff += style.ROW_LINE_80
+        for entry in reversed(metrics.slow):
+            line = "{:<8} {:<12} {:>8.1f} {:>8.1f}  {} {}".format(
+                time.strftime('%H:%M:%S', time.localtime(entry.time)), str(entry.user)[:12],
+                entry.seconds * 1000, entry.db_seconds * 1000, entry.command, entry.args)
+            buff += style.body_80(style.strip_colours(line)[:74], align='left')
+        if not metrics.slow:
+            buff += style.body_80("No commands over {:.0f} ms.".format(metrics.slow_seconds * 1000))
+        buff += style.FOOTER_80
+        user.send_to_self(buff)
+        return
+    if what is not None:
+        user.send_to_self("Stats for what? (slow, reset, or nothing for an overview)")
+        return
+    lag = metrics.loop_lag
+    writer = db.writer.metrics()
+    buff = style.header_80('STATS')
+    buff += style.body_80("Up {:.0f} s: {} users on {} connections, {} tables".format(
+        time.time() - metrics.started, len(server.users), len(server.connected), len(server.tables)), align='left')
+    buff += style.body_80("Loop lag: p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+        lag.quantile(0.5) * 1000, lag.quantile(0.99) * 1000, lag.max * 1000), align='left')
+    buff += style.body_80("DB writes: {} queued, {} batches ({} failed), mean {:.1f} ms, max {:.1f} ms".format(
+        writer['queue_depth'], writer['flushes'], writer['failures'], writer['mean_flush_ms'],
+        writer['max_flush_ms']), align='left')
+    buff += style.BLANK_80
+    buff += style.body_80("{:<20} {:>7} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+        'COMMAND', 'COUNT', 'MEAN MS', 'P50', 'P99', 'MAX', 'DB MS'), align='left')
+    buff += style.ROW_LINE_80
+    busiest = sorted(metrics.commands.items(), key=lambda item: item[1].latency.sum, reverse=True)
+    for name, stats in busiest[:STATS_TOP]:
+        latency = stats.latency
+        buff += style.body_80("{:<20} {:>7} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}".format(
+            name[:20], stats.count, latency.mean * 1000, latency.quantile(0.5) * 1000,
+            latency.quantile(0.99) * 1000, latency.max * 1000, stats.db_seconds / stats.count * 1000), align='left')
+    buff += style.BLANK_80
+    buff += style.body_80("{} slow commands logged ('stats slow')".format(len(metrics.slow)), align='left')
+    buff += style.FOOTER_80
+    user.send_to_self(buff)
+
+
+async def do_profile(user, what, mode):
+    """
+    Profiles the server for some seconds, then writes the profile to a file
+    and shows the admin what took the most time.
+    """
+    profiler = server.profiler
+    if what == 'stop':
+        if not profiler.running:
+            user.send_to_self("No profile is running.")
             return
-    user.send_to_self("Could not find user '{}'.".format(username))
+        await server.finish_profile(lambda path, result: profile_report(user, path, result))
+        return
+    if what is None:
+        if profiler.running:
+            user.send_to_self("A {} profile has been running for {:.0f} s ('profile stop' to stop it).".format(
+                profiler.mode, time.time() - profiler.started))
+        else:
+            user.send_to_self("Profile for how long? (profile <seconds> [sample|cprofile], or profile stop)")
+        return
+    if not what.isdigit() or not 0 < int(what) <= config.PROFILE_MAX_SECONDS:
+        user.send_to_self("Profile for 1 to {} seconds.".format(config.PROFILE_MAX_SECONDS))
+        return
+    try:
+        server.start_profile(int(what), mode or 'sample', lambda path, result: profile_report(user, path, result))
+    except (RuntimeError, ValueError) as e:
+        user.send_to_self("{}.".format(e))
+        return
+    user.send_to_self("&CProfiling ({}) for {} s.&x".format(profiler.mode, what))
 
-def do_card(user, args):
+
+def profile_report(user, path, result):
+    if user.transport.is_closing():
+        return
+    commands, functions = server.profiler.summary(result)
+    buff = style.header_80('PROFILE')
+    buff += style.body_80(path[-74:], align='left')
+    if commands:
+        buff += style.BLANK_80
+        buff += style.body_80("{:<66} {:>7}".format('COMMAND', 'SAMPLES'), align='left')
+        buff += style.ROW_LINE_80
+        for command, share in commands:
+            buff += style.body_80("{:<66} {:>6.1f}%".format(command[:66], share * 100), align='left')
+    buff += style.BLANK_80
+    buff += style.body_80("{:<66} {:>7}".format('FUNCTION', 'SELF'), align='left')
+    buff += style.ROW_LINE_80
+    for function, share in functions:
+        buff += style.body_80("{:<66} {:>6.1f}%".format(function[:66], share * 100), align='left')
+    buff += style.FOOTER_80
+    user.send_to_self(buff)
+
+
+async def do_card(user, args):
     """
-    Queries the card database, and sends results to the user.
+    Searches the card catalog, and sends results to the user.
     """
+    if args is None:
+        do_help(user, ['card'])
+        return
     card_name = ' '.join(args)
-    cards = db.models.Card.search(card_name)
+    if cardquery.is_query(card_name):
+        await card_query(user, card_name)
+        return
+    cards = server.catalog.search(card_name)
     if len(cards) < 1:
         user.send_to_self("Could not find card: {}".format(card_name))
         return
     buff = ""
-    for card in cards:
+    for card in cards[:config.CARD_SEARCH_LIMIT]:
         buff += style.card(card)
+    if len(cards) > config.CARD_SEARCH_LIMIT:
+        buff += "...and {} more. Please be more specific.".format(len(cards) - config.CARD_SEARCH_LIMIT)
+    user.send_to_self(buff)
+
+
+async def card_query(user, text):
+    """
+    Runs a search such as 't:creature c:green cmc<=3', and lists a page of
+    the cards it finds.
+    """
+    try:
+        query = cardquery.parse(text)
+    except cardquery.QueryError as e:
+        user.send_to_self(str(e))
+        return
+    await server.card_index.refresh()
+    page = server.card_index.search(query, config.CARD_PAGE_SIZE)
+    if page.total == 0:
+        user.send_to_self("No cards match: {}".format(text))
+        return
+    if page.total == 1:
+        user.send_to_self(style.card(page.cards[0]))
+        return
+    buff = style.header_80('CARDS')
+    for card in page.cards:
+        buff += style.card_summary(card)
+    buff += style.BLANK_80
+    buff += style.body_80("Page {} of {} ({} cards)".format(page.number, page.pages, page.total))
+    buff += style.FOOTER_80
     user.send_to_self(buff)
 
 
@@ -292,200 +452,139 @@ def do_rooms(user, args):
 
 
 def do_room(user, args):
-    def create(args):
-        if args is None:
-            do_help(user, ['room'])
-            return
-        room_name = style.strip_colours(' '.join(args))
-        # Check the database for duplicate name, rather than the server.rooms list, as we may not want to load rooms for some reason later
-        if db.session.query(db.models.Room).filter_by(name=room_name).first() is not None:
-            user.send_to_self("The room name '{}' is already taken, sorry.".format(room_name))
-            return
-        room = db.models.Room(name=str(room_name))
-        vroom = mud.models.Room.load(room)
-        server.rooms.append(vroom)
-        db.session.add(room)
-        db.session.commit()
-        user.send_to_self("Room created: {}".format(room_name))
-
-    def delete(args):
-        if args is None:
-            do_help(user, ['room'])
-            return
-        room_name = ' '.join(args)
-        for r in server.rooms:
-            if r.name == room_name:
-                room = r
-        if room is not None:
-            for occupant in room.occupants:
-                do_goto(occupant, config.LOBBY_ROOM_NAME)
-                user.send_to_user(occupant, "The lights flicker and you are suddenly in {}. Weird...".format(config.LOBBY_ROOM_NAME))
-            server.rooms.remove(room)
-            db.session.delete(room.db)
-            db.session.commit()
-            user.send_to_self("Room '{}' has been deleted.".format(room.name))
-            return
-        user.send_to_self("Room '{}' was not found.".format(room_name))
+    do_help(user, ['room'])
 
-    verbs = {
-        'create': create,
-        'delete': delete
-    }
 
-    if args is None:
-        do_help(user, ['room'])
+async def room_create(user, room_name):
+    room_name = style.strip_colours(room_name)
+    # Check the database for duplicate name, as well as the server.rooms list, as we may not want to load rooms for some reason later
+    if server.get_room(room_name) is not None or await db.run(db.models.Room.by_name, room_name) is not None:
+        user.send_to_self("The room name '{}' is already taken, sorry.".format(room_name))
+        return
+    room = db.models.Room(name=str(room_name))
+    vroom = mud.models.Room.load(room)
+    server.rooms.add(vroom)
+    # Other shards read the room back from the database, so it has to be there
+    await db.add(room, durable=server.cluster is not None)
+    if server.cluster is not None:
+        server.cluster.room_added(vroom)
+    user.send_to_self("Room created: {}".format(room_name))
+
+
+async def room_delete(user, room_name):
+    room = server.get_room(room_name)
+    if room is None:
+        user.send_to_self("Room '{}' was not found.".format(room_name))
         return
-    if args[0] in verbs:
-        verbs[args[0]](args[1:] if len(args) > 1 else None)
+    if room.name == config.LOBBY_ROOM_NAME:
+        user.send_to_self("You can't delete the {}!".format(config.LOBBY_ROOM_NAME))
         return
-    do_help(user, ['room'])
+    server.remove_room(room)
+    if server.cluster is not None:
+        server.cluster.room_removed(room)
+    await db.delete(room.db)
+    user.send_to_self("Room '{}' has been deleted.".format(room.name))
 
 
-def do_goto(user, args):
+def do_goto(user, room_name):
     if user.table is not None:
         user.send_to_self("You can't leave now, you're at a table!")
         return
-    if args is None:
-        do_help(user, ['goto'])
-        return
-    room_name = ' '.join(args)
     room = server.get_room(room_name)
     if room is None:
         user.send_to_self("Goto where?!")
         return
-    if user.room is not None:
-        user.room.occupants.remove(user)
-    user.room = room
-    user.room.occupants.append(user)
+    server.move(user, room)
     do_look(user, None)
 
 
 def do_deck(user, args):
-    def create(args):
-        if args is None:
-            do_help(user, ['deck'])
-            return
-        deck_name = style.strip_colours(' '.join(args))
-        for d in user.decks:
-            if d.name == deck_name:
-                user.send_to_self("You already have a deck named '{}'.".format(deck_name))
-                return
-        new_deck = db.models.Deck(
-            name = deck_name,
-            user_id = user.db.id,
-            cards = {}
-        )
-        db.session.add(new_deck)
-        user.decks.append(new_deck)
-        db.session.commit()
-        user.deck = new_deck
-        user.send_to_self("Created new deck '{}'.".format(new_deck.name))
-
-    def set_(args):
-        if args is None:
-            do_help(user, ['deck'])
-            return
-        deck_name = ' '.join(args)
-        for deck in user.decks:
-            if deck.name == deck_name:
-                user.deck = deck
-                db.session.add(user.db)
-                db.session.commit()
-                print(user.deck)
-                user.send_to_self("'{}' is now your active deck.".format(deck.name))
-                return
-        user.send_to_self("Deck '{}' not found.".format(deck_name))
+    if user.deck is None:
+        do_help(user, ['deck'])
+        return
+    buff = style.header_40(user.deck.name)
+    num_cards = 0
+    for card in user.deck.cards:
+        num_cards += user.deck.cards[card]
+        s_card = server.catalog.get(int(card))
+        buff += style.body_40("{:^3} x {:<25}".format(user.deck.cards[card], s_card.name))
+    buff += style.body_40(" [{}]".format(num_cards, ''), align='left')
+    buff += style.FOOTER_40
+    user.send_to_self(buff)
 
-    @d_user_has(user, 'deck', "You don't have a deck!")
-    def add(args):
-        if args is None:
-            do_help(user, ['deck'])
-            return
-        # if user.deck is None:
-        #     do_help(user, ['deck'])
-        #     return
-        if not is_int(args[0]):
-            num_cards = 1
-        else:
-            num_cards = int(args[0])
-            args = args[1:]
-        card_name = ' '.join(args)
-        s_cards = db.models.Card.search(card_name)
-        if len(s_cards) is 0:
-            user.send_to_self("Card '{}' not found.".format(card_name))
-            return
-        if len(s_cards) > 1:
-            user.send_to_self("Multiple cards called {}: {}Please be more specific.".format(card_name, ', '.join(card.name for card in s_cards)))
-            return
-        s_card = s_cards[0]
-        total_cards = 0
-        for card in user.deck.cards:
-            total_cards += user.deck.cards[card]
-        if total_cards >= 600:
-            user.send_to_self("Your deck is at the card limit (600).")
-        if s_card.id in user.deck.cards:
-            user.deck.cards[s_card.id] += num_cards
-        else:
-            user.deck.cards[s_card.id] = num_cards
-        db.session.commit()
-        user.send_to_self("Added {} x '{}' to '{}'.".format(num_cards, s_card.name, user.deck.name))
-
-    @d_user_has(user, 'deck', "You don't have a deck!")
-    def remove(args):
-        if args is None:
-            do_help(user, ['deck'])
-            return
-        # if user.deck is None:
-        #     do_help(user, ['deck'])
-        #     return
-        if not is_int(args[0]):
-            num_cards = 1
-        else:
-            num_cards = int(args[0])
-            args = args[1:]
-        card_name = ' '.join(args)
-        s_cards = db.models.Card.search(card_name)
-        if len(s_cards) is 0:
-            user.send_to_self("Card '{}' not found.".format(card_name))
-            return
-        if len(s_cards) > 1:
-            user.send_to_self("Multiple cards called {}: {}Please be more specific.".format(card_name, ', '.join(card.name for card in s_cards)))
+
+async def deck_create(user, deck_name):
+    deck_name = style.strip_colours(deck_name)
+    for d in user.decks:
+        if d.name == deck_name:
+            user.send_to_self("You already have a deck named '{}'.".format(deck_name))
             return
-        s_card = s_cards[0]
-        for card in user.deck.cards:
-            if card == s_card.id:
-                user.deck.cards[card] -= num_cards
-                if user.deck.cards[card] < 1:
-                    user.deck.cards.pop(card, None)
-                db.session.commit()
-                user.send_to_self("Removed {} x '{}' from '{}'.".format(num_cards, s_card.name, user.deck.name))
-                return
+    # entries rather than cards={}, which leaves the collection unloaded and
+    # so unreadable once the deck has been written and detached
+    new_deck = db.models.Deck(
+        name = deck_name,
+        user_id = user.db.id,
+        entries = {}
+    )
+    user.decks.append(new_deck)
+    await db.add(new_deck)
+    user.deck = new_deck
+    user.send_to_self("Created new deck '{}'.".format(new_deck.name))
 
-    verbs = {
-        'create': create,
-        'add': add,
-        'remove': remove,
-        'set': set_
-    }
 
-    if args is None:
-        if user.deck is None:
-            do_help(user, ['deck'])
+async def deck_set(user, deck_name):
+    for deck in user.decks:
+        if deck.name == deck_name:
+            user.deck = deck
+            await user.save()
+            user.send_to_self("'{}' is now your active deck.".format(deck.name))
             return
-        buff = style.header_40(user.deck.name)
-        num_cards = 0
-        for card in user.deck.cards:
-            num_cards += user.deck.cards[card]
-            s_card = db.session.query(db.models.Card).get(int(card))
-            buff += style.body_40("{:^3} x {:<25}".format(user.deck.cards[card], s_card.name))
-        buff += style.body_40(" [{}]".format(num_cards, ''), align='left')
-        buff += style.FOOTER_40
-        user.send_to_self(buff)
+    user.send_to_self("Deck '{}' not found.".format(deck_name))
+
+
+def find_card(user, card_name):
+    """
+    Finds the one card card_name could mean, or tells the user why not.
+    """
+    s_cards = server.catalog.search(card_name)
+    if len(s_cards) == 0:
+        user.send_to_self("Card '{}' not found.".format(card_name))
+        return None
+    if len(s_cards) > 1:
+        user.send_to_self("Multiple cards called {}: {} Please be more specific.".format(card_name, ', '.join(card.name for card in s_cards[:config.CARD_SEARCH_LIMIT])))
+        return None
+    return s_cards[0]
+
+
+async def deck_add(user, num_cards, card_name):
+    num_cards = 1 if num_cards is None else num_cards
+    s_card = find_card(user, card_name)
+    if s_card is None:
         return
-    if args[0] in verbs:
-        verbs[args[0]](args[1:] if len(args) > 1 else None)
+    total_cards = 0
+    for card in user.deck.cards:
+        total_cards += user.deck.cards[card]
+    if total_cards >= 600:
+        user.send_to_self("Your deck is at the card limit (600).")
+    if s_card.id in user.deck.cards:
+        user.deck.cards[s_card.id] += num_cards
+    else:
+        user.deck.cards[s_card.id] = num_cards
+    await db.save(user.deck)
+    user.send_to_self("Added {} x '{}' to '{}'.".format(num_cards, s_card.name, user.deck.name))
+
+
+async def deck_remove(user, num_cards, card_name):
+    num_cards = 1 if num_cards is None else num_cards
+    s_card = find_card(user, card_name)
+    if s_card is None:
         return
-    do_help(user, ['deck'])
+    if s_card.id in user.deck.cards:
+        user.deck.cards[s_card.id] -= num_cards
+        if user.deck.cards[s_card.id] < 1:
+            user.deck.cards.pop(s_card.id, None)
+        await db.save(user.deck)
+        user.send_to_self("Removed {} x '{}' from '{}'.".format(num_cards, s_card.name, user.deck.name))
 
 
 def do_decks(user, args):
@@ -498,390 +597,319 @@ def do_decks(user, args):
 
 
 def do_table(user, args):
-    def create(args):
-        if args is None:
-            do_help(user, ['table', 'create'])
-            return
-        table_name = style.strip_colours(' '.join(args))
-        table_ = mud.models.Table(user, table_name)
-        table_.start_time = int(server.tick_count)
-        server.add_tick(table_.round_timer, table_.start_time+50*60, repeat=False)
-        server.tables.append(table_)
-        user.room.tables.append(table_)
-        do_table(user, ['join', table_name])
-
-    def join(args):
-        if args is None:
-            do_help(user, ['table', 'join'])
-            return
-        table_name = ' '.join(args)
-        for t in user.room.tables:
-            if table_name == t.name:
-                if len(t.users) < 2 or user in t.users:
-                    t.join(user)
-                    user.table = t
-                    channels.do_tinfo(user.table, "{} has joined the table.".format(t.name))
-                    return
-        user.send_to_self("Could not find table '{}'.".format(table_name))
-
-    @d_user_has(user, 'table')
-    def dice(args):
-        # if user.table is None:
-        #     do_help(user, ['table', 'dice'])
-        #     return
-        if args is not None:
-            if str(args[0]).isdigit():
-                die_size = int(args[0])
-            else:
-                do_help(user, ['table', 'dice'])
-        else:
-            die_size = 6 #Default dice size
-        roll = randint(1, die_size)
-        channels.do_tinfo(user.table, "{} rolled {} on a {} sided dice.".format(user.name, roll, die_size))
-
-    @d_user_has(user, 'table')
-    def leave(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        table = user.table
-        table.leave(user)
-        channels.do_tinfo(table, "{} has left the table.".format(user.name))
-        user.table = None
-        if len(table.users) < 1:
-            del table
-
-    @d_user_has(user, 'table')
-    def stack(args):
-        # if user.table is None or user.deck is None:
-        #     do_help(user, ['table', 'stack'])
-        #     return
-        user.table.stack(user)
-        user.table.shuffle(user)
-        channels.do_tinfo(user.table, "{} stacked their library.".format(user.name))
-
-    @d_user_has(user, 'table')
-    def life(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        if args is None:
-            user.send_to_self("Do what with your life total?")
-            return
-        if not is_int(args[0]):
-            do_help(user, ['table', 'hp'])
-            return
-        user.table.life_totals[user] += int(args[0])
-        channels.do_tinfo(user.table, "{} set their life total to {}.".format(user.name,user.table.life_totals[user]))
-
-    @d_user_has(user, 'table')
-    def draw(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        if len(user.table.libraries[user]) < 1:
-            user.send_to_self("Your library is empty!")
-            return
-        if args is None:
-            user.table.draw(user)
-            channels.do_tinfo(user.table, "{} draws a card.".format(user.name))
-            return
-        if not is_int(args[0]):
-            do_help(user, ['table', 'draw'])
-            return
-        no_cards = int(args[0])
-        if no_cards < 1:
-            user.send_to_self("Ummm... how would you even... Uhh... I don't... No. Just, no.")
-            return
-        user.table.draw(user, no_cards)
-        channels.do_tinfo(user.table, "{} draws {} cards.".format(user.name, no_cards))
-
-    @d_user_has(user, 'table')
-    def hand(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        user.send_to_self(user.table.hand(user))
-
-    @d_user_has(user, 'table')
-    def play(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        table = user.table
-        if not is_int(args[0]):
-            do_help(user, ['table', 'play'])
-        card_index = int(args[0])
-        if card_index >= len(table.hands[user]):
-            user.send_to_self("Out of range!")
-            return
-        card = table.hands[user][int(args[0])]
-        table.play(user, card)
-        channels.do_tinfo(user.table, "{} plays {}.".format(user.name, card.name))
-
-    @d_user_has(user, 'table')
-    def discard(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        table = user.table
-        if not is_int(args[0]):
-            do_help(user, ['table', 'play'])
-        card_index = int(args[0])
-        if card_index >= len(table.hands[user]):
-            user.send_to_self("Out of range!")
-            return
-        card = table.hands[user][int(args[0])]
-        table.discard(user, card)
-        channels.do_tinfo(user.table, "{} discards {}.".format(user.name, card.name))
-
-    @d_user_has(user, 'table')
-    def tap(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        table = user.table
-        if args is None:
-            do_help(user, ['table', 'tap'])
-            return
-        if is_int(args[0]):
-            card_index = int(args[0])
-            if card_index >= len(table.battlefields[user]):
-                user.send_to_self("Out of range!")
-                return
-            card = table.battlefields[user][card_index]
-            if card.tapped:
-                user.send_to_self("{} is already tapped.".format(card.name))
-                return
-            card.tap()
-            channels.do_tinfo(user.table, "{} taps {}.".format(user.name, card.name))
-        elif args[0] == "all":
-            for card in table.battlefields[user]:
-                card.tap()
-            channels.do_tinfo(user.table, "{} taps all their cards.".format(user.name))
-        else:
-            do_help(user, ['table', 'tap'])
-
-    @d_user_has(user, 'table')
-    def untap(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        table = user.table
-        if args is None:
-            do_help(user, ['table', 'untap'])
-            return
-        if is_int(args[0]):
-            card_index = int(args[0])
-            if card_index >= len(table.battlefields[user]):
-                user.send_to_self("Out of range!")
-                return
-            card = table.battlefields[user][card_index]
-            if not card.tapped:
-                user.send_to_self("'{}' is not tapped.".format(card.name))
-                return
-            card.untap()
-            channels.do_tinfo(user.table, "{} untaps {}.".format(user.name, card.name))
-        elif args[0] == "all":
-            for card in table.battlefields[user]:
-                card.untap()
-            channels.do_tinfo(user, "untap all your cards.", "untaps all their cards.")
-        else:
-            do_help(user, ['table', 'tap'])
-
-    @d_user_has(user, 'table')
-    def shuffle(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        user.table.shuffle(user)
-        channels.do_tinfo(user, "shuffled your library.", "shuffled their library.")
-
-    @d_user_has(user, 'table')
-    def tutor(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        if args is None:
-            do_help(user, ['table', 'tutor'])
-            return
-        card_name = ' '.join(args)
-        if user.table.tutor(user, card_name):
-            channels.do_tinfo(user.table, "{} tutored {} from their library.".format(user.name, card_name))
-        else:
-            user.send_to_self("Failed to find '{}' in your library.".format(card_name))
-
-    @d_user_has(user, 'table')
-    def destroy(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        table = user.table
-        if args is None or not is_int(args[0]):
-            do_help(user, ['table', 'destroy'])
-            return
-        card_index = int(args[0])
-        if card_index >= len(table.battlefields[user]):
-            user.send_to_self("Out of range!")
-            return
-        card = table.battlefields[user][card_index]
-        table.destroy(user, card)
-        channels.do_tinfo(user, "destroy your {}.".format(card.name), "destroys their {}.".format(card.name))
-
-    @d_user_has(user, 'table')
-    def return_(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        table = user.table
-        if args is None or not is_int(args[0]):
-            do_help(user, ['table', 'return'])
-            return
-        card_index = int(args[0])
-        if card_index >= len(table.battlefields[user]):
-            user.send_to_self("Out of range!")
-            return
-        card = table.battlefields[user][card_index]
-        table.return_(user, card)
-        channels.do_tinfo(user.table, "{} returns {} to their hand.".format(user.name, card.name))
-
-    @d_user_has(user, 'table')
-    def greturn(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        table = user.table
-        if args is None or not is_int(args[0]):
-            do_help(user, ['table', 'greturn'])
-            return
-        card_index = int(args[0])
-        if card_index >= len(table.graveyards[user]):
-            user.send_to_self("Out of range!")
-            return
-        card = table.graveyards[user][int(args[0])]
-        table.greturn(user, card)
-        channels.do_tinfo(user, "return {} from your graveyard to hand.".format(card.name), "returns {} from their graveyard to hand.".format(card.name))
-
-    @d_user_has(user, 'table')
-    def unearth(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        table = user.table
-        if args is None or not is_int(args[0]):
-            do_help(user, ['table', 'unearth'])
-            return
-        card_index = int(args[0])
-        if card_index >= len(table.graveyards[user]):
-            user.send_to_self("Out of range!")
-            return
-        card = table.graveyards[user][card_index]
-        table.unearth(user, card)
-        channels.do_tinfo(user.table, "{} unearths their {}.".format(user.name, card.name))
-
-    @d_user_has(user, 'table')
-    def exile(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        table = user.table
-        if args is None or not is_int(args[0]):
-            do_help(user, ['table', 'exile'])
-            return
-        card_index = int(args[0])
-        if card_index >= len(table.graveyards[user]):
-            user.send_to_self("Out of range!")
-            return
-        card = table.battlefields[user][card_index]
-        table.exile(user, card)
-        channels.do_tinfo(user, "exile your {}.".format(card.name), "exiles their {}.".format(card.name))
-
-    @d_user_has(user, 'table')
-    def grexile(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        table = user.table
-        if args is None or not is_int(args[0]):
-            do_help(user, ['table', 'grexile'])
-            return
-        card_index = int(args[0])
-        if card_index >= len(table.graveyards[user]):
-            user.send_to_self("Out of range!")
-            return
-        card = table.graveyards[user][card_index]
-        table.grexile(user, card)
-        channels.do_tinfo(user.table, "exiles {} from their graveyard.".format(user.name, card.name))
-
-    @d_user_has(user, 'table')
-    def scoop(args):
-        if user.table is None:
-            user.send_to_self("You're not at a table!")
-            return
-        user.table.scoop(user)
-        channels.do_tinfo(user.table, "{} scoops it up!".format(user.name))
-
-    @d_user_has(user, 'table')
-    def time(args):
-        # if user.table is None:
-        #     user.send_to_self("You're not at a table!")
-        #     return
-        elapsed = int((server.ticker - user.table.start_time)/60)
-        user.send_to_self("{} minutes have elapsed.".format(elapsed))
-
-    verbs = {
-        'create': create,
-        'join': join,
-        'leave': leave,
-        'dice': dice,
-        'stack': stack,
-        'draw': draw,
-        'life': life,
-        'hand': hand,
-        'shuffle': shuffle,
-        'play': play,
-        'tap': tap,
-        'untap': untap,
-        'discard': discard,
-        'tutor': tutor,
-        'destroy': destroy,
-        'return': return_,
-        'greturn': greturn,
-        'unearth': unearth,
-        'exile': exile,
-        'grexile': grexile,
-        'scoop': scoop,
-        'time': time
-    }
+    if user.table is None:
+        do_help(user, ['table'])
+        return
+    if user.flags.get('table_delta'):
+        delta = user.table.show_delta(user)
+        if delta:
+            user.send_to_self(delta)
+        return
+    user.send_to_self(user.table.show())
 
-    if args is None:
-        if user.table is None:
-            do_help(user, ['table'])
-            return
-        user.send_to_self(user.table.show())
+
+def table_redraw(user):
+    if user.flags.get('table_delta'):
+        user.send_to_self(user.table.redraw(user))
+        return
+    user.send_to_self(user.table.show())
+
+
+async def table_delta(user, setting):
+    if setting not in ('on', 'off'):
+        do_help(user, ['table', 'delta'])
+        return
+    user.flags['table_delta'] = setting == 'on'
+    if user.table is not None and user.table.frames.pop(user, None) is not None:
+        user.send_to_self(style.UNPIN)
+    await user.save()
+    user.send_to_self("Table delta updates are now &Y{}&x.".format(setting))
+
+
+def table_create(user, table_name):
+    table_name = style.strip_colours(table_name)
+    if server.tables.get(user.room, table_name) is not None:
+        user.send_to_self("The table name '{}' is already taken, sorry.".format(table_name))
+        return
+    table_ = mud.models.Table(user, table_name)
+    table_.start_time = server.timers.time()
+    table_.timers.append(server.timers.call_later(50*60, table_.round_timer))
+    server.open_table(table_)
+    table_join(user, table_name)
+
+
+def table_join(user, table_name):
+    t = server.tables.get(user.room, table_name)
+    if t is not None and (len(t.users) < 2 or user in t.users):
+        server.join_table(user, t)
+        channels.do_tinfo(user.table, "{} has joined the table.".format(user.name))
+        return
+    user.send_to_self("Could not find table '{}'.".format(table_name))
+
+
+def table_dice(user, die_size):
+    die_size = 6 if die_size is None else die_size #Default dice size
+    if die_size < 1:
+        do_help(user, ['table', 'dice'])
         return
+    roll = randint(1, die_size)
+    channels.do_tinfo(user.table, "{} rolled {} on a {} sided dice.".format(user.name, roll, die_size))
 
-    if args[0] in verbs:
-        verbs[args[0]](args[1:] if len(args) > 1 else None)
+
+def table_leave(user):
+    table = server.leave_table(user)
+    channels.do_tinfo(table, "{} has left the table.".format(user.name))
+
+
+def table_stack(user):
+    user.table.stack(user, server.catalog)
+    user.table.shuffle(user)
+    channels.do_tinfo(user.table, "{} stacked their library.".format(user.name))
+
+
+def table_life(user, amount):
+    life = user.table.adjust_life(user, amount)
+    channels.do_tinfo(user.table, "{} set their life total to {}.".format(user.name, life))
+
+
+def table_draw(user, no_cards):
+    if len(user.table.libraries[user]) < 1:
+        user.send_to_self("Your library is empty!")
+        return
+    if no_cards is None:
+        user.table.draw(user)
+        channels.do_tinfo(user.table, "{} draws a card.".format(user.name))
+        return
+    if no_cards < 1:
+        user.send_to_self("Ummm... how would you even... Uhh... I don't... No. Just, no.")
+        return
+    no_cards = user.table.draw(user, no_cards)
+    channels.do_tinfo(user.table, "{} draws {} cards.".format(user.name, no_cards))
+
+
+def table_mill(user, no_cards):
+    if len(user.table.libraries[user]) < 1:
+        user.send_to_self("Your library is empty!")
+        return
+    no_cards = 1 if no_cards is None else no_cards
+    if no_cards < 1:
+        user.send_to_self("Ummm... how would you even... Uhh... I don't... No. Just, no.")
+        return
+    no_cards = user.table.mill(user, no_cards)
+    channels.do_tinfo(user.table, "{} mills {} card{}.".format(user.name, no_cards, '' if no_cards == 1 else 's'))
+
+
+def table_hand(user):
+    user.send_to_self(user.table.hand(user))
+
+
+def get_card(user, zone, number):
+    """
+    Finds card number in zone, or tells the user why not.
+    """
+    card = zone.get(number)
+    if card is None:
+        user.send_to_self("No such card!")
+    return card
+
+
+def table_play(user, number):
+    table = user.table
+    card = get_card(user, table.hands[user], number)
+    if card is None:
+        return
+    table.play(user, card)
+    channels.do_tinfo(user.table, "{} plays {}.".format(user.name, card.name))
+
+
+def table_discard(user, number):
+    table = user.table
+    card = get_card(user, table.hands[user], number)
+    if card is None:
+        return
+    table.discard(user, card)
+    channels.do_tinfo(user.table, "{} discards {}.".format(user.name, card.name))
+
+
+def table_tap(user, which):
+    table = user.table
+    if which == "all":
+        table.tap_all(user)
+        channels.do_tinfo(user.table, "{} taps all their cards.".format(user.name))
+        return
+    if not which.lstrip('-').isdigit():
+        do_help(user, ['table', 'tap'])
+        return
+    card = get_card(user, table.battlefields[user], int(which))
+    if card is None:
+        return
+    if card.tapped:
+        user.send_to_self("{} is already tapped.".format(card.name))
+        return
+    table.tap(user, card)
+    channels.do_tinfo(user.table, "{} taps {}.".format(user.name, card.name))
+
+
+def table_untap(user, which):
+    table = user.table
+    if which == "all":
+        table.tap_all(user, False)
+        channels.do_tinfo(user.table, "{} untaps all their cards.".format(user.name))
+        return
+    if not which.lstrip('-').isdigit():
+        do_help(user, ['table', 'untap'])
+        return
+    card = get_card(user, table.battlefields[user], int(which))
+    if card is None:
+        return
+    if not card.tapped:
+        user.send_to_self("'{}' is not tapped.".format(card.name))
+        return
+    table.untap(user, card)
+    channels.do_tinfo(user.table, "{} untaps {}.".format(user.name, card.name))
+
+
+def table_shuffle(user):
+    user.table.shuffle(user)
+    channels.do_tinfo(user.table, "{} shuffled their library.".format(user.name))
+
+
+def table_tutor(user, card_name):
+    if user.table.tutor(user, card_name):
+        channels.do_tinfo(user.table, "{} tutored {} from their library.".format(user.name, card_name))
     else:
-        do_help(user, ['table'])
+        user.send_to_self("Failed to find '{}' in your library.".format(card_name))
+
 
-actions = {
-    'login': do_login,
-    'quit':  do_quit,
-    'look':  do_look,
-    'who':   do_who,
-    'help':  do_help,
-    'alias': do_alias,
-    'freeze': do_freeze,
-    'mute': do_mute,
-    'make_admin': do_make_admin,
-    'rooms': do_rooms,
-    'room':  do_room,
-    'goto':  do_goto,
-    'card':  do_card,
-    'deck':  do_deck,
-    'decks': do_decks,
-    'table': do_table
-}
+def table_destroy(user, number):
+    table = user.table
+    card = get_card(user, table.battlefields[user], number)
+    if card is None:
+        return
+    table.destroy(user, card)
+    channels.do_tinfo(user.table, "{} destroys their {}.".format(user.name, card.name))
 
+
+def table_return(user, number):
+    table = user.table
+    card = get_card(user, table.battlefields[user], number)
+    if card is None:
+        return
+    table.return_(user, card)
+    channels.do_tinfo(user.table, "{} returns {} to their hand.".format(user.name, card.name))
+
+
+def table_greturn(user, number):
+    table = user.table
+    card = get_card(user, table.graveyards[user], number)
+    if card is None:
+        return
+    table.greturn(user, card)
+    channels.do_tinfo(user.table, "{} returns {} from their graveyard to hand.".format(user.name, card.name))
+
+
+def table_unearth(user, number):
+    table = user.table
+    card = get_card(user, table.graveyards[user], number)
+    if card is None:
+        return
+    table.unearth(user, card)
+    channels.do_tinfo(user.table, "{} unearths their {}.".format(user.name, card.name))
+
+
+def table_exile(user, number):
+    table = user.table
+    card = get_card(user, table.battlefields[user], number)
+    if card is None:
+        return
+    table.exile(user, card)
+    channels.do_tinfo(user.table, "{} exiles their {}.".format(user.name, card.name))
+
+
+def table_grexile(user, number):
+    table = user.table
+    card = get_card(user, table.graveyards[user], number)
+    if card is None:
+        return
+    table.grexile(user, card)
+    channels.do_tinfo(user.table, "{} exiles {} from their graveyard.".format(user.name, card.name))
+
+
+def table_scoop(user):
+    user.table.scoop(user)
+    channels.do_tinfo(user.table, "{} scoops it up!".format(user.name))
+
+
+def table_time(user):
+    elapsed = int((server.timers.time() - user.table.start_time)/60)
+    user.send_to_self("{} minutes have elapsed.".format(elapsed))
+
+
+def show_usage(user, topic):
+    do_help(user, topic)
+
+
+# Checks run before a command, as (user attribute, message if it is None)
+AT_TABLE = [('table', "You're not at a table!")]
+HAS_DECK = [('deck', "You don't have a deck!")]
+
+room_verbs = CommandTable(show_usage)
+room_verbs.add('create', room_create, args='text', help='room')
+room_verbs.add('delete', room_delete, args='text', help='room')
+
+deck_verbs = CommandTable(show_usage)
+deck_verbs.add('create', deck_create, args='text', help='deck')
+deck_verbs.add('set', deck_set, args='text', help='deck')
+deck_verbs.add('add', deck_add, args='int? text', help='deck', requires=HAS_DECK)
+deck_verbs.add('remove', deck_remove, args='int? text', help='deck', requires=HAS_DECK)
+
+table_verbs = CommandTable(show_usage)
+table_verbs.add('create', table_create, args='text', help='table create')
+table_verbs.add('join', table_join, args='text', help='table join')
+table_verbs.add('leave', table_leave, args='', requires=AT_TABLE, help='table leave')
+table_verbs.add('dice', table_dice, args='int?', requires=AT_TABLE, help='table dice')
+table_verbs.add('stack', table_stack, args='', requires=AT_TABLE, help='table stack')
+table_verbs.add('draw', table_draw, args='int?', requires=AT_TABLE, help='table draw')
+table_verbs.add('mill', table_mill, args='int?', requires=AT_TABLE, help='table mill')
+table_verbs.add('life', table_life, args='int', requires=AT_TABLE, help='table life')
+table_verbs.add('hand', table_hand, args='', requires=AT_TABLE, help='table hand')
+table_verbs.add('shuffle', table_shuffle, args='', requires=AT_TABLE, help='table shuffle')
+table_verbs.add('play', table_play, args='int', requires=AT_TABLE, help='table play')
+table_verbs.add('tap', table_tap, args='word', requires=AT_TABLE, help='table tap')
+table_verbs.add('untap', table_untap, args='word', requires=AT_TABLE, help='table untap')
+table_verbs.add('discard', table_discard, args='int', requires=AT_TABLE, help='table discard')
+table_verbs.add('tutor', table_tutor, args='text', requires=AT_TABLE, help='table tutor')
+table_verbs.add('destroy', table_destroy, args='int', requires=AT_TABLE, help='table destroy')
+table_verbs.add('return', table_return, args='int', requires=AT_TABLE, help='table return')
+table_verbs.add('greturn', table_greturn, args='int', requires=AT_TABLE, help='table greturn')
+table_verbs.add('unearth', table_unearth, args='int', requires=AT_TABLE, help='table unearth')
+table_verbs.add('exile', table_exile, args='int', requires=AT_TABLE, help='table exile')
+table_verbs.add('grexile', table_grexile, args='int', requires=AT_TABLE, help='table grexile')
+table_verbs.add('scoop', table_scoop, args='', requires=AT_TABLE, help='table scoop')
+table_verbs.add('time', table_time, args='', requires=AT_TABLE, help='table time')
+table_verbs.add('redraw', table_redraw, args='', requires=AT_TABLE, help='table delta')
+table_verbs.add('delta', table_delta, args='word', help='table delta')
+
+commands = CommandTable(show_usage)
+# Only by its full name, so that 'l' is still short for 'look'
+commands.add('login', do_login, sensitive=True, abbreviate=False)
+commands.add('quit', do_quit)
+commands.add('look', do_look)
+commands.add('who', do_who)
+commands.add('help', do_help)
+commands.add('alias', do_alias)
+commands.add('colour', do_colour)
+commands.add('freeze', do_freeze, permission='admin')
+commands.add('mute', do_mute, permission='admin')
+commands.add('ban', do_ban, permission='admin')
+commands.add('make_admin', do_make_admin, permission='owner')
+commands.add('reload', do_reload, args='word?', permission='admin')
+commands.add('stats', do_stats, args='word?', permission='admin')
+commands.add('profile', do_profile, args='word? word?', permission='admin')
+commands.add('rooms', do_rooms)
+commands.add('room', do_room, verbs=room_verbs)
+commands.add('goto', do_goto, args='text')
+commands.add('card', do_card)
+commands.add('deck', do_deck, verbs=deck_verbs)
+commands.add('decks', do_decks)
+commands.add('table', do_table, verbs=table_verbs)
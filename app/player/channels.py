@@ -1,17 +1,14 @@
 from app import server
-from app import db
+from app.mud.bus import SERVER, room_topic, table_topic
 
 def send_to_server(msg):
-    for u in server.users:
-        u.send_to_self(msg)
+    server.bus.publish(SERVER, msg)
 
 def send_to_room(room, msg):
-    for user in room.occupants:
-        user.send_to_self(msg)
+    server.bus.publish(room_topic(room), msg)
 
 def send_to_table(table, msg):
-    for user in table.users:
-        user.send_to_self(msg)
+    server.bus.publish(table_topic(table), msg)
 
 # Non-User channels
 def do_info(msg):
@@ -27,30 +24,43 @@ def do_rinfo(room, msg):
 def send_to_channel(user, channel, msg, do_emote=False):
     args = msg.split()
 
-    if channel.type is 0:
-        user_list = server.users
-    if channel.type is 1:
-        user_list = user.room.occupants
-    if channel.type is 2:
-        user_list = user.table.users
-    if channel.type is 3:
-        user_list = [server.get_user(args[0])]
+    if channel.type == 3:
+        target = server.get_user(args[0]) if args else None
+        if target is None:
+            user.send_to_self("{} appears not to be here...".format(args[0] if args else "They"))
+            return
+        topic = server.bus.user_topic(target.db.id)
         args = args[1:]
         msg = ' '.join(args)
-        if msg[0] is '@':
+        if msg[0] == '@':
             do_emote = True
             msg = msg[1:]
             args = msg.split()
+    elif channel.type == 2:
+        topic = table_topic(user.table)
+    elif channel.type == 1:
+        topic = room_topic(user.room)
+    else:
+        topic = SERVER
+
+    def hears(u):
+        # Whether u is in the channel's audience, for picking an emote's victim
+        if channel.type == 3:
+            return u is target
+        if channel.type == 2:
+            return u.table is user.table
+        if channel.type == 1:
+            return u.room is user.room
+        return True
 
     if do_emote:
         if len(args) > 1:
             if args[1] == "self":
                 vict = user
             else:
-                vict = None
-                for u in user_list:
-                    if u.name == args[1]:
-                        vict = u
+                vict = server.get_user(args[1])
+                if vict is not None and not hears(vict):
+                    vict = None
             if vict is None:
                 user.send_to_self("{} appears not to be here...".format(args[1]))
                 return
@@ -62,43 +72,44 @@ def send_to_channel(user, channel, msg, do_emote=False):
             return
 
         if vict is not None and vict is not user:
-            others = [u for u in user_list if u is not user and u is not vict and channel.key in u.db.listening]
-            msg_vict = "&W[&x{}{}&x&W]&x {}{}&x".format(channel.colour_token, channel.name, channel.colour_token, emote['vict'])
+            exclude = (user.db.id, vict.db.id)
+            msg_vict = channel.emote_line(msg=emote['vict'])
         else:
-            others = [u for u in user_list if u is not user and channel.key in u.db.listening] if emote['others'] is not None else None
-        msg_user = "&W[&x{}{}&x&W]&x {}{}&x".format(channel.colour_token, channel.name, channel.colour_token, emote['user'])
-        msg_others = "&W[&x{}{}&x&W]&x {}{}&x".format(channel.colour_token, channel.name, channel.colour_token, emote['others']) if emote['others'] is not None else None
+            exclude = (user.db.id,)
+        msg_user = channel.emote_line(msg=emote['user'])
+        msg_others = channel.emote_line(msg=emote['others']) if emote['others'] is not None else None
     else:
-        others = [u for u in user_list if u is not user and channel.key in u.db.listening]
-        msg_user = "&W[&x{}{}&x&W]&x You{}: {}{}&x".format(channel.colour_token, channel.name, " to {}".format(others[0].name) if channel.type is 3 else "", channel.colour_token, msg)
-        msg_others = "&W[&x{}{}&x&W]&x {}: {}{}&x".format(channel.colour_token, channel.name, user.name, channel.colour_token, msg)
+        exclude = (user.db.id,)
+        msg_user = channel.user_line(to=" to {}".format(target.name) if channel.type == 3 else "", msg=msg)
+        msg_others = channel.others_line(user=user.name, msg=msg)
 
     user.send_to_self(msg_user)
     if do_emote and vict is not None and vict is not user:
         user.send_to_user(vict, msg_vict)
-    if others is not None:
-        user.send_to_users(others, msg_others)
+    if msg_others is not None:
+        # Only to those listening to the channel
+        server.bus.publish(topic, msg_others, channel=channel.key, exclude=exclude)
 
 
 def get_emote(user, emote, vict=None):
-    emote = db.session.query(db.models.Emote).filter_by(name=emote).first()
+    emote = server.emotes.get(emote)
     if emote is None:
         return None
     if vict is not None:
         if vict is user:
             return {
-                'user': emote.user_vict_self.format(user=user.name) if emote.user_vict_self is not None else emote.user_no_vict.format(user=user.name),
-                'others': emote.others_vict_self.format(user=user.name) if emote.others_vict_self is not None else emote.others_no_vict.format(user=user.name)
+                'user': emote.user_vict_self(user=user.name) if emote.user_vict_self is not None else emote.user_no_vict(user=user.name),
+                'others': emote.others_vict_self(user=user.name) if emote.others_vict_self is not None else emote.others_no_vict(user=user.name)
             }
 
         else:
             return {
-                'user': emote.user_vict.format(user=user.name, vict=vict.name) if emote.user_vict is not None else emote.user_no_vict.format(user=user.name),
-                'others': emote.others_vict.format(user=user.name, vict=vict.name) if emote.others_vict is not None else emote.others_no_vict.format(user=user.name),
-                'vict': emote.vict_vict.format(user=user.name) if emote.vict_vict is not None else None
+                'user': emote.user_vict(user=user.name, vict=vict.name) if emote.user_vict is not None else emote.user_no_vict(user=user.name),
+                'others': emote.others_vict(user=user.name, vict=vict.name) if emote.others_vict is not None else emote.others_no_vict(user=user.name),
+                'vict': emote.vict_vict(user=user.name) if emote.vict_vict is not None else None
             }
     else:
         return {
-            'user': emote.user_no_vict.format(user=user.name),
-            'others': emote.others_no_vict.format(user=user.name) if emote.others_no_vict is not None else None
+            'user': emote.user_no_vict(user=user.name),
+            'others': emote.others_no_vict(user=user.name) if emote.others_no_vict is not None else None
         }
\ No newline at end of file
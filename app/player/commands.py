@@ -0,0 +1,243 @@
+from app import config
+
+
+class ArgumentError(ValueError):
+    pass
+
+
+def _int(args, i):
+    return int(args[i]), i + 1
+
+
+def _word(args, i):
+    return args[i], i + 1
+
+
+def _text(args, i):
+    if i >= len(args):
+        raise IndexError(i)
+    return ' '.join(args[i:]), len(args)
+
+
+ARG_TYPES = {
+    'int': _int,
+    'word': _word,
+    'text': _text
+}
+
+
+def compile_args(spec):
+    """
+    Turns an argument spec such as 'int? text' into a function that takes the
+    words after a command and returns the values to call its handler with.
+    A '?' marks an argument as optional (None when missing); 'text' takes
+    the rest of the line. Raises ArgumentError if the words don't fit.
+    """
+    steps = []
+    for token in spec.split():
+        steps.append((ARG_TYPES[token.rstrip('?')], token.endswith('?')))
+
+    def parse(args):
+        args = args or ()
+        values = []
+        i = 0
+        for take, optional in steps:
+            try:
+                value, i = take(args, i)
+            except (ValueError, IndexError):
+                if not optional:
+                    raise ArgumentError(spec)
+                value = None
+            values.append(value)
+        if i < len(args):
+            raise ArgumentError(spec)
+        return values
+
+    return parse
+
+
+class PrefixTrie(object):
+    """
+    Maps words to values, and finds the words a prefix could be short for.
+    """
+    def __init__(self):
+        self.root = {}
+
+    def add(self, word, value):
+        node = self.root
+        for c in word:
+            node = node.setdefault(c, {})
+        # None can't be a character, so it marks the end of a word
+        node[None] = (word, value)
+
+    def complete(self, prefix):
+        """
+        Returns [(word, value), ...] for every word starting with prefix.
+        """
+        node = self.root
+        for c in prefix:
+            node = node.get(c)
+            if node is None:
+                return []
+        found = []
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            for c, child in node.items():
+                if c is None:
+                    found.append(child)
+                else:
+                    nodes.append(child)
+        found.sort()
+        return found
+
+
+# Permission name: check the user must pass to run the command
+PERMISSIONS = {
+    'admin': lambda user: user.is_admin(),
+    'owner': lambda user: user.name == config.ADMIN
+}
+
+
+class Command(object):
+    """
+    A command and everything needed to run it, worked out when it is
+    registered rather than each time it is used.
+
+    Handlers without an argument spec are called as func(user, args), where
+    args is the list of words after the command or None; with a spec they
+    are called as func(user, *values). A command with verbs passes its first
+    word on to the matching verb, and only runs func itself when it is
+    given no words. The words after a sensitive command (a password, say)
+    are never logged.
+    """
+    __slots__ = ('name', 'func', 'spec', 'parse', 'help', 'permission', 'allowed', 'requires', 'verbs', 'usage',
+                 'sensitive')
+
+    def __init__(self, name, func, args=None, help=None, permission=None, requires=(), verbs=None, usage=None,
+                 sensitive=False):
+        self.name = name
+        self.func = func
+        self.spec = args
+        self.parse = compile_args(args) if args is not None else None
+        self.help = (help or name).split()
+        self.permission = permission
+        self.allowed = PERMISSIONS[permission] if permission is not None else None
+        # ((user attribute, message if it is None), ...)
+        self.requires = tuple(requires)
+        self.verbs = verbs
+        self.usage = usage
+        self.sensitive = sensitive
+
+    def __repr__(self):
+        return "<Command {}>".format(self.name)
+
+    def permits(self, user):
+        return self.allowed is None or self.allowed(user)
+
+    def full_name(self, args, user=None):
+        """
+        The command's name, followed by the verb args start with if it has
+        one ('table play').
+        """
+        if self.verbs is not None and args:
+            verb = self.verbs.find(args[0], user)
+            if verb is not None:
+                return '{} {}'.format(self.name, verb.name)
+        return self.name
+
+    def __call__(self, user, args):
+        """
+        Runs the command for user; returns whatever the handler does, which
+        the caller should await if it is a coroutine.
+        """
+        if not self.permits(user):
+            user.send_to_self("Huh?")
+            return None
+        for attrib, error_msg in self.requires:
+            if getattr(user, attrib, None) is None:
+                user.send_to_self(error_msg)
+                return None
+        if self.verbs is not None and args:
+            verb = self.verbs.find(args[0], user)
+            if verb is None:
+                matches = self.verbs.matches(args[0], user)
+                if matches:
+                    user.send_to_self("Did you mean: {}?".format(', '.join(matches)))
+                    return None
+                return self.usage(user, self.help)
+            return verb(user, args[1:] if len(args) > 1 else None)
+        if self.parse is None:
+            return self.func(user, args)
+        try:
+            values = self.parse(args)
+        except ArgumentError:
+            return self.usage(user, self.help)
+        return self.func(user, *values)
+
+
+class CommandTable(object):
+    """
+    A set of commands that can be looked up by name or by any abbreviation
+    of it that isn't ambiguous. Used for top level commands and for the verbs
+    of commands like 'table'.
+    """
+    def __init__(self, usage):
+        # usage(user, help_topic) is called when a command is used wrongly
+        self.usage = usage
+        self.by_name = {}
+        self.trie = PrefixTrie()
+
+    def __iter__(self):
+        return iter(self.by_name.values())
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    def add(self, name, func, abbreviate=True, **kwargs):
+        """
+        Registers a command. With abbreviate=False it is only found by its
+        full name, and doesn't make shorter words ambiguous.
+        """
+        command = Command(name, func, usage=self.usage, **kwargs)
+        self.by_name[name] = command
+        if abbreviate:
+            self.trie.add(name, command)
+        return command
+
+    def complete(self, word, user=None):
+        """
+        Returns [(name, command), ...] for every command starting with word,
+        leaving out those user isn't allowed to run, so that they are
+        neither offered to nor get in the way of users who can't use them.
+        """
+        matches = self.trie.complete(word)
+        if user is None:
+            return matches
+        return [(name, command) for name, command in matches if command.permits(user)]
+
+    def find(self, word, user=None):
+        """
+        Returns the command word names or abbreviates, or None if there isn't
+        one or it could be short for more than one. With user, only commands
+        they are allowed to run are considered.
+        """
+        command = self.by_name.get(word)
+        if command is not None and (user is None or command.permits(user)):
+            return command
+        matches = self.complete(word, user)
+        if len(matches) == 1:
+            return matches[0][1]
+        # 'dec' means 'deck' rather than 'decks'
+        if matches and all(name.startswith(matches[0][0]) for name, _ in matches):
+            return matches[0][1]
+        return None
+
+    def matches(self, word, user=None):
+        return [name for name, _ in self.complete(word, user)]
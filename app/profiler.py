@@ -0,0 +1,169 @@
+"""
+Profiles the running server for a while, without a restart.
+
+'sample' mode has SIGPROF interrupt the process every few ms of CPU time
+and counts the event loop thread's stack at that moment, filed under the
+command being run (or '(loop)' between commands). It is cheap enough to
+leave on under real traffic, and is written out as collapsed stacks, one
+'command;outer frame;...;inner frame count' line per stack, which
+flamegraph.pl, speedscope and the like read.
+
+'cprofile' mode runs cProfile on the event loop thread instead, which
+counts every call exactly but slows everything down, and writes pstats.
+"""
+import cProfile
+import os
+import pstats
+import signal
+import time
+from collections import Counter
+
+from . import metrics
+
+MODES = ('sample', 'cprofile')
+# Frames deeper than this are left off a sample's stack
+MAX_DEPTH = 128
+IDLE = '(loop)'
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def frame_label(path, line, name):
+    """
+    'function (path:line)', with paths shortened to within the repo or
+    the installed package.
+    """
+    if path.startswith(ROOT + os.sep):
+        path = os.path.relpath(path, ROOT)
+    elif 'site-packages' + os.sep in path:
+        path = path.split('site-packages' + os.sep, 1)[1]
+    else:
+        path = os.path.basename(path)
+    return '{} ({}:{})'.format(name, path, line)
+
+
+class Profiler(object):
+    """
+    Runs one profile at a time: start() it, stop() it, then write() what
+    stop() returns to path(), a file in directory.
+    """
+    def __init__(self, directory, interval=0.005):
+        self.directory = directory
+        self.interval = interval
+        self.mode = None
+        self.started = None
+        self.samples = Counter()
+        self.labels = {}
+        self.profile = None
+        self.previous_handler = None
+
+    @property
+    def running(self):
+        return self.mode is not None
+
+    @staticmethod
+    def can_sample():
+        return hasattr(signal, 'setitimer') and hasattr(signal, 'SIGPROF')
+
+    def start(self, mode='sample'):
+        """
+        Must be called from the event loop (main) thread, which is the one
+        profiled.
+        """
+        if self.running:
+            raise RuntimeError("A {} profile is already running".format(self.mode))
+        if mode not in MODES:
+            raise ValueError("Profile mode must be one of {}".format(', '.join(MODES)))
+        if mode == 'sample':
+            if not self.can_sample():
+                raise RuntimeError("Sampling needs SIGPROF, which this platform doesn't have")
+            self.samples = Counter()
+            self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+            # Let system calls carry on after a sample rather than fail with EINTR
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.mode = mode
+        self.started = time.time()
+
+    def sample(self, signum, frame):
+        timing = metrics.current.get()
+        codes = []
+        while frame is not None and len(codes) < MAX_DEPTH:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        self.samples[(timing.name if timing is not None else IDLE, tuple(codes))] += 1
+
+    def stop(self):
+        """
+        Stops profiling, and returns what was collected: a Counter of
+        {(command, (code, ...)): samples} or a cProfile.Profile.
+        """
+        if not self.running:
+            raise RuntimeError("No profile is running")
+        mode, self.mode = self.mode, None
+        if mode == 'sample':
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+            self.previous_handler = None
+            result, self.samples = self.samples, Counter()
+        else:
+            self.profile.disable()
+            result, self.profile = self.profile, None
+        return result
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = frame_label(code.co_filename, code.co_firstlineno,
+                                                    getattr(code, 'co_qualname', code.co_name))
+        return label
+
+    def collapse(self, samples):
+        """
+        Turns samples from stop() into {'command;outer;...;inner': count}.
+        """
+        stacks = Counter()
+        for (command, codes), count in samples.items():
+            stacks[';'.join([command] + [self.label(code) for code in reversed(codes)])] += count
+        return stacks
+
+    def summary(self, result, top=10):
+        """
+        What took the most time in a result from stop(), as
+        ([(command, share), ...], [(function, share), ...]), shares being
+        fractions of the total. Functions are charged only for time in
+        themselves; cProfile results have no commands.
+        """
+        commands = Counter()
+        functions = Counter()
+        if isinstance(result, cProfile.Profile):
+            for (path, line, name), stat in pstats.Stats(result).stats.items():
+                functions[frame_label(path, line, name)] += stat[2]
+        else:
+            for (command, codes), count in result.items():
+                commands[command] += count
+                if codes:
+                    functions[self.label(codes[0])] += count
+        total = sum(functions.values()) or 1
+        return ([(command, count / total) for command, count in commands.most_common(top)],
+                [(function, count / total) for function, count in functions.most_common(top)])
+
+    def path(self, mode):
+        name = time.strftime('profile-%Y%m%d-%H%M%S', time.localtime(self.started))
+        return os.path.join(self.directory, name + ('.collapsed' if mode == 'sample' else '.pstats'))
+
+    def write(self, result, path):
+        """
+        Writes what stop() returned to path. Blocking, so best run off the
+        event loop.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(result, cProfile.Profile):
+            result.dump_stats(path)
+            return
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.collapse(result).items()):
+                f.write('{} {}\n'.format(stack, count))
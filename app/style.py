@@ -1,3 +1,5 @@
+import re
+from functools import lru_cache
 from textwrap import wrap
 
 COLOUR_TOKENS = {
@@ -20,15 +22,30 @@ COLOUR_TOKENS = {
     '&x': '\033[0m' #reset
 }
 
+# Every token is '&' and a letter. Splitting on them in one regex pass leaves
+# the letters at the odd indexes, which are swapped for their escape codes.
+COLOUR_PATTERN = re.compile('&([{}])'.format(''.join(token[1] for token in COLOUR_TOKENS)))
+COLOUR_CODES = {token[1]: COLOUR_TOKENS[token] for token in COLOUR_TOKENS}
+
+# Strings up to this long (prompts, headers, channel tags...) are cached
+CACHE_MAX_LENGTH = 512
+
+def translate(string):
+    parts = COLOUR_PATTERN.split(string)
+    parts[1::2] = map(COLOUR_CODES.__getitem__, parts[1::2])
+    return ''.join(parts)
+
+@lru_cache(maxsize=1024)
+def _colourify_cached(string):
+    return translate(string)
+
 def colourify(string):
-    for token in COLOUR_TOKENS:
-        string = string.replace(token, COLOUR_TOKENS[token])
-    return string
+    if len(string) <= CACHE_MAX_LENGTH:
+        return _colourify_cached(string)
+    return translate(string)
 
 def strip_colours(string):
-    for token in COLOUR_TOKENS:
-        string = string.replace(token, '')
-    return string
+    return COLOUR_PATTERN.sub('', string)
 
 
 FOOTER_80 =        "&c||############################################################################||&x\r\n"
@@ -121,6 +138,9 @@ def card(card):
     buff += ""+c_token+"****************************************&x\r\n"
     return buff
 
+def card_summary(card):
+    return body_80("{:<32} {:>12}  {:<27}".format(card.name[:32], str(card.manaCost or '')[:12], str(card.type or '')[:27]), align='left')
+
 def room_name(name):
     buff = "&y.-~~~~~~~~~~~~~~~~~~~~~~~~~~&Y{{&W {:^20} &Y}}&x&y~~~~~~~~~~~~~~~~~~~~~~~~~~-.&x\r\n".format(name)
     return buff
@@ -154,10 +174,37 @@ def table_user_stats(life, hand, library, graveyard, poison=None):
     buff ="&G|&x&g+++&x &RLi&x:&R{:^3}&x &GH&x:&G{:^3}&x &YL&x:&Y{:^3}&x &yG&x:&y{:^3}&x {:^5} &g+++&x&G|&x".format(life, hand, library, graveyard, "&MP&x:&M{:^3}&x".format(poison) if poison is not None else "")
     return buff
 
-def table_card(index, card):
-    buff = "&G|&x ({:2}) [{:1}] {:<27} &G|&x".format(index, "T" if card.tapped else "", card.name)
+# width is that of the longest handle shown; the name gives way to it
+def table_card(index, card, width=3):
+    buff = "&G|&x ({:{}}) [{:1}] {:<{}} &G|&x".format(index, width, "T" if card.tapped else "", card.name, 29 - width)
     return buff
 
 def table_card_blank():
     buff = "&G|                                      |&x"
+    return buff
+
+# Moves the cursor home and clears the screen, so a table drawn after it starts on the top row
+CLEAR_SCREEN = "\x1b[H\x1b[2J"
+# Lets the whole screen scroll again
+UNPIN = "\x1b[r"
+
+def table_pin(rows):
+    """
+    Sets the scroll region to the lines below a table of that many rows
+    drawn at the top of the screen, and moves the cursor there, so that
+    prompts and messages scroll underneath it and leave it in place.
+    """
+    top = rows + 2
+    return "\x1b[{};r\x1b[{};1H".format(top, top)
+
+def table_delta(rows):
+    """
+    Redraws the given (index, row) pairs of a table pinned at the top of
+    the screen by table_pin (its header on the first line), then puts the
+    cursor back.
+    """
+    buff = "\x1b7"
+    for index, row in rows:
+        buff += "\x1b[{};1H{}\x1b[K".format(index + 2, row)
+    buff += "\x1b8"
     return buff
\ No newline at end of file
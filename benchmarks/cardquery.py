@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Times 'card' queries against the columnar CardIndex, and against checking
+every card in turn, on a made up card pool.
+
+    python benchmarks/cardquery.py [cards]
+"""
+import os
+import random
+import sys
+import timeit
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Importing the app package starts a server, so app is registered as an
+# empty package and only the modules needed are loaded from it.
+os.environ['DATABASE'] = 'sqlite://'
+sys.path.insert(0, ROOT)
+app = types.ModuleType('app')
+app.__path__ = [os.path.join(ROOT, 'app')]
+sys.modules['app'] = app
+
+from app.db import cardquery  # noqa: E402
+from app.db.catalog import CardCatalog, CardDefinition, normalize  # noqa: E402
+
+WORDS = ['goblin', 'elf', 'dragon', 'angel', 'shade', 'storm', 'grave', 'fire', 'oath', 'wurm',
+         'knight', 'sphinx', 'bolt', 'growth', 'ritual', 'guide', 'lord', 'titan', 'sliver', 'ooze']
+TEXT = ['flying', 'trample', 'haste', 'draw a card', 'deals 3 damage to any target',
+        'destroy target creature', 'add one mana of any color', 'you gain 2 life',
+        'counter target spell', 'target player discards a card', 'create a 1/1 token']
+TYPES = ['Creature', 'Instant', 'Sorcery', 'Enchantment', 'Artifact', 'Land', 'Planeswalker']
+SUBTYPES = ['Elf', 'Goblin', 'Human', 'Wizard', 'Dragon', 'Zombie', 'Beast', 'Soldier']
+COLOURS = ['White', 'Blue', 'Black', 'Red', 'Green']
+RARITIES = ['Common', 'Uncommon', 'Rare', 'Mythic Rare']
+
+QUERIES = [
+    't:creature c:green cmc<=3',
+    't:creature c:green cmc<=3 o:"draw a card"',
+    'o:flying pow>=4 -c:m',
+    '(t:goblin or t:elf) r:rare',
+    'dragon c:r page:3',
+    'c:colourless t:artifact tou>3'
+]
+
+
+def make_card(card_id, rng):
+    card_types = [rng.choice(TYPES)]
+    creature = card_types[0] == 'Creature'
+    return CardDefinition(
+        id=card_id,
+        name=' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title() + ' {}'.format(card_id),
+        names=None,
+        manaCost=None,
+        cmc=rng.randint(0, 8),
+        colors=tuple(rng.sample(COLOURS, rng.choice([0, 1, 1, 1, 2]))) or None,
+        type=card_types[0],
+        supertypes=('Legendary',) if rng.random() < 0.1 else None,
+        types=tuple(card_types),
+        subtypes=tuple(rng.sample(SUBTYPES, rng.randint(1, 2))) if creature else None,
+        rarity=rng.choice(RARITIES),
+        text=' '.join(rng.sample(TEXT, rng.randint(1, 3))),
+        power=str(rng.randint(0, 8)) if creature else None,
+        toughness=str(rng.randint(1, 8)) if creature else None,
+        loyalty=None
+    )
+
+
+def matches(card, node):
+    """
+    What the index does, one card at a time.
+    """
+    kind = node[0]
+    if kind == 'and':
+        return all(matches(card, child) for child in node[1])
+    if kind == 'or':
+        return any(matches(card, child) for child in node[1])
+    if kind == 'not':
+        return not matches(card, node[1])
+    _, field, op, value = node
+    if field in cardquery.NUMERIC_FIELDS:
+        number = cardquery.number(getattr(card, field))
+        return number is not None and cardquery.COMPARISONS[op](number, value)
+    if field == 'color':
+        colours = card.colors or ()
+        if value == 'c':
+            return not colours
+        if value == 'm':
+            return len(colours) > 1
+        return all(colour in colours for colour in value)
+    if field == 'type':
+        names = [name.lower() for name in (card.supertypes or ()) + (card.types or ()) + (card.subtypes or ())]
+        return all(any(name.startswith(word) for name in names) for word in value.lower().split())
+    if field == 'rarity':
+        return (card.rarity or '').lower().startswith(value.lower())
+    key = normalize(card.name if field == 'name' else card.text or '')
+    value = normalize(value)
+    if ' ' in value:
+        return value in key
+    return any(word.startswith(value) for word in key.split())
+
+
+def scan(catalog, query, page_size):
+    cards = sorted(catalog.by_id.values(), key=lambda card: (card.name, card.id))
+    found = [card for card in cards if matches(card, query.tree)]
+    pages = max(1, -(-len(found) // page_size))
+    page = min(query.page, pages)
+    return found[(page - 1) * page_size:page * page_size]
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = random.Random(1)
+    catalog = CardCatalog()
+    for card_id in range(1, size + 1):
+        catalog.add(make_card(card_id, rng))
+    index = cardquery.CardIndex(catalog)
+    build = bench(index.build, 1)
+    print("{} cards, index built in {:.0f} ms".format(size, build / 1000))
+    print("{:<46} {:>8} {:>12} {:>12} {:>8}".format('query', 'matches', 'scan us', 'index us', 'speedup'))
+    for text in QUERIES:
+        query = cardquery.parse(text)
+        page = index.search(query, 20)
+        assert page.cards == scan(catalog, query, 20)
+        scanned = bench(lambda: scan(catalog, query, 20), 3)
+        indexed = bench(lambda: index.search(cardquery.parse(text), 20), 200)
+        print("{:<46} {:>8} {:>12.0f} {:>12.1f} {:>7.0f}x".format(text, page.total, scanned, indexed, scanned / indexed))
+
+
+if __name__ == '__main__':
+    main()
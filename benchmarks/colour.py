@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Compares style.colourify against the old one-str.replace-per-token version on
+table renders, help files and prompts.
+
+    python benchmarks/colour.py
+"""
+import importlib.util
+import os
+import timeit
+from collections import namedtuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.style is loaded straight from its file, as importing the app package
+# starts a server.
+spec = importlib.util.spec_from_file_location('style', os.path.join(ROOT, 'app', 'style.py'))
+style = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(style)
+
+
+def legacy_colourify(string):
+    for token in style.COLOUR_TOKENS:
+        string = string.replace(token, style.COLOUR_TOKENS[token])
+    return string
+
+
+def legacy_strip_colours(string):
+    for token in style.COLOUR_TOKENS:
+        string = string.replace(token, '')
+    return string
+
+
+Card = namedtuple('Card', ['name', 'tapped'])
+
+
+def table_render(players=2, cards=60):
+    buff = style.table_header("Friday Night Magic")
+    for player in range(players):
+        buff += "\r\n" + style.table_user("player{}".format(player))
+        buff += "\r\n" + style.table_user_stats(20, 7, 40, 3, 2)
+        for i in range(cards):
+            buff += "\r\n" + style.table_card(i, Card("Llanowar Elves", i % 3 == 0))
+    return buff
+
+
+def help_files():
+    help_dir = os.path.join(ROOT, 'help')
+    buff = ""
+    for name in sorted(os.listdir(help_dir)):
+        with open(os.path.join(help_dir, name)) as f:
+            buff += f.read()
+    return buff
+
+
+PAYLOADS = {
+    'table (2 x 60 cards)': table_render(),
+    'table (4 x 100 cards)': table_render(4, 100),
+    'all help files': help_files(),
+    'prompt': "&B<&x &calice&x &B||&x &cElves&x &C(&x&c60&x&C)&x &B||&x &GH&x:&G7&x &YL&x:&Y40&x &yG&x:&y3&x &B>&x&w>> &x",
+    'chat line': "&W[&x&Gchat&x&W]&x alice: &Ganyone up for a game?&x",
+}
+
+
+def bench(func, payload, number):
+    return min(timeit.repeat(lambda: func(payload), number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    print("{:<24} {:>8} {:>12} {:>12} {:>12} {:>8}".format('payload', 'bytes', 'legacy us', 'uncached us', 'cached us', 'speedup'))
+    for name, payload in PAYLOADS.items():
+        assert style.colourify(payload) == legacy_colourify(payload)
+        assert style.strip_colours(payload) == legacy_strip_colours(payload)
+        number = max(100, 200000 // len(payload))
+        legacy = bench(legacy_colourify, payload, number)
+        uncached = bench(style.translate, payload, number)
+        current = bench(style.colourify, payload, number)
+        print("{:<24} {:>8} {:>12.2f} {:>12.2f} {:>12.2f} {:>7.1f}x".format(
+            name, len(payload), legacy, uncached, current, legacy / current))
+
+
+if __name__ == '__main__':
+    main()
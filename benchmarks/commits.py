@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Compares commit throughput on a plain SQLite engine (rollback journal,
+synchronous=FULL) against one set up by app.db.engine.make_engine, writing
+one row per commit and in batches, from one thread and from several.
+
+    python benchmarks/commits.py [rows]
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, text
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.db.engine is loaded straight from its file, as importing the app
+# package starts a server.
+spec = importlib.util.spec_from_file_location('engine', os.path.join(ROOT, 'app', 'db', 'engine.py'))
+engine_module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(engine_module)
+
+
+def plain_engine(url):
+    return create_engine(url, connect_args={'check_same_thread': False})
+
+
+def tuned_engine(url):
+    return engine_module.make_engine(url)
+
+
+def write(engine, rows, batch):
+    for start in range(0, rows, batch):
+        with engine.begin() as conn:
+            for i in range(start, min(start + batch, rows)):
+                conn.execute(text("INSERT INTO rows (value) VALUES (:value)"), {'value': 'row {}'.format(i)})
+
+
+def bench(make, rows, batch, threads):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = make('sqlite:///' + os.path.join(tmp, 'bench.db'))
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE rows (id INTEGER PRIMARY KEY, value VARCHAR)"))
+        start = time.perf_counter()
+        if threads == 1:
+            write(engine, rows, batch)
+        else:
+            with ThreadPoolExecutor(threads) as executor:
+                for future in [executor.submit(write, engine, rows // threads, batch) for _ in range(threads)]:
+                    future.result()
+        elapsed = time.perf_counter() - start
+        engine.dispose()
+    return rows / elapsed
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print("{:<28} {:>14} {:>14} {:>8}".format('workload', 'plain rows/s', 'tuned rows/s', 'speedup'))
+    for batch, threads in [(1, 1), (1, 4), (50, 1), (50, 4)]:
+        plain = bench(plain_engine, rows, batch, threads)
+        tuned = bench(tuned_engine, rows, batch, threads)
+        name = "{} row(s)/commit, {} thread(s)".format(batch, threads)
+        print("{:<28} {:>14.0f} {:>14.0f} {:>7.1f}x".format(name, plain, tuned, tuned / plain))
+
+
+if __name__ == '__main__':
+    main()
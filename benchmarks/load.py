@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+Starts the server in this process on a temporary database with a small
+card set, and drives it with simulated telnet clients. Each client
+registers, logs back in, builds a deck, pairs up with another client at a
+table and then plays: drawing and playing cards, chatting on every kind of
+channel, looking around and searching for cards.
+
+Prints a JSON report with command round trip latency percentiles,
+throughput, event loop lag and memory use, so runs can be compared.
+
+    python benchmarks/load.py --clients 50 --duration 30 --output results.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Every command ends with a prompt, which ends like this whether or not
+# colour is on
+PROMPT = b">> "
+HAND_CARD = re.compile(r"\(\s*(\d+)\)")
+
+CARDS = {
+    'Forest': {'type': 'Basic Land — Forest', 'types': ['Land'], 'supertypes': ['Basic'], 'subtypes': ['Forest']},
+    'Mountain': {'type': 'Basic Land — Mountain', 'types': ['Land'], 'supertypes': ['Basic'], 'subtypes': ['Mountain']},
+    'Llanowar Elves': {'manaCost': '{G}', 'cmc': 1, 'colors': ['Green'], 'type': 'Creature — Elf Druid',
+                       'types': ['Creature'], 'subtypes': ['Elf', 'Druid'], 'rarity': 'Common',
+                       'text': '{T}: Add {G}.', 'power': '1', 'toughness': '1'},
+    'Grizzly Bears': {'manaCost': '{1}{G}', 'cmc': 2, 'colors': ['Green'], 'type': 'Creature — Bear',
+                      'types': ['Creature'], 'subtypes': ['Bear'], 'rarity': 'Common', 'power': '2', 'toughness': '2'},
+    'Lightning Bolt': {'manaCost': '{R}', 'cmc': 1, 'colors': ['Red'], 'type': 'Instant', 'types': ['Instant'],
+                       'rarity': 'Common', 'text': 'Lightning Bolt deals 3 damage to any target.'},
+    'Shivan Dragon': {'manaCost': '{4}{R}{R}', 'cmc': 6, 'colors': ['Red'], 'type': 'Creature — Dragon',
+                      'types': ['Creature'], 'subtypes': ['Dragon'], 'rarity': 'Rare',
+                      'text': 'Flying\n{R}: Shivan Dragon gets +1/+0 until end of turn.', 'power': '5', 'toughness': '5'},
+}
+DECK = [(16, 'Forest'), (8, 'Mountain'), (12, 'Llanowar Elves'), (12, 'Grizzly Bears'), (8, 'Lightning Bolt'),
+        (4, 'Shivan Dragon')]
+SEARCHES = ['card bolt', 'card t:creature c:green cmc<=2', 'card o:flying or pow>=5', 'card -t:land r:common']
+CHAT = ['anyone up for a game?', 'nice play', 'gg', 'one more?', 'that dragon though']
+EMOTES = ['smile', 'nod', 'laugh', 'grin']
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    def at(fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+    return {
+        'count': len(values),
+        'mean_ms': sum(values) / len(values) * 1000,
+        'p50_ms': at(0.50),
+        'p90_ms': at(0.90),
+        'p99_ms': at(0.99),
+        'max_ms': values[-1] * 1000
+    }
+
+
+def rss_kb():
+    """
+    Resident set size now, in KiB (None where /proc isn't available).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return None
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Client(object):
+    """
+    One simulated player. send() writes a command and waits for its prompt,
+    recording how long that took under the command's name.
+    """
+    def __init__(self, number, port, stats, rng, timeout):
+        self.name = 'load{}'.format(number)
+        self.number = number
+        self.port = port
+        self.stats = stats
+        self.rng = rng
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.buffer = b""
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        # The welcome screen ends with a prompt
+        await self.response()
+
+    async def response(self):
+        while PROMPT not in self.buffer:
+            try:
+                data = await asyncio.wait_for(self.reader.read(65536), self.timeout)
+            except asyncio.TimeoutError:
+                raise ConnectionError("{} got no prompt for {}s".format(self.name, self.timeout))
+            if not data:
+                raise ConnectionError("{} was disconnected".format(self.name))
+            self.buffer += data
+        text, self.buffer = self.buffer.split(PROMPT, 1)
+        return text.decode('utf-8', errors='replace')
+
+    async def send(self, line, name=None):
+        start = time.perf_counter()
+        self.writer.write(line.encode() + b"\r\n")
+        text = await self.response()
+        self.stats.setdefault(name or line.split()[0], []).append(time.perf_counter() - start)
+        return text
+
+    async def close(self):
+        self.writer.write(b"quit\r\n")
+        with contextlib.suppress(ConnectionError):
+            await self.writer.drain()
+        self.writer.close()
+
+    async def setup(self, tables):
+        await self.connect()
+        await self.send('register {0} pw pw'.format(self.name), 'register')
+        await self.send('colour off')
+        await self.close()
+        await self.connect()
+        await self.send('{} pw'.format(self.name), 'login')
+        await self.send('deck create Bench', 'deck create')
+        for copies, card in DECK:
+            await self.send('deck add {} {}'.format(copies, card), 'deck add')
+        # Clients pair up, the even one of each pair opening the table
+        table = 'bench{}'.format(self.number // 2)
+        if self.number % 2 == 0:
+            await self.send('table create {}'.format(table), 'table create')
+            tables[table] = True
+        else:
+            while not tables.get(table):
+                await asyncio.sleep(0.05)
+            await self.send('table join {}'.format(table), 'table join')
+        await self.send('table stack', 'table stack')
+        await self.send('table draw 7', 'table draw')
+
+    async def play(self, until, think):
+        actions = [
+            (10, self.chat), (10, self.say), (10, self.tchat), (5, self.whisper), (5, self.emote),
+            (15, self.draw_and_play), (10, self.tap), (10, self.view_table), (5, self.look),
+            (5, self.who), (5, self.search), (5, self.hand), (5, self.dice)
+        ]
+        weights = [weight for weight, _ in actions]
+        while time.perf_counter() < until:
+            action = self.rng.choices(actions, weights)[0][1]
+            await action()
+            if think:
+                await asyncio.sleep(self.rng.uniform(0, 2 * think))
+
+    async def chat(self):
+        await self.send('.' + self.rng.choice(CHAT), 'chat')
+
+    async def say(self):
+        await self.send("'" + self.rng.choice(CHAT), 'say')
+
+    async def tchat(self):
+        await self.send(';' + self.rng.choice(CHAT), 'tchat')
+
+    async def whisper(self):
+        partner = 'load{}'.format(self.number ^ 1)
+        await self.send('>{} {}'.format(partner, self.rng.choice(CHAT)), 'whisper')
+
+    async def emote(self):
+        await self.send('.@' + self.rng.choice(EMOTES), 'emote')
+
+    async def draw_and_play(self):
+        await self.send('table draw', 'table draw')
+        hand = HAND_CARD.findall(await self.send('table hand', 'table hand'))
+        if hand:
+            await self.send('table play {}'.format(self.rng.choice(hand)), 'table play')
+        else:
+            await self.send('table stack', 'table stack')
+
+    async def tap(self):
+        await self.send('table {} all'.format(self.rng.choice(['tap', 'untap'])), 'table tap')
+
+    async def view_table(self):
+        await self.send('table', 'table')
+
+    async def look(self):
+        await self.send('look')
+
+    async def who(self):
+        await self.send('who')
+
+    async def search(self):
+        await self.send(self.rng.choice(SEARCHES), 'card')
+
+    async def hand(self):
+        await self.send('table hand', 'table hand')
+
+    async def dice(self):
+        await self.send('table dice 20', 'table dice')
+
+
+async def measure_lag(lag, stop, interval=0.05):
+    """
+    Sleeps for interval over and over, noting how late each wake up is.
+    """
+    loop = asyncio.get_event_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag.append(max(0.0, loop.time() - start - interval))
+
+
+async def run_clients(args, port, stats, errors):
+    tables = {}
+    clients = [Client(i, port, stats, random.Random(args.seed + i), args.timeout) for i in range(args.clients)]
+    semaphore = asyncio.Semaphore(args.ramp)
+
+    async def setup(client):
+        async with semaphore:
+            await client.setup(tables)
+
+    await asyncio.gather(*[setup(client) for client in clients])
+    start = time.perf_counter()
+    until = start + args.duration
+
+    async def play(client):
+        try:
+            await client.play(until, args.think / 1000)
+        except ConnectionError as e:
+            errors.append(str(e))
+        finally:
+            await client.close()
+
+    await asyncio.gather(*[play(client) for client in clients])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=20, help="simulated players (paired up at tables)")
+    parser.add_argument('--duration', type=float, default=20, help="seconds of play, after everyone is set up")
+    parser.add_argument('--think', type=float, default=50, help="mean ms each client waits between commands")
+    parser.add_argument('--ramp', type=int, default=10, help="clients setting up at once")
+    parser.add_argument('--password-rounds', type=int, default=1000, help="pbkdf2 rounds for the test accounts")
+    parser.add_argument('--timeout', type=float, default=30, help="seconds to wait on a prompt before giving up")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the JSON report here as well as to stdout")
+    parser.add_argument('--verbose', action='store_true', help="show the server's own output")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='mud-bench-')
+    card_data = os.path.join(tmp, 'cards.json')
+    with open(card_data, 'w') as f:
+        json.dump({name: dict(card, name=name) for name, card in CARDS.items()}, f)
+    os.environ.update({
+        'DATABASE': 'sqlite:///' + os.path.join(tmp, 'bench.sqlite'),
+        'CARD_DATA': card_data,
+        'PASSWORD_ROUNDS': str(args.password_rounds),
+        'HELP_RELOAD_INTERVAL': '0'
+    })
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+
+    quiet = contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, 'w'))
+    with quiet:
+        from app import db
+        from app.mud.user import User
+
+        loop = asyncio.get_event_loop()
+        server = loop.run_until_complete(loop.create_server(User, host='127.0.0.1', port=0))
+        port = server.sockets[0].getsockname()[1]
+        rss_start = rss_kb()
+
+        # The clients get their own thread and event loop, so the server's
+        # loop lag is the server's alone
+        stats = {}
+        errors = []
+        result = {}
+        done = asyncio.Event()
+
+        def clients():
+            try:
+                result['elapsed'] = asyncio.run(run_clients(args, port, stats, errors))
+            except Exception as e:
+                result['error'] = repr(e)
+            finally:
+                loop.call_soon_threadsafe(done.set)
+
+        lag = []
+        probe = loop.create_task(measure_lag(lag, done))
+        thread = threading.Thread(target=clients, name='clients')
+        thread.start()
+        loop.run_until_complete(done.wait())
+        loop.run_until_complete(probe)
+        thread.join()
+        # Let the last disconnects be handled and written
+        loop.run_until_complete(asyncio.sleep(1))
+        rss_end = rss_kb()
+        db_metrics = db.writer.metrics()
+
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        db.shutdown()
+        db.passwords.shutdown()
+
+    if 'error' in result:
+        sys.exit("Benchmark failed: {}".format(result['error']))
+    play_commands = sum(len(times) for name, times in stats.items())
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'config': {
+            'clients': args.clients,
+            'duration_s': args.duration,
+            'think_ms': args.think,
+            'password_rounds': args.password_rounds,
+            'seed': args.seed
+        },
+        'elapsed_s': result['elapsed'],
+        'commands': play_commands,
+        'throughput_per_s': play_commands / result['elapsed'],
+        'errors': errors,
+        'latency': dict(percentiles([t for times in stats.values() for t in times]), by_command={
+            name: percentiles(times) for name, times in sorted(stats.items())
+        }),
+        'loop_lag': percentiles(lag),
+        'rss_kb': {
+            'start': rss_start,
+            'end': rss_end,
+            # Clients run in this process too, so this is an upper bound
+            'peak': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        },
+        'db': db_metrics
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,26 +9,60 @@ if os.path.exists('.env'):
             os.environ[var[0]] = var[1]
 
 import asyncio
-from app import config
+import app
+from app import config, db
+from app.mud import bus
 from app.mud.user import User
 
 def main():
     print("Server starting up...")
     loop = asyncio.get_event_loop()
+    broker = None
+    bus_link = None
+    if config.BUS_SOCKET and config.BUS_BROKER:
+        broker = loop.run_until_complete(bus.serve(app.server.bus, config.BUS_SOCKET))
+        print("Message broker on {}".format(config.BUS_SOCKET))
+    elif config.BUS_SOCKET:
+        bus_link = loop.run_until_complete(bus.connect(app.server.bus, config.BUS_SOCKET))
+        print("Sharing messages through {}".format(config.BUS_SOCKET))
+    if config.SHARDS:
+        from app.mud import cluster
+        loop.run_until_complete(cluster.start(config.SHARDS))
     coroutine = loop.create_server(User, host=config.HOST, port=config.PORT)
     server = loop.run_until_complete(coroutine)
 
     print("Server now listening on {}".format(server.sockets[0].getsockname()))
 
+    app.server.metrics.start(loop)
+    metrics_server = None
+    if config.METRICS_PORT:
+        metrics_server = loop.run_until_complete(app.server.metrics.serve(config.METRICS_HOST, config.METRICS_PORT))
+        print("Metrics served on http://{}:{}/metrics".format(config.METRICS_HOST, config.METRICS_PORT))
+
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         print("Keyboard Interrupt! \nExiting...")
         pass
 
+    app.server.metrics.stop()
+    if metrics_server is not None:
+        metrics_server.close()
+        loop.run_until_complete(metrics_server.wait_closed())
     server.close()
     loop.run_until_complete(server.wait_closed())
+    loop.run_until_complete(app.server.shutdown())
+    if app.server.cluster is not None:
+        loop.run_until_complete(app.server.cluster.stop())
+    if broker is not None:
+        broker.close()
+        loop.run_until_complete(broker.wait_closed())
+    if bus_link is not None:
+        bus_link.cancel()
+        loop.run_until_complete(asyncio.gather(bus_link, return_exceptions=True))
     loop.close()
+    db.shutdown()
+    db.passwords.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+"""
+The card importer, against a small AllCards.json style fixture.
+
+    python -m pytest tests
+"""
+import gzip
+import json
+import os
+import shutil
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE = os.path.join(ROOT, 'tests', 'fixtures', 'cards.json')
+
+# Importing the app package starts a server, so app is registered as an
+# empty package and only the modules needed are loaded from it.
+os.environ['DATABASE'] = 'sqlite://'
+sys.path.insert(0, ROOT)
+if 'app' not in sys.modules:
+    app = types.ModuleType('app')
+    app.__path__ = [os.path.join(ROOT, 'app')]
+    sys.modules['app'] = app
+
+from sqlalchemy import select  # noqa: E402
+
+from app.db import importer, models  # noqa: E402
+from app.db.engine import make_engine  # noqa: E402
+
+
+def fixture_cards():
+    with open(FIXTURE, encoding='utf-8') as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def gzipped(tmp_path):
+    path = str(tmp_path / 'cards.json.gz')
+    with open(FIXTURE, 'rb') as src, gzip.open(path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    return path
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = make_engine('sqlite:///' + str(tmp_path / 'cards.sqlite'))
+    models.Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+def read_cards(engine):
+    """
+    {name: (text, colours, types)} for every card in the database.
+    """
+    cards = models.Card.__table__
+    with engine.connect() as conn:
+        lists = {}
+        for card_id, name in conn.execute(select([models.card_colors.c.card_id, models.Color.name]).select_from(
+                models.card_colors.join(models.Color.__table__))):
+            lists.setdefault(card_id, ([], []))[0].append(name)
+        for card_id, name, position in conn.execute(select([
+                models.card_types.c.card_id, models.CardType.name, models.card_types.c.position]).select_from(
+                models.card_types.join(models.CardType.__table__)).order_by(models.card_types.c.position)):
+            lists.setdefault(card_id, ([], []))[1].append(name)
+        return {row.name: (row.text, sorted(lists.get(row.id, ([], []))[0]), lists.get(row.id, ([], []))[1])
+                for row in conn.execute(cards.select())}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 65536])
+def test_iter_object_matches_json(chunk_size):
+    # Small chunks split keys, strings and numbers across reads
+    with importer.open_card_data(FIXTURE) as f:
+        pairs = list(importer.iter_object(f, chunk_size=chunk_size))
+    assert pairs == list(fixture_cards().items())
+
+
+def test_iter_object_reads_gzip(gzipped):
+    with importer.open_card_data(gzipped) as f:
+        assert dict(importer.iter_object(f, chunk_size=16)) == fixture_cards()
+
+
+def test_iter_object_empty_and_truncated(tmp_path):
+    empty = tmp_path / 'empty.json'
+    empty.write_text(' { } ')
+    with importer.open_card_data(str(empty)) as f:
+        assert list(importer.iter_object(f)) == []
+    truncated = tmp_path / 'truncated.json'
+    with open(FIXTURE, encoding='utf-8') as f:
+        truncated.write_text(f.read()[:-40], encoding='utf-8')
+    with importer.open_card_data(str(truncated)) as f, pytest.raises(ValueError):
+        list(importer.iter_object(f, chunk_size=64))
+
+
+def test_import_cards(engine, gzipped):
+    assert importer.import_cards(gzipped, batch_size=2, engine=engine) == len(fixture_cards())
+    cards = read_cards(engine)
+    assert set(cards) == set(fixture_cards())
+    assert cards['Fire // Ice'][1] == ['Blue', 'Red']
+    assert cards['Jace, the Mind Sculptor'][2] == ['Legendary', 'Planeswalker', 'Jace']
+    assert cards['Æther Vial'][1] == []
+
+
+def test_import_cards_again_updates(engine, tmp_path):
+    importer.import_cards(FIXTURE, batch_size=4, engine=engine)
+    changed = fixture_cards()
+    changed['Lightning Bolt']['text'] = "Lightning Bolt deals 3 damage to any target. (Errata)"
+    changed['Lightning Bolt']['colors'] = ['Red', 'Green']
+    changed['Llanowar Elves']['subtypes'] = ['Elf']
+    changed['Grizzly Bears'] = {"name": "Grizzly Bears", "manaCost": "{1}{G}", "cmc": 2, "colors": ["Green"],
+                                "type": "Creature — Bear", "types": ["Creature"], "subtypes": ["Bear"]}
+    path = tmp_path / 'changed.json'
+    path.write_text(json.dumps(changed), encoding='utf-8')
+
+    importer.import_cards(str(path), batch_size=3, engine=engine)
+    cards = read_cards(engine)
+    # Matched by name, so nothing is imported twice
+    with engine.connect() as conn:
+        assert len(conn.execute(select([models.Card.__table__.c.id])).fetchall()) == len(changed)
+    assert set(cards) == set(changed)
+    assert cards['Lightning Bolt'] == ("Lightning Bolt deals 3 damage to any target. (Errata)", ['Green', 'Red'], ['Instant'])
+    assert cards['Llanowar Elves'][2] == ['Creature', 'Elf']
+    assert cards['Grizzly Bears'][2] == ['Creature', 'Bear']